@@ -18,6 +18,7 @@ import os
 import os.path
 import pprint
 import textwrap
+import threading
 from copy import copy, deepcopy
 from typing import List
 
@@ -442,6 +443,99 @@ def user_arguments_to_source(user_arguments) -> gen.internals.Source:
     return user_source
 
 
+class ConfigSchema:
+    """Everything about the DC/OS configuration which doesn't depend on the user arguments.
+
+    That is the templates, the targets they make, and the source of all calculated, default and
+    builtin arguments. It is the same for every generate() with the same extra templates, so
+    get_config_schema() only builds it once per process. It must not be modified.
+    """
+
+    def __init__(self, extra_templates: List[str]):
+        # TODO(cmaloney): Make these all just defined by the base calc.py
+        config_package_names = ['dcos-config', 'dcos-metadata']
+
+        template_filenames = [dcos_config_yaml, cloud_config_yaml, 'dcos-metadata.yaml', dcos_services_yaml]
+
+        # TODO(cmaloney): Check there are no duplicates between templates and extra_template_files
+        template_filenames += extra_templates
+
+        # Re-arrange templates to be indexed by common name. Only allow multiple for one key if the key
+        # is yaml (ends in .yaml).
+        templates = dict()
+        for filename in template_filenames:
+            key = os.path.basename(filename)
+            templates.setdefault(key, list())
+            templates[key].append(filename)
+
+            if len(templates[key]) > 1 and not key.endswith('.yaml'):
+                raise Exception(
+                    "Internal Error: Only know how to merge YAML templates at this point in time. "
+                    "Can't merge template {} in template_list {}".format(filename, templates[key]))
+
+        # Include a base target that references variables we need to calculate cluster_packages.
+        base_target = gen.internals.Target({
+            'config_package_names',
+            'dcos_image_commit',
+            'package_ids',
+            'template_filenames',
+        })
+        self._targets = [base_target] + target_from_templates(templates)
+        self._templates = templates
+
+        base_source = gen.internals.Source(is_user=False)
+        base_source.add_entry(gen.calc.entry, replace_existing=False)
+
+        if gen_extra_calc:
+            validate_downstream_entry(gen_extra_calc.entry)
+            base_source.add_entry(gen_extra_calc.entry, replace_existing=True)
+
+        def add_builtin(name, value):
+            base_source.add_must(name, json_prettyprint(value))
+
+        # Add builtin variables.
+        # TODO(cmaloney): Hash the contents of all the templates rather than using the list of filenames
+        # since the filenames might not live in this git repo, or may be locally modified.
+        add_builtin('template_filenames', template_filenames)
+        add_builtin('config_package_names', list(config_package_names))
+
+        # Add placeholders for builtin variables whose values will be calculated after all others, so that we won't
+        # get unset argument errors. The placeholder value with be replaced with the actual value after all other
+        # variables are calculated.
+        temporary_str = 'DO NOT USE THIS AS AN ARGUMENT TO OTHER ARGUMENTS. IT IS TEMPORARY'
+        add_builtin('cluster_packages', temporary_str)
+        add_builtin('cluster_package_list_id', temporary_str)
+        add_builtin('user_arguments_full', temporary_str)
+        add_builtin('user_arguments', temporary_str)
+        add_builtin('config_yaml_full', temporary_str)
+        add_builtin('config_yaml', temporary_str)
+        add_builtin('expanded_config', temporary_str)
+        add_builtin('expanded_config_full', temporary_str)
+
+        self.base_source = base_source
+
+    def get_targets(self):
+        """Return new targets to resolve. Resolving finalizes targets, so they can't be shared."""
+        return [target.copy() for target in self._targets]
+
+    def get_templates(self):
+        """Return the template filenames, indexed by the name of the file they render."""
+        return {name: list(filenames) for name, filenames in self._templates.items()}
+
+
+_config_schemas = dict()
+_config_schemas_lock = threading.Lock()
+
+
+def get_config_schema(extra_templates: List[str]) -> ConfigSchema:
+    """Return the ConfigSchema for extra_templates, building it on first use in this process."""
+    key = tuple(extra_templates)
+    with _config_schemas_lock:
+        if key not in _config_schemas:
+            _config_schemas[key] = ConfigSchema(list(extra_templates))
+        return _config_schemas[key]
+
+
 # TODO(cmaloney): This function should disolve away like the ssh one is and just become a big
 # static dictonary or pass in / construct on the fly at the various template callsites.
 def get_dcosconfig_source_target_and_templates(
@@ -450,67 +544,9 @@ def get_dcosconfig_source_target_and_templates(
         extra_sources: List[gen.internals.Source]):
     log.info("Generating configuration files...")
 
-    # TODO(cmaloney): Make these all just defined by the base calc.py
-    config_package_names = ['dcos-config', 'dcos-metadata']
-
-    template_filenames = [dcos_config_yaml, cloud_config_yaml, 'dcos-metadata.yaml', dcos_services_yaml]
-
-    # TODO(cmaloney): Check there are no duplicates between templates and extra_template_files
-    template_filenames += extra_templates
-
-    # Re-arrange templates to be indexed by common name. Only allow multiple for one key if the key
-    # is yaml (ends in .yaml).
-    templates = dict()
-    for filename in template_filenames:
-        key = os.path.basename(filename)
-        templates.setdefault(key, list())
-        templates[key].append(filename)
-
-        if len(templates[key]) > 1 and not key.endswith('.yaml'):
-            raise Exception(
-                "Internal Error: Only know how to merge YAML templates at this point in time. "
-                "Can't merge template {} in template_list {}".format(filename, templates[key]))
-
-    # Include a base target that references variables we need to calculate cluster_packages.
-    base_target = gen.internals.Target({
-        'config_package_names',
-        'dcos_image_commit',
-        'package_ids',
-        'template_filenames',
-    })
-    targets = [base_target] + target_from_templates(templates)
-    base_source = gen.internals.Source(is_user=False)
-    base_source.add_entry(gen.calc.entry, replace_existing=False)
-
-    if gen_extra_calc:
-        validate_downstream_entry(gen_extra_calc.entry)
-        base_source.add_entry(gen_extra_calc.entry, replace_existing=True)
-
-    def add_builtin(name, value):
-        base_source.add_must(name, json_prettyprint(value))
-
-    sources = [base_source, user_arguments_to_source(user_arguments)] + extra_sources
-
-    # Add builtin variables.
-    # TODO(cmaloney): Hash the contents of all the templates rather than using the list of filenames
-    # since the filenames might not live in this git repo, or may be locally modified.
-    add_builtin('template_filenames', template_filenames)
-    add_builtin('config_package_names', list(config_package_names))
-
-    # Add placeholders for builtin variables whose values will be calculated after all others, so that we won't get
-    # unset argument errors. The placeholder value with be replaced with the actual value after all other variables are
-    # calculated.
-    temporary_str = 'DO NOT USE THIS AS AN ARGUMENT TO OTHER ARGUMENTS. IT IS TEMPORARY'
-    add_builtin('cluster_packages', temporary_str)
-    add_builtin('cluster_package_list_id', temporary_str)
-    add_builtin('user_arguments_full', temporary_str)
-    add_builtin('user_arguments', temporary_str)
-    add_builtin('config_yaml_full', temporary_str)
-    add_builtin('config_yaml', temporary_str)
-    add_builtin('expanded_config', temporary_str)
-    add_builtin('expanded_config_full', temporary_str)
-
-    return sources, targets, templates
+    schema = get_config_schema(extra_templates)
+    sources = [schema.base_source, user_arguments_to_source(user_arguments)] + extra_sources
+    return sources, schema.get_targets(), schema.get_templates()
 
 
 def build_late_package(late_files, config_id, provider):
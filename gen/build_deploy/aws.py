@@ -563,34 +563,35 @@ def gen_buttons(build_name, reproducible_artifact_path, tag, commit, variant_arg
         })
 
 
-def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_completes):
-    # Generate the single-master and multi-master templates.
+def gen_simple_template_for_num_masters(variant_prefix, filename, arguments, num_masters):
+    num_masters_source = Source()
+    num_masters_source.add_must('num_masters', str(num_masters))
+    yield from gen_simple_template(variant_prefix, filename, arguments, num_masters_source)
 
+
+def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_completes, jobs=1):
+    # Generate the single-master, multi-master and advanced templates, up to jobs at once.
+    tasks = []
     for bootstrap_variant, variant_base_args in variant_arguments.items():
         variant_prefix = pkgpanda.util.variant_prefix(bootstrap_variant)
 
-        def make(num_masters, filename):
-            num_masters_source = Source()
-            num_masters_source.add_must('num_masters', str(num_masters))
-            yield from gen_simple_template(
-                variant_prefix,
-                filename,
-                variant_base_args,
-                num_masters_source)
-
         # Single master templates
-        yield from make(1, 'single-master.cloudformation.json')
+        tasks.append((
+            gen_simple_template_for_num_masters,
+            (variant_prefix, 'single-master.cloudformation.json', variant_base_args, 1)))
 
         # Multi master templates
-        yield from make(3, 'multi-master.cloudformation.json')
+        tasks.append((
+            gen_simple_template_for_num_masters,
+            (variant_prefix, 'multi-master.cloudformation.json', variant_base_args, 3)))
 
         # Advanced templates
         for os_type in ['coreos', 'el7']:
-            yield from gen_advanced_template(
-                variant_base_args,
-                variant_prefix,
-                reproducible_artifact_path,
-                os_type)
+            tasks.append((
+                gen_advanced_template,
+                (variant_base_args, variant_prefix, reproducible_artifact_path, os_type)))
+
+    yield from util.run_artifact_tasks(tasks, jobs)
 
     # Button page linking to the basic templates.
     button_page = gen_buttons(build_name, reproducible_artifact_path, tag, commit, variant_arguments)
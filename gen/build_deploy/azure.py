@@ -272,15 +272,19 @@ def make_template(num_masters, gen_arguments, varietal, bootstrap_variant_prefix
         }
 
 
-def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_completes):
+def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_completes, jobs=1):
+    # Generate the templates, up to jobs at once.
+    tasks = []
     for arm_t in ['dcos', 'acs']:
         for num_masters in [1, 3, 5]:
             for bootstrap_name, gen_arguments in variant_arguments.items():
-                yield from make_template(
+                tasks.append((make_template, (
                     num_masters,
                     gen_arguments,
                     arm_t,
-                    pkgpanda.util.variant_prefix(bootstrap_name))
+                    pkgpanda.util.variant_prefix(bootstrap_name))))
+
+    yield from util.run_artifact_tasks(tasks, jobs)
 
     yield {
         'channel_path': 'azure.html',
@@ -704,20 +704,18 @@ def make_bash(gen_out) -> None:
             else:
                 setup_services += "systemctl {} {}\n".format(service['command'], name)
 
-    # Populate in the bash script template
-    bash_script = gen.template.parse_str(bash_template).render({
-        'dcos_image_commit': util.dcos_image_commit,
-        'generation_date': util.template_generation_date,
-        'setup_flags': setup_flags,
-        'setup_services': setup_services,
-        'mesos_agent_work_dir': gen_out.arguments['mesos_agent_work_dir'],
-        'exhibitor_ca_certificate': gen_out.arguments['exhibitor_ca_certificate'],
-        'exhibitor_ca_certificate_path': gen_out.arguments['exhibitor_ca_certificate_path'],
-    })
-
-    # Output the dcos install script
+    # Populate in the bash script template and output the dcos install script
     install_script_filename = 'dcos_install.sh'
-    pkgpanda.util.write_string(install_script_filename, bash_script)
+    with pkgpanda.util.open_atomic(install_script_filename) as f:
+        gen.template.parse_str(bash_template).render_to(f, {
+            'dcos_image_commit': util.dcos_image_commit,
+            'generation_date': util.template_generation_date,
+            'setup_flags': setup_flags,
+            'setup_services': setup_services,
+            'mesos_agent_work_dir': gen_out.arguments['mesos_agent_work_dir'],
+            'exhibitor_ca_certificate': gen_out.arguments['exhibitor_ca_certificate'],
+            'exhibitor_ca_certificate_path': gen_out.arguments['exhibitor_ca_certificate_path'],
+        })
     gen_out.utils.add_channel_artifact(install_script_filename)
 
 
@@ -830,7 +828,7 @@ def make_installer_docker(variant, variant_info, installer_info):
     return installer_filename
 
 
-def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_completes):
+def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_completes, jobs=1):
     """Create a installer script for each variant in bootstrap_dict.
 
     Writes a dcos_generate_config.<variant>.sh for each variant in
@@ -839,6 +837,9 @@ def do_create(tag, build_name, reproducible_artifact_path, commit, variant_argum
     variants to (genconf_version, genconf_filename) tuples.
 
     Outputs the generated dcos_generate_config.sh as it's artifacts.
+
+    jobs is accepted like for the other providers, but the installers are
+    built one at a time.
     """
     # TODO(cmaloney): Build installers in parallel.
     # Variants are sorted for stable ordering.
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+import time
+
+import gen.build_deploy.util
+import pkgpanda.util
+
+
+def make_artifacts(name, delay):
+    # Finish in a different order than started, and write output from both python and a subprocess.
+    time.sleep(delay)
+    print('making {}'.format(name))
+    print('warning from {}'.format(name), file=sys.stderr)
+    subprocess.check_call(['echo', 'made {}'.format(name)])
+    subprocess.check_call('echo error from {} >&2'.format(name), shell=True)
+    yield {'channel_path': name + '.json'}
+    yield {'reproducible_path': name + '.tar.xz'}
+
+
+def test_run_artifact_tasks(capfd):
+    tasks = [(make_artifacts, (name, delay)) for name, delay in [('a', 0.3), ('b', 0), ('c', 0.1)]]
+    expected_artifacts = [artifact for name in 'abc' for artifact in [
+        {'channel_path': name + '.json'},
+        {'reproducible_path': name + '.tar.xz'}]]
+    expected_out = ''.join('making {0}\nmade {0}\n'.format(name) for name in 'abc')
+    expected_err = ''.join('warning from {0}\nerror from {0}\n'.format(name) for name in 'abc')
+
+    for jobs in [1, 3]:
+        assert list(gen.build_deploy.util.run_artifact_tasks(tasks, jobs)) == expected_artifacts
+        out, err = capfd.readouterr()
+        assert out == expected_out
+        assert err == expected_err
+
+
+def get_tar_threads():
+    yield pkgpanda.util.max_tar_threads
+
+
+def test_run_artifact_tasks_tar_threads(monkeypatch):
+    # The workers share the CPUs for compressing rather than each using up to all of them.
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    assert list(gen.build_deploy.util.run_artifact_tasks([(get_tar_threads, ())], 4)) == [2]
+    assert list(gen.build_deploy.util.run_artifact_tasks([(get_tar_threads, ())], 16)) == [1]
+    monkeypatch.setattr(pkgpanda.util, 'max_tar_threads', 1)
+    assert list(gen.build_deploy.util.run_artifact_tasks([(get_tar_threads, ())], 2)) == [1]
@@ -1,9 +1,14 @@
 import os
 import os.path
 import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
 from datetime import datetime
 from subprocess import check_output
 
+import pkgpanda.util
 from pkgpanda.util import write_json, write_string
 
 dcos_image_commit = os.getenv('DCOS_IMAGE_COMMIT', None)
@@ -69,3 +74,74 @@ def variant_prefix(variant):
     if variant is None:
         return ''
     return variant + '.'
+
+
+def _restore_fds(saved_fds):
+    for fd, saved_fd in enumerate(saved_fds, start=1):
+        os.dup2(saved_fd, fd)
+        os.close(saved_fd)
+
+
+def _run_task_captured(function, args, tar_threads):
+    """Run function(*args) in a pool worker, returning the artifacts it yields and its output.
+
+    Everything the task writes to stdout and stderr, including the output of
+    the processes it runs, is captured separately at the file descriptor
+    level. If the task fails its output is written out straight away, as
+    there is nothing to return it with. The tarballs the task makes are
+    compressed on at most tar_threads threads.
+    """
+    pkgpanda.util.max_tar_threads = tar_threads
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        def read(output):
+            output.seek(0)
+            return output.read().decode(errors='replace')
+
+        saved_fds = [os.dup(1), os.dup(2)]
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        try:
+            # sys.stdout / sys.stderr may not write to the file descriptors (e.g. under pytest).
+            with open(stdout.fileno(), 'w', buffering=1, closefd=False) as stdout_stream, \
+                    open(stderr.fileno(), 'w', buffering=1, closefd=False) as stderr_stream, \
+                    redirect_stdout(stdout_stream), redirect_stderr(stderr_stream):
+                artifacts = list(function(*args))
+        except BaseException:
+            _restore_fds(saved_fds)
+            _write_output(read(stdout), read(stderr))
+            raise
+        _restore_fds(saved_fds)
+        return artifacts, read(stdout), read(stderr)
+
+
+def _write_output(stdout, stderr):
+    sys.stdout.write(stdout)
+    sys.stdout.flush()
+    sys.stderr.write(stderr)
+    sys.stderr.flush()
+
+
+def run_artifact_tasks(tasks, jobs=1):
+    """Run each (function, args) task in tasks, yielding the artifacts each yields.
+
+    With jobs > 1 the tasks run in a pool of up to jobs processes, so function
+    and args must be picklable. Artifacts are yielded in the order of tasks, and
+    the stdout and stderr of each task are written to stdout and stderr just
+    before its artifacts are yielded. Each stream comes out as if the tasks ran
+    one after the other, but how a task's stdout and stderr interleave is lost.
+    The CPUs are shared out between the workers for compressing tarballs.
+    """
+    if jobs <= 1:
+        for function, args in tasks:
+            yield from function(*args)
+        return
+
+    tar_threads = min(pkgpanda.util.max_tar_threads, max(1, (os.cpu_count() or 1) // jobs))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_run_task_captured, function, args, tar_threads) for function, args in tasks]
+        for future in futures:
+            artifacts, stdout, stderr = future.result()
+            _write_output(stdout, stderr)
+            yield from artifacts
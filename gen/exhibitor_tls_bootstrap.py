@@ -8,6 +8,7 @@ from typing import Any, Dict, List, Tuple
 from urllib.parse import urlparse
 
 from gen.exceptions import ExhibitorTLSBootstrapError
+from pkgpanda.util import extract_tarball
 
 
 PACKAGE_NAME = 'dcos-bootstrap-ca'
@@ -67,11 +68,11 @@ def _find_package(packages_json: str) -> str:
 
 
 def _extract_package(package_path: str) -> None:
-    """ Extracts the dcos-bootstrap-ca package from the local pkgpanda
-    repository """
+    """ Extracts the dcos-bootstrap-ca binary from the dcos-bootstrap-ca
+    package in the local pkgpanda repository """
     Path(BINARY_PATH).mkdir(exist_ok=True)
     with tempfile.TemporaryDirectory() as td:
-        subprocess.run(['tar', '-xJf', package_path, '-C', td])
+        extract_tarball(str(package_path), td, members=['bin/' + PACKAGE_NAME])
 
         shutil.move(
             Path(td) / 'bin' / PACKAGE_NAME,
@@ -2,6 +2,8 @@ import copy
 import enum
 import inspect
 import logging
+import weakref
+from collections import defaultdict
 from contextlib import contextmanager
 from functools import partial, partialmethod
 from typing import Any, Callable, Dict, List, Set, Tuple, Union
@@ -13,8 +15,22 @@ from pkgpanda.util import hash_checkout
 log = logging.getLogger(__name__)
 
 
+# The parameters of functions inspected so far. Setters and validate functions are mostly the same
+# functions for every generate(), so they are only inspected once.
+_function_parameters = weakref.WeakKeyDictionary()
+
+
 def get_function_parameters(function):
-    return set(inspect.signature(function).parameters)
+    try:
+        return set(_function_parameters[function])
+    except KeyError:
+        pass
+    except TypeError:
+        # Can't be weakly referenced, so can't be cached.
+        return set(inspect.signature(function).parameters)
+    parameters = frozenset(inspect.signature(function).parameters)
+    _function_parameters[function] = parameters
+    return set(parameters)
 
 
 def validate_arguments_strings(arguments: dict):
@@ -147,6 +163,9 @@ class Scope:
         assert isinstance(target, Target)
         self.cases[value] = target
 
+    def copy(self):
+        return Scope(self.name, {value: target.copy() for value, target in self.cases.items()})
+
     def __iadd__(self, other):
         # Note: can't use type being defined as parameter type
         assert isinstance(other, Scope), "Internal consistency error, expected Scope but got {}".format(type(other))
@@ -212,6 +231,17 @@ class Target:
         assert self._arguments is not None, "Must only be called after finalize()"
         return self._arguments
 
+    def copy(self):
+        """Return an unfinalized copy of this target and its sub scopes."""
+        return Target(set(self.variables), {name: scope.copy() for name, scope in self.sub_scopes.items()})
+
+    def reset(self):
+        """Undo finalize() of this target and all its sub scopes, so Resolver.update() can finalize them again."""
+        self._arguments = None
+        for scope in self.sub_scopes.values():
+            for sub_target in scope.cases.values():
+                sub_target.reset()
+
     def yield_validates(self):
         # Recursively walk the target / sub scope tree and yield a
         # validate function for each and every switch.
@@ -552,6 +582,13 @@ class Resolver:
         # Set of Resolvables() which are resolved, being resolved.
         self._arguments = ArgumentDict()
 
+        # The names of the arguments each argument was calculated from and, the other way around, the
+        # arguments calculated from each argument. Used by update() to only recalculate what changed.
+        self._dependencies = defaultdict(set)
+        self._dependents = defaultdict(set)
+        # Names of the arguments the targets asked for directly.
+        self._roots = set()
+
         self._contexts = list()
 
         self._validator = Validator(validate_fns, targets)
@@ -653,6 +690,12 @@ class Resolver:
         assert foo == name, "Internal consistency error: Unwinding stack seems to not be the order it was built in..."
 
     def _ensure_finalized(self, resolvable):
+        if self._eval_stack:
+            self._dependencies[self._eval_stack[-1]].add(resolvable.name)
+            self._dependents[resolvable.name].add(self._eval_stack[-1])
+        else:
+            self._roots.add(resolvable.name)
+
         if resolvable.is_finalized:
             return
 
@@ -755,6 +798,72 @@ class Resolver:
         for parameter_set, error in self._validator.yield_multi_argument_validate_errors(self._arguments):
             self._errors[parameter_set] = error
 
+    def _forget(self, name):
+        self._arguments.pop(name, None)
+        self._errors.pop(name, None)
+        self._unset.discard(name)
+        self._late.discard(name)
+        for dependency in self._dependencies.pop(name, set()):
+            self._dependents[dependency].discard(name)
+
+    def update(self, changes: dict):
+        """Change the user arguments given in changes, recalculating only the arguments which depend on them.
+
+        changes maps the name of each argument to change to its new value, or to None to remove it.
+        Afterwards the resolver is in the same state as a new one resolved with the changed user
+        arguments would be. Returns the names of the arguments which were (re)calculated or dropped.
+        """
+        assert self._resolved, "Only resolved Resolvers can be updated"
+        validate_arguments_strings({name: value for name, value in changes.items() if value is not None})
+
+        for name, value in changes.items():
+            setters = [setter for setter in self._setters.get(name, list()) if not setter.is_user]
+            if value is not None:
+                setters.append(Setter(name, value, False, [], True))
+            if setters:
+                self._setters[name] = setters
+            else:
+                self._setters.pop(name, None)
+
+        # Everything calculated from a changed argument must be calculated again.
+        invalid = set()
+        to_visit = list(changes)
+        while to_visit:
+            name = to_visit.pop()
+            if name not in invalid:
+                invalid.add(name)
+                to_visit.extend(self._dependents.get(name, set()))
+        for name in invalid:
+            self._forget(name)
+        unchanged = set(self._arguments)
+
+        self._roots = set()
+        for target in self._targets:
+            target.reset()
+            self._calculate_target(target)
+
+        # Drop arguments nothing needs anymore, e.g. those of a switch case which is no longer taken.
+        needed = set()
+        to_visit = list(self._roots)
+        while to_visit:
+            name = to_visit.pop()
+            if name not in needed:
+                needed.add(name)
+                to_visit.extend(self._dependencies.get(name, set()))
+        unneeded = set(self._arguments) - needed
+        for name in unneeded:
+            self._forget(name)
+
+        self._errors = {key: error for key, error in self._errors.items() if not isinstance(key, frozenset)}
+        for parameter_set, error in self._validator.yield_multi_argument_validate_errors(self._arguments):
+            self._errors[parameter_set] = error
+
+        changed = invalid | unneeded | (set(self._arguments) - unchanged)
+        validate_arguments_strings({
+            name: self._arguments[name].value for name in changed
+            if name in self._arguments and not self._arguments[name].is_error})
+        return changed
+
     @property
     def arguments(self):
         assert self._resolved, "Can't get arguments until they've been resolved"
@@ -804,31 +913,17 @@ class Resolver:
 
 def resolve_configuration(sources: List[Source], targets: List[Target]):
 
-    # Merge the sources into a big dictionary of setters + validators, ensuring
-    # that all setters are either strings or functions.
-    validate = list()
-    setters = dict()
-
-    # Merge all the config targets into one big group of setters for providing
-    # to the calculator
-    # TODO(cmaloney): The setter management / set code is very similar to that in ConfigTarget, they
-    # could probably be joined.
-    for source in sources:
-        for name, setter_list in source.setters.items():
-            setters.setdefault(name, list())
-            setters[name] += setter_list
-        validate += source.validate
-
     # Re-enable this after sorting out how to have "optional" config targets which
     # add in extra "acceptable" parameters (SSH Config, AWS Advanced Template config, etc)
     # validate_all_arguments_match_parameters(mandatory_parameters, setters, user_arguments)
     # TODO DCOS-14196: [gen.internals] disallow extra user provided arguments
 
-    user_config = Source(is_user=True)
-
-    # Merge all the seters and validate function into one uber list
-    setters = copy.deepcopy(user_config.setters)
-    validate = copy.deepcopy(user_config.validate)
+    # Merge all the setters and validate functions of the sources into one uber list. Setter lists
+    # are copied rather than extended in place, so Resolver.update() never changes a Source.
+    # TODO(cmaloney): The setter management / set code is very similar to that in ConfigTarget, they
+    # could probably be joined.
+    setters = dict()
+    validate = list()
     for source in sources:
         for name, setter_list in source.setters.items():
             # TODO(cmaloney): Make a setter manager already...
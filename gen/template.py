@@ -15,14 +15,32 @@
 #   switch <identifier>
 #   case <string>:
 #   endswith
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
 from typing import Optional, Tuple
 
 from pkg_resources import resource_string
 
 import gen.internals
 
+log = logging.getLogger(__name__)
+
 identifier_valid_characters = 'abcdefghijklmnopqrstuvwxyz_0123456789'
 
+# Parsed templates are cached by the hash of their text. If cache_dir is set
+# they are also stored there as pickles, to be reused by later processes.
+cache_dir = os.environ.get('DCOS_TEMPLATE_CACHE_DIR')
+cache_size = 256
+# Bump when the AST classes or the parser change, so that stale pickles aren't used.
+_cache_version = 1
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
 
 class SyntaxError(Exception):
 
@@ -307,68 +325,130 @@ class UnsetMarker:
     pass
 
 
+def _get_argument(arguments, name):
+    try:
+        return arguments[name]
+    except KeyError as ex:
+        raise UnsetParameter("Unset parameter {}".format(name), name) from ex
+
+
+def _get_case(identifier, cases, arguments):
+    choice = _get_argument(arguments, identifier)
+    if choice not in cases:
+        raise ValueError("switch %s: value `%s` is not in the set of handled cases" % (
+            identifier, choice))
+    return cases[choice]
+
+
+def _apply_filter(name, value, filters):
+    try:
+        filter_func = filters[name]
+    except KeyError:
+        raise UnsetParameter("Unset filter parameter {}".format(name), name)
+    return filter_func(value)
+
+
+def _iterate(new_var, iterable_name, arguments):
+    """Set arguments[new_var] to each value of the argument iterable_name in turn, yielding after each."""
+    # If the argument is a string, it should be a json list.
+    iterable = _get_argument(arguments, iterable_name)
+    # TODO(cmaloney): for should only be used (for now) in code which doesn't contain
+    # arbitrary user parameters.
+    # Stash the original state of the argument.
+    original_value = arguments.get(new_var, UnsetMarker())
+
+    assert isinstance(iterable, list)
+    for value in iterable:
+        arguments[new_var] = value
+        yield
+
+    # Reset the argument to the original state.
+    if isinstance(original_value, UnsetMarker):
+        arguments.pop(new_var, None)
+    else:
+        arguments[new_var] = original_value
+
+
+def _compile_switch(chunk):
+    cases = {value: _compile(case) for value, case in chunk.cases.items()}
+
+    def render_switch(arguments, filters):
+        return _get_case(chunk.identifier, cases, arguments)(arguments, filters)
+    return render_switch
+
+
+def _compile_replacement(chunk):
+    if chunk.filter is None:
+        def render_replacement(arguments, filters):
+            yield str(_get_argument(arguments, chunk.identifier))
+        return render_replacement
+
+    def render_filtered_replacement(arguments, filters):
+        yield str(_apply_filter(chunk.filter, _get_argument(arguments, chunk.identifier), filters))
+    return render_filtered_replacement
+
+
+def _compile_for(chunk):
+    body = _compile(chunk.body)
+
+    def render_for(arguments, filters):
+        for _ in _iterate(chunk.new_var, chunk.iterable, arguments):
+            yield from body(arguments, filters)
+    return render_for
+
+
+def _compile(ast):
+    """Compile ast into a function(arguments, filters) which renders it.
+
+    The function returns a generator of the pieces of the output, in order.
+    """
+    steps = []
+    for chunk in ast:
+        if isinstance(chunk, Switch):
+            steps.append(_compile_switch(chunk))
+        elif isinstance(chunk, Replacement):
+            steps.append(_compile_replacement(chunk))
+        elif isinstance(chunk, For):
+            steps.append(_compile_for(chunk))
+        elif isinstance(chunk, str):
+            steps.append(lambda arguments, filters, blob=(chunk,): blob)
+        else:
+            raise NotImplementedError(
+                "Unknown chunk type {}".format(type(chunk)))
+
+    def render(arguments, filters):
+        for step in steps:
+            yield from step(arguments, filters)
+    return render
+
+
 class Template:
 
     def __init__(self, ast: list):
         self.ast = ast
+        self.__render = None
 
-    def render(self, arguments: dict, filters: dict={}):
+    def _get_renderer(self):
+        # Compiled on first use, so that templates which are only inspected aren't compiled.
+        if self.__render is None:
+            self.__render = _compile(self.ast)
+        return self.__render
 
-        def get_argument(name):
-            try:
-                return arguments[name]
-            except KeyError as ex:
-                raise UnsetParameter("Unset parameter {}".format(name), name) from ex
-
-        def render_ast(ast):
-            rendered = ""
-            for chunk in ast:
-                if isinstance(chunk, Switch):
-                    choice = get_argument(chunk.identifier)
-                    if choice not in chunk.cases:
-                        raise ValueError("switch %s: value `%s` is not in the set of handled cases" % (
-                            chunk.identifier, choice))
-                    rendered += render_ast(chunk.cases[choice])
-                elif isinstance(chunk, Replacement):
-                    value = get_argument(chunk.identifier)
-                    if chunk.filter is None:
-                        rendered += str(value)
-                    else:
-                        try:
-                            filter_func = filters[chunk.filter]
-                        except KeyError:
-                            raise UnsetParameter("Unset filter parameter {}".format(chunk.filter), chunk.filter)
-                        rendered += str(filter_func(value))
-                elif isinstance(chunk, For):
-                    # If the argument is a string, it should be a json list.
-                    iterable = get_argument(chunk.iterable)
-                    # TODO(cmaloney): for should only be used (for now) in code which doesn't contain
-                    # arbitrary user parameters.
-                    # Stash the original state of the argument.
-                    original_value = UnsetMarker()
-                    if chunk.new_var in arguments:
-                        original_value = arguments[chunk.new_var]
-
-                    assert isinstance(iterable, list)
-                    for value in iterable:
-                        arguments[chunk.new_var] = value
-                        rendered += render_ast(chunk.body)
-
-                    # Reset the argument to the original state.
-                    if isinstance(original_value, UnsetMarker):
-                        del arguments[chunk.new_var]
-                    else:
-                        arguments[chunk.new_var] = original_value
+    def render(self, arguments: dict, filters: dict={}):
+        return ''.join(self.render_iter(arguments, filters))
 
-                elif isinstance(chunk, str):
-                    rendered += chunk
-                else:
-                    raise NotImplementedError(
-                        "Unknown chunk type {}".format(type(chunk)))
+    def render_to(self, fileobj, arguments: dict, filters: dict={}):
+        """Render the template, writing the output to fileobj piece by piece rather than building it in memory."""
+        for piece in self.render_iter(arguments, filters):
+            fileobj.write(piece)
 
-            return rendered
+    def render_iter(self, arguments: dict, filters: dict={}):
+        """Return a generator of the pieces of the rendered template, in order.
 
-        return render_ast(self.ast)
+        The template is rendered as the generator is consumed, so arguments
+        must not be changed until it is exhausted.
+        """
+        return self._get_renderer()(arguments, filters)
 
     def target_from_ast(self):
         def variables_from_ast(ast, blacklist):
@@ -492,14 +572,77 @@ def _parse_chunks(tokenizer):
             return chunks
 
 
-def parse_str(text):
+def _parse_ast(text):
     tokenizer = Tokenizer(text)
     ast = _parse_chunks(tokenizer)
     token_type, _ = tokenizer.peek()
     if token_type != "eof":
         raise ValueError(
             "Unexpected token of type {} at end of text, expecting EOF".format(token_type))
-    return Template(ast)
+    return ast
+
+
+def _load_cached_ast(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        log.warning("Ignoring unreadable template cache file %s: %s", path, ex)
+        return None
+
+
+def _store_cached_ast(path, ast):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(ast, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError as ex:
+        log.warning("Unable to write template cache file %s: %s", path, ex)
+
+
+def parse_str(text):
+    """Parse text into a Template.
+
+    Templates are cached by the hash of text, so parsing the same text again
+    returns the same Template, which must not be modified.
+    """
+    key = hashlib.sha256('{}\0{}'.format(_cache_version, text).encode()).hexdigest()
+    with _cache_lock:
+        template = _cache.get(key)
+        if template is not None:
+            _cache.move_to_end(key)
+            return template
+
+    ast = None
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, key + '.pickle')
+        ast = _load_cached_ast(path)
+    if ast is None:
+        ast = _parse_ast(text)
+        if path:
+            _store_cached_ast(path, ast)
+
+    template = Template(ast)
+    with _cache_lock:
+        _cache[key] = template
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return template
+
+
+def clear_cache():
+    """Clear the in-process cache of parsed templates."""
+    with _cache_lock:
+        _cache.clear()
 
 
 def parse_resources(filename):
@@ -6,6 +6,7 @@ import tempfile
 import pytest
 
 import gen
+import gen.template
 
 
 def file_mode(filename: str) -> str:
@@ -204,3 +205,18 @@ def test_validate_downstream_entry():
                 'bar': 'bar',
             },
         })
+
+
+def test_config_schema_cached():
+    assert gen.get_config_schema([]) is gen.get_config_schema([])
+    assert gen.get_config_schema([]) is not gen.get_config_schema(['aws/dcos-config.yaml'])
+
+    arguments = {'foo': 'bar'}
+    sources_1, targets_1, templates_1 = gen.get_dcosconfig_source_target_and_templates(arguments, [], [])
+    sources_2, targets_2, templates_2 = gen.get_dcosconfig_source_target_and_templates(arguments, [], [])
+    # The calculated source is shared, targets are new since resolving finalizes them.
+    assert sources_1[0] is sources_2[0]
+    assert sources_1[1] is not sources_2[1]
+    assert targets_1 == targets_2
+    assert not any(target_1 is target_2 for target_1 in targets_1 for target_2 in targets_2)
+    assert templates_1 == templates_2
@@ -2,6 +2,7 @@ from copy import deepcopy
 
 import pytest
 
+import gen
 import gen.internals
 from gen.exceptions import ValidationError
 from gen.internals import Scope, Source, Target
@@ -123,6 +124,88 @@ def test_resolve_late():
     # TODO(cmaloney): Test resolved from late variables
 
 
+def test_target_copy():
+    target = get_test_target()
+    target_copy = target.copy()
+    assert target_copy == target
+    target_copy.sub_scopes['d'].cases['d_1'].add_variable('e')
+    assert target_copy != target
+
+    # Copies can be resolved independently.
+    user_source = Source(is_user=True)
+    user_source.add_must('c', 'c_str')
+    user_source.add_must('d_1_a', 'd_1_a_str')
+    for target in [target.copy(), target.copy()]:
+        resolver = gen.internals.resolve_configuration([test_source, user_source], [target])
+        assert resolver.status_dict == {'status': 'ok'}
+
+
+def test_resolver_update():
+    calls = []
+
+    def calc_b(c):
+        calls.append('b')
+        return c + '_b'
+
+    def calc_e(a):
+        calls.append('e')
+        return a + '_e'
+
+    source = Source({
+        'default': {'a': 'a_str', 'd': 'd_1'},
+        'must': {'b': calc_b, 'e': calc_e},
+        'conditional': {'d': {
+            'd_1': {'must': {'d_1_b': 'd_1_b_str'}},
+            'd_2': {'must': {'d_2_b': 'd_2_b_str'}},
+        }},
+    })
+
+    def get_target():
+        target = get_test_target()
+        target.add_variable('e')
+        return target
+
+    def resolve(user_arguments):
+        resolver = gen.internals.resolve_configuration(
+            [source, gen.user_arguments_to_source(user_arguments)], [get_target()])
+        return resolver
+
+    def assert_same(resolver, user_arguments):
+        fresh = resolve(user_arguments)
+        assert resolver.status_dict == fresh.status_dict
+        assert ({name: arg.value for name, arg in resolver.arguments.items() if not arg.is_error} ==
+                {name: arg.value for name, arg in fresh.arguments.items() if not arg.is_error})
+        assert set(resolver.arguments) == set(fresh.arguments)
+
+    user_arguments = {'c': 'c_str', 'd_1_a': 'd_1_a_str'}
+    resolver = resolve(user_arguments)
+    assert resolver.status_dict == {'status': 'ok'}
+    assert resolver.arguments['b'].value == 'c_str_b'
+
+    # Only what depends on a changed argument is recalculated.
+    calls.clear()
+    assert resolver.update({'c': 'c_new'}) == {'b', 'c'}
+    assert calls == ['b']
+    assert resolver.arguments['b'].value == 'c_new_b'
+    assert_same(resolver, {'c': 'c_new', 'd_1_a': 'd_1_a_str'})
+
+    # Switching case drops the arguments of the old case.
+    changed = resolver.update({'d': 'd_2'})
+    assert {'d', 'd_1_a', 'd_1_b', 'd_2_a', 'd_2_b'} <= changed
+    assert resolver.status_dict == {'status': 'errors', 'errors': {}, 'unset': {'d_2_a'}}
+    assert_same(resolver, {'c': 'c_new', 'd_1_a': 'd_1_a_str', 'd': 'd_2'})
+
+    # Removing an argument.
+    calls.clear()
+    resolver.update({'d': None, 'c': None})
+    assert calls == []
+    assert resolver.status_dict == {'status': 'errors', 'errors': {}, 'unset': {'c'}}
+    assert_same(resolver, {'d_1_a': 'd_1_a_str'})
+
+    with pytest.raises(ValidationError):
+        resolver.update({'c': 1})
+
+
 def test_source_secrets():
     entry = {
         'default': {
@@ -1,3 +1,5 @@
+import io
+
 import pytest
 
 import gen.template
@@ -150,3 +152,61 @@ def test_render():
             "btcelsefoo")
     with pytest.raises(UnsetParameter):
         parse_str("{% for a in b %}{{ a }}{% endfor %}else{{ a }}").render({"b": ['b', 't', 'c']})
+
+
+def test_render_nested():
+    template = parse_str(
+        '{% for a in b %}{% switch c %}{% case "x" %}{{ a }},{% case "y" %}{{ a | up }};{% endswitch %}{% endfor %}')
+    arguments = {"b": ["p", "q"], "c": "y"}
+    assert template.render(arguments, {"up": str.upper}) == "P;Q;"
+    assert arguments == {"b": ["p", "q"], "c": "y"}
+    arguments["c"] = "x"
+    assert template.render(arguments) == "p,q,"
+    with pytest.raises(ValueError):
+        template.render({"b": ["p"], "c": "z"})
+
+
+def test_parse_cache(tmpdir, monkeypatch):
+    gen.template.clear_cache()
+    monkeypatch.setattr(gen.template, 'cache_dir', str(tmpdir))
+    template = parse_str("{{ a }}b")
+    assert parse_str("{{ a }}b") is template
+    assert len(tmpdir.listdir()) == 1
+
+    # The pickled AST is used by later processes.
+    gen.template.clear_cache()
+
+    def fail(text):
+        raise AssertionError("template was parsed again")
+    monkeypatch.setattr(gen.template, '_parse_ast', fail)
+    cached = parse_str("{{ a }}b")
+    assert cached is not template
+    assert cached == template
+    assert cached.render({"a": "x"}) == "xb"
+
+    # Corrupt cache files are ignored.
+    gen.template.clear_cache()
+    monkeypatch.undo()
+    monkeypatch.setattr(gen.template, 'cache_dir', str(tmpdir))
+    tmpdir.listdir()[0].write("garbage")
+    assert parse_str("{{ a }}b") == template
+
+
+def test_render_iter_and_render_to():
+    template = parse_str(
+        'a{% for x in xs %}{% switch x %}{% case "1" %}one{% case "2" %}{{ y | up }}{% endswitch %}{% endfor %}')
+    arguments = {"xs": ["1", "2", "1"], "y": "two"}
+    filters = {"up": str.upper}
+    expected = "aoneTWOone"
+    assert template.render(arguments, filters) == expected
+    assert "".join(template.render_iter(arguments, filters)) == expected
+    out = io.StringIO()
+    template.render_to(out, arguments, filters)
+    assert out.getvalue() == expected
+    assert arguments == {"xs": ["1", "2", "1"], "y": "two"}
+
+    # Errors are raised as the output is consumed.
+    pieces = parse_str("a{{ b }}").render_iter({})
+    assert next(pieces) == "a"
+    with pytest.raises(UnsetParameter):
+        next(pieces)
@@ -2,7 +2,7 @@ import logging
 import os
 import os.path
 
-from tempfile import TemporaryDirectory
+from tempfile import mkstemp, TemporaryDirectory
 
 from pkgpanda.util import make_tar
 
@@ -22,5 +22,16 @@ def make_pkgpanda_package(contents_dir, package_filename):
     if os.path.dirname(package_filename):
         os.makedirs(os.path.dirname(package_filename), exist_ok=True)
 
-    make_tar(package_filename, contents_dir)
+    # Make the tarball next to package_filename and move it into place so that generate runs in other
+    # processes rendering the same package never see (or write over) a partially written one.
+    fd, tmp_filename = mkstemp(prefix='.', suffix=os.path.basename(package_filename),
+                               dir=os.path.dirname(package_filename) or '.')
+    os.close(fd)
+    try:
+        make_tar(tmp_filename, contents_dir)
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, package_filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
     logging.info("Package filename: %s", package_filename)
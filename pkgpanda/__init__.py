@@ -9,25 +9,34 @@ Each package contains a pkginfo.json. That contains a list of requires as well a
 environment variables from the package.
 
 """
+import errno
 import json
 import logging
 import os
 import os.path
 import re
 import shutil
+import stat
+import tarfile
 import tempfile
+import threading
+import weakref
 from collections import Iterable
 from itertools import chain
 from typing import Union
 
+import requests
+
 from pkgpanda.constants import (DCOS_SERVICE_CONFIGURATION_FILE,
+                                install_root,
                                 RESERVED_UNIT_NAMES,
                                 STATE_DIR_ROOT)
-from pkgpanda.exceptions import (InstallError, PackageError, PackageNotFound,
+from pkgpanda.exceptions import (FetchError, InstallError, PackageError, PackageNotFound,
                                  ValidationError)
 from pkgpanda.subprocess import CalledProcessError, check_call, check_output
-from pkgpanda.util import (download, extract_tarball, if_exists, is_windows,
-                           load_json, make_directory, remove_directory, write_json, write_string)
+from pkgpanda.util import (chown_tree, download, extract_tar_stream, extract_tarball, if_exists, is_windows,
+                           load_json, load_string, make_directory, package_contents_digest, remove_directory, sha256,
+                           write_json, write_string)
 
 if not is_windows:
     import grp
@@ -53,6 +62,102 @@ version_regex = r"^[a-zA-Z0-9@_+:.]+$"
 username_regex = r"^dcos_[a-z0-9_]+$"
 linux_group_regex = r"^[a-z_][a-z0-9_-]*$"  # https://github.com/shadow-maint/shadow/blob/master/libmisc/chkname.c#L52
 
+# (connect, read) timeouts in seconds for fetching packages from peers. Peers
+# are only an optimization, so give up on slow ones quickly.
+peer_fetch_timeout = (5, 60)
+
+
+class SystemctlBackend:
+    """Runs systemd operations with systemctl.
+
+    Every operation covers all the units it is given with a single systemctl
+    call, so systemd queues the jobs together and runs them concurrently.
+    Starting a target thus costs three calls however many units it wants:
+    daemon-reload, which systemctl only runs on its own and which has to
+    finish before the new unit files can be enabled, the start itself, and
+    reading the start latencies once the start jobs are done.
+    """
+
+    def daemon_reload(self):
+        check_call(["systemctl", "daemon-reload"])
+
+    def stop(self, names, block):
+        cmd = ["systemctl", "stop"] + list(names)
+        if not block:
+            cmd.append("--no-block")
+        try:
+            check_call(cmd)
+        except CalledProcessError as ex:
+            # If the service doesn't exist, don't error. This happens when a
+            # bootstrap tarball has just been extracted but nothing started
+            # yet during first activation.
+            log.warning(ex)
+            if ex.returncode != 5:
+                raise
+
+    def enable_and_start(self, names, block):
+        # --no-reload as daemon_reload() is called separately before, so new
+        # unit files are picked up even if the units were already enabled.
+        cmd = ["systemctl", "enable", "--now", "--no-reload"] + list(names)
+        if not block:
+            cmd.append("--no-block")
+        check_call(cmd)
+
+    def get_start_latencies(self, names):
+        """Return {unit: seconds it took the unit to become active} for the active units in names."""
+        if not names:
+            return {}
+        output = check_output(
+            ["systemctl", "show",
+             "--property=Id,ActiveState,InactiveExitTimestampMonotonic,ActiveEnterTimestampMonotonic"] +
+            list(names)).decode()
+
+        latencies = {}
+        # One block of properties per unit, separated by an empty line.
+        for block in output.strip().split("\n\n"):
+            properties = dict(line.partition("=")[::2] for line in block.splitlines())
+            if properties.get("ActiveState") != "active":
+                continue
+            try:
+                started = int(properties["InactiveExitTimestampMonotonic"])
+                active = int(properties["ActiveEnterTimestampMonotonic"])
+            except (KeyError, ValueError):
+                continue
+            if started and active >= started:
+                latencies[properties["Id"]] = (active - started) / 10**6
+        return latencies
+
+
+class FakeSystemctlBackend:
+    """Records systemd operations instead of running them, for tests.
+
+    Starting a target also starts the units in wants_directory, the way
+    systemd starts the units a target wants. Units are started with the
+    latency given in latencies (0 by default).
+    """
+
+    def __init__(self, wants_directory, latencies=None):
+        self.calls = []
+        self.active = set()
+        self.wants_directory = wants_directory
+        self.latencies = latencies or {}
+
+    def daemon_reload(self):
+        self.calls.append(("daemon-reload",))
+
+    def stop(self, names, block):
+        self.calls.append(("stop",) + tuple(names))
+        self.active.difference_update(names)
+
+    def enable_and_start(self, names, block):
+        self.calls.append(("enable-and-start",) + tuple(names))
+        self.active.update(names)
+        if any(name.endswith(".target") for name in names):
+            self.active.update(if_exists(os.listdir, self.wants_directory) or [])
+
+    def get_start_latencies(self, names):
+        return {name: self.latencies.get(name, 0.0) for name in names if name in self.active}
+
 
 class Systemd:
     """Manages systemd units and unit files during installation.
@@ -61,40 +166,49 @@ class Systemd:
     base systemd dir to make sure they're available on the root volume, and thus readable when systemd starts. Symlinks
     in the unit.wants directory are rewritten to point to the copied unit files.
 
+    systemctl is run through backend, a SystemctlBackend unless given.
+
     """
 
     # Use "unit.new" to prevent removing unrelated ".new" directories if the install root is being used as the systemd
     # base dir.
     new_unit_suffix = ".unit.new"
 
-    def __init__(self, unit_directory, active, block):
+    def __init__(self, unit_directory, active, block, backend=None):
         self.__unit_directory = unit_directory
         self.__active = active
         self.__block = block
         self.__base_systemd = os.path.normpath(os.path.join(self.__unit_directory, ".."))
+        self.backend = backend or SystemctlBackend()
 
     def stop_all(self):
-        if not self.__active:
-            log.warning("Do not stop services")
-            return
         if not os.path.exists(self.__unit_directory):
             log.warning("Do not stop services. %s does not exist", self.__unit_directory)
             return
         names = list(filter(
             lambda n: os.path.isfile(os.path.join(self.__unit_directory, n)),
             os.listdir(self.__unit_directory)))
-        try:
-            cmd = ["systemctl", "stop"] + names
-            if not self.__block:
-                cmd.append("--no-block")
-            check_call(cmd)
-        except CalledProcessError as ex:
-            # If the service doesn't exist, don't error. This happens when a
-            # bootstrap tarball has just been extracted but nothing started
-            # yet during first activation.
-            log.warning(ex)
-            if ex.returncode != 5:
-                raise
+        self.stop(names)
+
+    def stop(self, names):
+        if not self.__active:
+            log.warning("Do not stop services")
+            return
+        if not names:
+            log.info("No services to stop")
+            return
+        self.backend.stop(names, self.__block)
+
+    def start_target(self, target, block):
+        """Reload the unit files, then enable and start target along with every unit it wants.
+
+        Returns {unit: seconds it took to become active} for the units in the unit directory if block, else {}.
+        """
+        self.backend.daemon_reload()
+        self.backend.enable_and_start([target], block)
+        if not block or not os.path.exists(self.__unit_directory):
+            return {}
+        return self.backend.get_start_latencies(sorted(self.unit_names(self.__unit_directory)))
 
     def remove_staged_unit_files(self):
         """Remove staged unit files created by Systemd.stage_new_units()."""
@@ -145,11 +259,10 @@ class Systemd:
             log.warning("Do not move new unit files. %s does not exist", self.__unit_directory)
             return
 
-        self.remove_unit_files()
-
+        # os.replace() swaps each unit file in with a single rename, replacing the old one if there is one.
         for unit_name in self.unit_names(self.__unit_directory):
             systemd_file_path = os.path.join(self.__base_systemd, unit_name)
-            shutil.move(systemd_file_path + self.new_unit_suffix, systemd_file_path)
+            os.replace(systemd_file_path + self.new_unit_suffix, systemd_file_path)
 
     @staticmethod
     def unit_names(unit_dir):
@@ -374,7 +487,12 @@ def validate_compatible(packages, roles):
 
 
 # TODO(cmaloney): Add a github fetcher, useful for grabbing config tarballs.
-def requests_fetcher(base_url, id_str, target, work_dir):
+def fetch_package_tarball(base_url, id_str, tmp_dir, work_dir):
+    """Return the path of a local copy of the tarball of package id_str.
+
+    Tarballs in file:// repositories are used in place, others are downloaded
+    into tmp_dir.
+    """
     assert base_url
     assert type(id_str) == str
     id = PackageId(id_str)
@@ -383,18 +501,126 @@ def requests_fetcher(base_url, id_str, target, work_dir):
     # all the logic can go away, we gain integrity checking, etc.
     base_url = base_url.rstrip('/')
     url = base_url + "/packages/{0}/{1}.tar.xz".format(id.name, id_str)
-    # TODO(cmaloney): Use a private tmp directory so there is no chance of a user
-    # intercepting the tarball + other validation data locally.
-    with tempfile.NamedTemporaryFile(suffix=".tar.xz") as file:
-        download(file.name, url, work_dir, rm_on_error=False)
-        extract_tarball(file.name, target)
+    # Local tarballs are extracted in place rather than copied first.
+    if url.startswith('file://'):
+        src_filename = url[len('file://'):]
+        if not os.path.isabs(src_filename):
+            src_filename = work_dir.rstrip('/') + '/' + src_filename
+        if not os.path.exists(src_filename):
+            raise FetchError(url, src_filename, FileNotFoundError(src_filename), False)
+        return src_filename
+    filename = os.path.join(tmp_dir, id_str + ".tar.xz")
+    download(filename, url, work_dir, rm_on_error=False)
+    return filename
+
+
+def requests_fetcher(base_url, id_str, target, work_dir):
+    # The temporary directory is only accessible by the current user, so the
+    # tarball can't be tampered with between download and extraction.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        extract_tarball(fetch_package_tarball(base_url, id_str, tmp_dir, work_dir), target)
+
+
+def package_contents_digest_path(id_str):
+    """Return the path of the contents digest of package id_str, relative to the root of a repository.
+
+    The digest (see pkgpanda.util.package_contents_digest) is published next
+    to the package tarball, so copies of the package from untrusted sources
+    can be checked against it.
+    """
+    id = PackageId(id_str)
+    return "packages/{0}/{1}.contents.sha256".format(id.name, id_str)
+
+
+def fetch_package_contents_digest(base_url, id_str, work_dir, timeout=peer_fetch_timeout):
+    """Return the contents digest of package id_str published in the repository at base_url.
+
+    Returns None if the repository has no digest for the package, e.g. if it
+    was made by an older release or the package wasn't built by pkgpanda.
+    Raises FetchError if the digest can't be fetched.
+    """
+    url = base_url.rstrip('/') + '/' + package_contents_digest_path(id_str)
+    if url.startswith('file://'):
+        filename = url[len('file://'):]
+        if not os.path.isabs(filename):
+            filename = work_dir.rstrip('/') + '/' + filename
+        return if_exists(load_string, filename)
+    try:
+        response = requests.get(url, timeout=timeout)
+        if response.status_code == requests.codes.not_found:
+            return None
+        response.raise_for_status()
+    except requests.RequestException as ex:
+        raise FetchError(url, None, ex, False) from ex
+    return response.text.strip()
+
+
+def peer_fetcher(peer_url, id_str, target, contents_digest, timeout=peer_fetch_timeout):
+    """Fetch package id_str from the pkgpanda HTTP API of a peer node.
+
+    Peers aren't trusted like the repository. The package is streamed into a
+    private temporary directory next to target, and only moved to target once
+    it matches contents_digest, the digest the repository publishes for it
+    (see fetch_package_contents_digest).
+    """
+    url = peer_url.rstrip('/') + "/repository/{}/tarball".format(id_str)
+    parent_dir = os.path.dirname(os.path.abspath(target))
+    make_directory(parent_dir)
+    tmp_dir = tempfile.mkdtemp(prefix='.peer-', dir=parent_dir)
+    try:
+        tmp_target = os.path.join(tmp_dir, id_str)
+        try:
+            with requests.get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                extract_tar_stream(response.raw, tmp_target)
+        except (requests.RequestException, OSError, tarfile.TarError) as ex:
+            raise FetchError(url, target, ex, False) from ex
+        digest = package_contents_digest(tmp_target)
+        if digest != contents_digest:
+            raise ValidationError("Package {} from {} has contents digest {} but the repository has {}".format(
+                id_str, peer_url, digest, contents_digest))
+        os.rename(tmp_target, target)
+    finally:
+        remove_directory(tmp_dir)
+
+
+def _stat_key(path):
+    """Return what changes about path when it is modified or replaced, or None if it doesn't exist.
+
+    The link count of a directory changes when subdirectories are added or
+    removed, which catches changes made within the same mtime tick.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_nlink, st.st_size
 
 
 class Repository:
 
-    def __init__(self, path):
+    # Content-addressed store of the files of packages, inside the repository.
+    # Not a valid package id, so never mistaken for a package.
+    objects_dir = '.objects'
+
+    def __init__(self, path, dedup=False):
+        """Repository of the packages in path.
+
+        If dedup is set, the files of added packages are hardlinked to
+        identical files of other packages through the object store, so each
+        is only stored once. Packages are immutable, so they can share files.
+        """
         self.__path = os.path.abspath(path)
         self.__packages = None
+        self.__packages_key = None
+        # {package name: {package id: PackageId}} of the packages in list().
+        self.__index = {}
+        self.__loaded = {}
+        self.__dedup = dedup
+        # Guards the caches above, the pkgpanda HTTP API uses a repository from several threads.
+        self.__lock = threading.RLock()
+        # {package id: lock} held while the package is added, so it's only fetched once.
+        self.__add_locks = weakref.WeakValueDictionary()
 
     @property
     def path(self):
@@ -403,31 +629,76 @@ class Repository:
     def package_path(self, id):
         return os.path.join(self.__path, id)
 
+    @property
+    def objects_path(self):
+        return os.path.join(self.__path, self.objects_dir)
+
     def get_ids(self, name):
-        # TODO(cmaloney): There is a lot of excess re-parsing here...
-        return list(pkg_id for pkg_id in self.list() if PackageId(pkg_id).name == name)
+        with self.__lock:
+            self.__refresh()
+            return list(self.__index.get(name, {}))
 
-    def has_package(self, id):
-        return id in self.list()
+    def get_package_ids(self, name):
+        """Return the parsed PackageIds of the packages called name."""
+        with self.__lock:
+            self.__refresh()
+            return list(self.__index.get(name, {}).values())
 
-    def list(self):
-        """List the available packages in the repository.
-
-        A package is a folder which contains a pkginfo.json"""
-        if self.__packages is not None:
+    def __index_add(self, id):
+        try:
+            pkg_id = PackageId(id)
+        except ValidationError:
+            log.warning("Ignoring invalid package id %s in %s", id, self.__path)
+            return
+        self.__index.setdefault(pkg_id.name, {})[id] = pkg_id
+
+    def __index_remove(self, id):
+        name = id.split('--')[0]
+        ids = self.__index.get(name, {})
+        ids.pop(id, None)
+        if not ids:
+            self.__index.pop(name, None)
+
+    def __refresh(self):
+        """Return the cached set of package ids, listing the repository again if it changed.
+
+        The listing is cached until the repository directory changes, so
+        packages added or removed by other processes are picked up. Must be
+        called with the lock held."""
+        key = _stat_key(self.__path)
+        if self.__packages is not None and key == self.__packages_key:
             return self.__packages
 
-        packages = set()
-        if not os.path.exists(self.__path):
-            return packages
+        if key is None:
+            self.__index = {}
+            return set()
 
+        packages = set()
+        self.__index = {}
         for id in os.listdir(self.__path):
             if PackageId.is_id(id):
                 packages.add(id)
+                self.__index_add(id)
         self.__packages = packages
+        self.__packages_key = key
         return self.__packages
 
+    def has_package(self, id):
+        with self.__lock:
+            return id in self.__refresh()
+
+    def list(self):
+        """List the available packages in the repository.
+
+        A package is a folder which contains a pkginfo.json
+
+        Returns a copy of the cached listing, so it doesn't change under
+        callers when packages are added or removed."""
+        with self.__lock:
+            return set(self.__refresh())
+
     # Load the given package
+    # Loaded packages are cached until their pkginfo.json changes.
     def load(self, id: str):
 
         # Validate the package id.
@@ -438,6 +709,11 @@ class Repository:
             raise PackageNotFound(id)
 
         filename = os.path.join(path, "pkginfo.json")
+        key = _stat_key(filename)
+        cached = self.__loaded.get(id)
+        if key is not None and cached is not None and cached[0] == key:
+            return cached[1]
+
         try:
             pkginfo = load_json(filename)
         except OSError as ex:
@@ -446,7 +722,9 @@ class Repository:
         if not isinstance(pkginfo, dict):
             raise PackageError("Usage should be a dictionary, not a {0}".format(type(pkginfo).__name__))
 
-        return Package(path, id, pkginfo)
+        package = Package(path, id, pkginfo)
+        self.__loaded[id] = (key, package)
+        return package
 
     def load_packages(self, ids: Iterable):
         packages = set()
@@ -466,30 +744,46 @@ class Repository:
         # Validate the package id.
         PackageId(id)
 
-        # If the package already exists, return true
-        package_path = self.package_path(id)
-        if os.path.exists(package_path):
-            if warn_added:
-                print("Package already added.")
-            return False
-
-        # TODO(cmaloney): Supply a temporary directory to extract to
-        # Then swap that into place, preventing partially-extracted things from
-        # becoming an issue.
-        pkg_path = self.package_path(id)
-        # Appending _tmp so there is very little chance of us running into the
-        # rm of another package, since all our PackageID strings are SHA-1, so
-        # they never end with `_tmp`. `{sha}_tmp` is still a valid version
-        # number however so other code doing directory scans will be fine with
-        # the temp folders.
-        tmp_path = pkg_path + '_tmp'
-
-        # Cleanup artifacts (if any) laying around from previous partial
-        # package extractions.
-        remove_directory(tmp_path)
-
-        fetcher(id, tmp_path)
-        shutil.move(tmp_path, pkg_path)
+        with self.__lock:
+            add_lock = self.__add_locks.setdefault(id, threading.Lock())
+
+        # Adds of the same package in this process wait for each other.
+        # Other processes may add it too, which the rename below copes with.
+        with add_lock:
+            # If the package already exists, return true
+            pkg_path = self.package_path(id)
+            if os.path.exists(pkg_path):
+                if warn_added:
+                    print("Package already added.")
+                return False
+
+            # The package is extracted in a directory of its own and renamed
+            # into place, so partially-extracted packages never show up. The
+            # directory name isn't a package id, so directory scans skip it.
+            os.makedirs(self.__path, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix='.add-', dir=self.__path)
+            try:
+                tmp_path = os.path.join(tmp_dir, id)
+                fetcher(id, tmp_path)
+                if self.__dedup:
+                    self._dedup(tmp_path)
+                try:
+                    os.rename(tmp_path, pkg_path)
+                except OSError as ex:
+                    # Another process added the package first.
+                    if ex.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+                    if warn_added:
+                        print("Package already added.")
+                    return False
+            finally:
+                remove_directory(tmp_dir)
+
+        with self.__lock:
+            if self.__packages is not None:
+                self.__packages.add(id)
+                self.__index_add(id)
+            self.__loaded.pop(id, None)
         return True
 
     def remove(self, id):
@@ -497,6 +791,73 @@ class Repository:
         if not os.path.exists(path):
             raise PackageNotFound(id)
         remove_directory(path)
+        with self.__lock:
+            if self.__packages is not None:
+                self.__packages.discard(id)
+                self.__index_remove(id)
+            self.__loaded.pop(id, None)
+
+    def _dedup(self, path):
+        """Replace the files in path by hardlinks to identical files in the object store.
+
+        Files not in the store yet are added to it. Hardlinks share their
+        permissions, owner and modification time, so files are identified by
+        their contents, permissions and owner. Python sources are identified
+        by their modification time too, as Python uses it to check whether
+        its bytecode cache is up to date.
+        """
+        for root_dir, _, files in os.walk(path):
+            for name in files:
+                file_path = os.path.join(root_dir, name)
+                st = os.lstat(file_path)
+                # Empty files take no space, so don't waste links on them.
+                if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+                    continue
+
+                key = "{}-{:o}-{}-{}".format(sha256(file_path), stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid)
+                if name.endswith('.py'):
+                    key += "-{}".format(st.st_mtime_ns)
+                object_path = os.path.join(self.objects_path, key[:2], key)
+                make_directory(os.path.dirname(object_path))
+
+                try:
+                    os.link(file_path, object_path)
+                    continue
+                except FileExistsError:
+                    pass
+
+                link_path = file_path + '.dedup_tmp'
+                try:
+                    os.link(object_path, link_path)
+                except OSError as ex:
+                    # E.g. the object has reached the maximum number of links, keep the copy.
+                    log.warning("Unable to link %s to %s: %s", file_path, object_path, ex)
+                    continue
+                os.replace(link_path, file_path)
+
+    def gc(self):
+        """Remove the objects no package uses anymore from the object store.
+
+        Returns the number of objects removed and the number of bytes freed.
+        """
+        removed, freed = 0, 0
+        if not os.path.isdir(self.objects_path):
+            return removed, freed
+
+        for fan_out in os.listdir(self.objects_path):
+            fan_out_path = os.path.join(self.objects_path, fan_out)
+            for name in os.listdir(fan_out_path):
+                object_path = os.path.join(fan_out_path, name)
+                st = os.lstat(object_path)
+                # The store's own link is the last one, so no package uses it.
+                if st.st_nlink == 1:
+                    os.remove(object_path)
+                    removed += 1
+                    freed += st.st_size
+            if not os.listdir(fan_out_path):
+                os.rmdir(fan_out_path)
+
+        return removed, freed
 
 
 class ConflictingFile(ValidationError):
@@ -538,6 +899,35 @@ def symlink_tree(src, dest):
                 raise ConflictingFile(src_path, dest_path, ex) from ex
 
 
+def copy_link_tree(src, dest, removed_paths):
+    """Copy the directories and symlinks of a tree made by symlink_tree.
+
+    Symlinks into any of removed_paths are left out, as are the directories
+    which only held such symlinks. Anything else (e.g. generated files) isn't
+    part of a link tree and isn't copied either.
+    """
+    removed_prefixes = tuple(os.path.join(path, '') for path in removed_paths)
+
+    def copy(src, dest):
+        has_entries = False
+        for entry in os.scandir(src):
+            dest_path = os.path.join(dest, entry.name)
+            if entry.is_symlink():
+                target = os.readlink(entry.path)
+                if not target.startswith(removed_prefixes):
+                    os.symlink(target, dest_path)
+                    has_entries = True
+            elif entry.is_dir():
+                os.mkdir(dest_path)
+                if copy(entry.path, dest_path) or not os.listdir(entry.path):
+                    has_entries = True
+                else:
+                    os.rmdir(dest_path)
+        return has_entries
+
+    copy(src, dest)
+
+
 # Manages a systemd-sysusers user set.
 # Can have users
 class UserManagement:
@@ -682,7 +1072,9 @@ class Install:
         manage_users=False,
         add_users=False,
         manage_state_dir=False,
-        state_dir_root=STATE_DIR_ROOT
+        state_dir_root=STATE_DIR_ROOT,
+        systemd_backend=None,
+        verify_state_dir_owners=False
     ):
 
         assert type(rooted_systemd) == bool
@@ -716,8 +1108,13 @@ class Install:
 
         assert not state_dir_root.endswith('/')
         self.__state_dir_root = state_dir_root
+        self.__verify_state_dir_owners = verify_state_dir_owners
 
-        self.systemd = Systemd(self._make_abs(self.__systemd_dir), self.__manage_systemd, self.__block_systemd)
+        self.__active = None
+        self.__active_key = None
+
+        self.systemd = Systemd(
+            self._make_abs(self.__systemd_dir), self.__manage_systemd, self.__block_systemd, systemd_backend)
 
     def _get_dcos_configuration_template(self):
         return {"sysctl": {}}
@@ -728,8 +1125,14 @@ class Install:
     def get_active(self):
         """the active folder has symlinks to all the active packages.
 
-        Return the full package ids (The targets of the symlinks)."""
+        Return the full package ids (The targets of the symlinks).
+
+        The ids are cached until the active folder changes. Activation swaps
+        in a whole new folder, so that is always noticed."""
         active_dir = self.get_active_dir()
+        key = _stat_key(active_dir)
+        if key is not None and key == self.__active_key:
+            return set(self.__active)
 
         if not os.path.exists(active_dir):
             if os.path.exists(active_dir + ".old") or os.path.exists(active_dir + ".new"):
@@ -748,6 +1151,8 @@ class Install:
             # cope if there is something invalid in the current active dir.
             ids.add(os.path.basename(package_path))
 
+        self.__active = frozenset(ids)
+        self.__active_key = key
         return ids
 
     def has_flag(self, name):
@@ -769,16 +1174,67 @@ class Install:
                 "active.buildinfo.full.json"
             ]))
 
+    def _get_incremental_base(self, packages):
+        """Return what activating packages can reuse from the active set, or None.
+
+        Returns the ids of the active packages which stay active, the paths of
+        the active packages which don't and the active buildinfo, or None if
+        the current install isn't complete enough to build on.
+        """
+        active_dir = self.get_active_dir()
+        link_dirs = [self._make_abs(name) for name in self.__well_known_dirs if name != self.__systemd_dir]
+        if os.path.exists(self._make_abs("install_progress")) or \
+                not all(os.path.isdir(name) for name in link_dirs + [active_dir]):
+            return None
+        try:
+            active_buildinfo_full = load_json(self._make_abs("active.buildinfo.full.json"))
+        except (OSError, ValueError):
+            return None
+
+        new_ids = {package.path: str(package.id) for package in packages}
+        kept_ids = set()
+        removed_paths = []
+        for name in os.listdir(active_dir):
+            package_path = os.readlink(os.path.join(active_dir, name))
+            if package_path in new_ids:
+                kept_ids.add(new_ids[package_path])
+            else:
+                removed_paths.append(package_path)
+        return kept_ids, removed_paths, active_buildinfo_full
+
     # Builds new working directories for the new active set, then swaps it into place as atomically as possible.
 
-    def activate(self, packages):
+    def activate(self, packages, incremental=True, dry_run=False):
+        """Make packages the active set.
+
+        With incremental, the link trees of the packages which are already
+        active are copied from the active install rather than rebuilt from
+        the packages, and only the packages being added are walked. The new
+        set is built in the `.new` directories and swapped into place the same
+        way in both cases, so recovering from a crash with install_progress
+        works the same.
+
+        Only the services which change (see plan_restarts) are stopped, the
+        others keep running through the swap. With dry_run, the new set is
+        built and thrown away again without touching the active one, and no
+        users or state directories are created. The systemd directory isn't
+        touched at all, the restart plan is worked out from the packages.
+
+        Returns the restart plan, or None if systemd units aren't managed.
+        """
         # Ensure the new set is reasonable.
         validate_compatible(packages, self.__roles)
 
+        base = self._get_incremental_base(packages) if incremental else None
+
         # Build the absolute paths for the running config, new config location,
         # and where to archive the config.
+        well_known_dirs = self.__well_known_dirs
         active_names = self.get_active_names()
-        active_dirs = list(map(self._make_abs, self.__well_known_dirs + ["active"]))
+        if dry_run and not self.__skip_systemd_dirs:
+            well_known_dirs = [name for name in well_known_dirs if name != self.__systemd_dir]
+            active_names.remove(self._make_abs(self.__systemd_dir))
+        active_dirs = list(map(self._make_abs, well_known_dirs + ["active"]))
 
         new_names = [name + ".new" for name in active_names]
         new_dirs = [name + ".new" for name in active_dirs]
@@ -794,13 +1250,25 @@ class Install:
                     os.remove(name)
 
         log.info("Remove unit files staged for an activation that didn't occur.")
-        if not self.__skip_systemd_dirs:
+        if not self.__skip_systemd_dirs and not dry_run:
             self.systemd.remove_staged_unit_files()
 
         log.debug("Make the directories for the new config: " + ", ".join(new_dirs))
         for name in new_dirs:
             os.makedirs(name)
 
+        kept_ids = set()
+        old_buildinfo_full = {}
+        if base is not None:
+            kept_ids, removed_paths, old_buildinfo_full = base
+            log.info("Activate incrementally, keeping %s active packages", len(kept_ids))
+            # Unit file links are rewritten to their copies in the systemd dir
+            # when staged, so they can't be traced back to a package and the
+            # systemd dir is always rebuilt.
+            for name in well_known_dirs:
+                if name != self.__systemd_dir:
+                    copy_link_tree(self._make_abs(name), self._make_abs(name + ".new"), removed_paths)
+
         def symlink_all(src, dest):
             if not os.path.isdir(src):
                 return
@@ -841,7 +1309,10 @@ class Install:
             # populated later.
             # Do the basename since some well known dirs are full paths (dcos.target.wants)
             # while inside the packages they are always top level directories.
-            for new, dir_name in zip(new_dirs, self.__well_known_dirs):
+            for new, dir_name in zip(new_dirs, well_known_dirs):
+                # The links of packages which stay active have been copied.
+                if str(package.id) in kept_ids and dir_name != self.__systemd_dir:
+                    continue
                 dir_name = os.path.basename(dir_name)
                 pkg_dir = os.path.join(package.path, dir_name)
 
@@ -881,7 +1352,10 @@ class Install:
 
             # Add to the buildinfo
             try:
-                active_buildinfo_full[package.name] = load_json(os.path.join(package.path, "buildinfo.full.json"))
+                if str(package.id) in kept_ids and package.name in old_buildinfo_full:
+                    active_buildinfo_full[package.name] = old_buildinfo_full[package.name]
+                else:
+                    active_buildinfo_full[package.name] = load_json(os.path.join(package.path, "buildinfo.full.json"))
             except FileNotFoundError:
                 # TODO(cmaloney): These only come from setup-packages. Should update
                 # setup-packages to add a buildinfo.full for those packages
@@ -891,18 +1365,27 @@ class Install:
             # same. Otherwise on upgrades we might remove access to a files by changing their chown
             # to something incompatible. We survive the first upgrade because everything goes from
             # root to specific users, and root can access all user files.
+            # A dry run mustn't change the host, so users and state directories are left alone.
             if package.username is not None:
-                sysusers.add_user(package.username, package.group)
+                if dry_run:
+                    UserManagement.validate_username(package.username)
+                else:
+                    sysusers.add_user(package.username, package.group)
 
             # Ensure the state directory exists
             # TODO(cmaloney): On upgrade take a snapshot?
-            if self.__manage_state_dir:
+            if self.__manage_state_dir and not dry_run:
                 state_dir_path = self.__state_dir_root + '/' + package.name
                 if package.state_directory:
                     make_directory(state_dir_path)
                     if package.username and not is_windows:
                         uid = sysusers.get_uid(package.username)
-                        check_call(['chown', '-R', str(uid), state_dir_path])
+                        # Skips state directories which already belong to the user unless verifying, as walking
+                        # large ones (e.g. mesos) dominates activation time.
+                        changed = chown_tree(state_dir_path, uid, verify=self.__verify_state_dir_owners)
+                        if changed:
+                            log.info("Changed the owner of %s entries in %s to %s", changed, state_dir_path,
+                                     package.username)
 
             if package.sysctl:
                 service_names = _get_service_names(package.path)
@@ -916,7 +1399,7 @@ class Install:
                         dcos_service_configuration["sysctl"][service] = package.sysctl[service]
 
         log.info("Prepare new systemd units for activation.")
-        if not self.__skip_systemd_dirs:
+        if not self.__skip_systemd_dirs and not dry_run:
             new_wants_dir = self._make_abs(self.__systemd_dir + ".new")
             if os.path.exists(new_wants_dir):
                 self.systemd.stage_new_units(new_wants_dir)
@@ -936,7 +1419,158 @@ class Install:
         new_buildinfo_meta = self._make_abs("active.buildinfo.full.json.new")
         write_json(new_buildinfo_meta, active_buildinfo_full)
 
-        self.swap_active(".new")
+        restart_plan = None
+        if not self.__skip_systemd_dirs:
+            restart_plan = self.plan_restarts(packages)
+
+        if dry_run:
+            log.info("Dry run, remove the new config.")
+            for name in new_names:
+                if os.path.isdir(name):
+                    remove_directory(name)
+                elif os.path.exists(name):
+                    os.remove(name)
+            return restart_plan
+
+        stop_units = None
+        if restart_plan is not None:
+            for unit, reason in sorted(restart_plan['restart'].items()):
+                log.info("Restart %s: %s", unit, reason)
+            stop_units = sorted(restart_plan['stop'] + list(restart_plan['restart']))
+        self.swap_active(".new", stop_units=stop_units)
+        return restart_plan
+
+    def _get_new_path(self, path):
+        """Return the (old, new) locations of path if it is part of the active set.
+
+        Unit files refer to the install root as /opt/mesosphere even if it is
+        somewhere else (e.g. --root), so both are recognized.
+        """
+        for prefix in {self.__root, install_root}:
+            if not path.startswith(prefix + '/'):
+                continue
+            first, _, rest = path[len(prefix) + 1:].partition('/')
+            if self._make_abs(first) not in self.get_active_names():
+                return None
+            return self._make_abs(os.path.join(first, rest)), self._make_abs(os.path.join(first + ".new", rest))
+        return None
+
+    def plan_restarts(self, packages):
+        """Work out which systemd units activating the new set in `.new` changes.
+
+        Must be called after the new etc and environment have been built in the
+        `.new` directories. The new unit files are read from the packages, so
+        the systemd directory doesn't need to have been staged.
+        Returns a dict with:
+            restart: {unit: reason} for the units which are in both sets but
+                whose unit file, environment files, sysctl settings, package or
+                any package it requires changed. Every unit is restarted when a
+                setup package changes, as the config it carries (e.g. files
+                other packages include) can't be traced to the units using it.
+            stop: units which are only in the active set.
+            start: units which are only in the new set.
+            keep: units which don't change and can keep running.
+        """
+        wants_dir = self._make_abs(self.__systemd_dir)
+        wants_name = os.path.basename(self.__systemd_dir)
+        base_systemd = os.path.dirname(wants_dir)
+
+        def units_of(package_path):
+            """Return {unit: unit file} for the units package_path provides."""
+            units = {}
+            for dir_name in [wants_name] + ["{}_{}".format(wants_name, role) for role in self.__roles]:
+                unit_dir = os.path.join(package_path, dir_name)
+                for unit in if_exists(os.listdir, unit_dir) or []:
+                    units[unit] = os.path.join(unit_dir, unit)
+            return units
+
+        old_ids = {}
+        old_providers = {}
+        active_dir = self.get_active_dir()
+        for name in if_exists(os.listdir, active_dir) or []:
+            package_path = os.readlink(os.path.join(active_dir, name))
+            old_ids[name] = os.path.basename(package_path)
+            for unit in units_of(package_path):
+                old_providers[unit] = name
+
+        packages_by_name = {package.name: package for package in packages}
+        new_providers = {}
+        new_unit_files = {}
+        for package in packages:
+            for unit, unit_file in units_of(package.path).items():
+                new_providers[unit] = package.name
+                new_unit_files[unit] = unit_file
+
+        def is_setup(pkg_id):
+            return pkg_id is not None and PackageId(pkg_id).version.startswith("setup_")
+
+        new_ids = {package.name: str(package.id) for package in packages}
+        changed_setup = sorted(
+            name for name in set(old_ids) | set(new_ids)
+            if old_ids.get(name) != new_ids.get(name) and (is_setup(old_ids.get(name)) or is_setup(new_ids.get(name))))
+
+        def changed_requirement(name):
+            """Return a package name requires (directly or not) whose id changes, if any."""
+            to_check = [name]
+            seen = set()
+            while to_check:
+                name = to_check.pop()
+                if name in seen or name not in packages_by_name:
+                    continue
+                seen.add(name)
+                if old_ids.get(name) != str(packages_by_name[name].id):
+                    return name
+                to_check += [expand_require(require)[0] for require in packages_by_name[name].requires]
+            return None
+
+        old_units = set(if_exists(os.listdir, wants_dir) or [])
+        new_units = set(new_unit_files)
+
+        def load_sysctl(path):
+            return (if_exists(load_json, path) or {}).get("sysctl", {})
+        service_configuration_path = os.path.join("etc", DCOS_SERVICE_CONFIGURATION_FILE)
+        old_sysctl = load_sysctl(self._make_abs(service_configuration_path))
+        new_sysctl = load_sysctl(self._make_abs(os.path.join("etc.new", service_configuration_path)))
+
+        restart = {}
+        for unit in sorted(old_units & new_units):
+            if changed_setup:
+                restart[unit] = "setup package {} changed".format(changed_setup[0])
+                continue
+
+            new_unit_contents = if_exists(load_string, new_unit_files[unit])
+            if if_exists(load_string, os.path.join(base_systemd, unit)) != new_unit_contents:
+                restart[unit] = "unit file changed"
+                continue
+
+            changed = changed_requirement(new_providers.get(unit))
+            if old_providers.get(unit) != new_providers.get(unit) or changed == new_providers.get(unit):
+                restart[unit] = "package {} changed".format(new_providers.get(unit))
+                continue
+            if changed is not None:
+                restart[unit] = "required package {} changed".format(changed)
+                continue
+
+            service = os.path.splitext(unit)[0]
+            if old_sysctl.get(service) != new_sysctl.get(service):
+                restart[unit] = "sysctl settings changed"
+                continue
+
+            for line in (new_unit_contents or '').splitlines():
+                key, _, value = line.strip().partition('=')
+                if key.strip() != "EnvironmentFile":
+                    continue
+                paths = self._get_new_path(value.strip().lstrip('-'))
+                if paths is not None and if_exists(load_string, paths[0]) != if_exists(load_string, paths[1]):
+                    restart[unit] = "environment file {} changed".format(value.strip().lstrip('-'))
+                    break
+
+        return {
+            'restart': restart,
+            'stop': sorted(old_units - new_units),
+            'start': sorted(new_units - old_units),
+            'keep': sorted((old_units & new_units) - set(restart)),
+        }
 
     def recover_swap_active(self):
         state_filename = self._make_abs("install_progress")
@@ -958,7 +1592,12 @@ class Install:
     # only part of the swap happens before a reboot.
     # TODO(cmaloney): Implement recovery properly.
 
-    def swap_active(self, extension, archive=True):
+    def swap_active(self, extension, archive=True, stop_units=None):
+        """Swap the active set for the one in the directories ending with extension.
+
+        stop_units are the systemd units to stop before the swap. All units
+        are stopped if it is None.
+        """
         active_names = self.get_active_names()
         state_filename = self._make_abs("install_progress")
 
@@ -983,9 +1622,12 @@ class Install:
             # TODO(cmaloney): stop all systemd services in dcos.target.wants
             record_state({"stage": "archive"})
 
-            log.info("Stop all systemd services and clean up existing unit files.")
+            log.info("Stop systemd services and clean up existing unit files.")
             if not self.__skip_systemd_dirs:
-                self.systemd.stop_all()
+                if stop_units is None:
+                    self.systemd.stop_all()
+                else:
+                    self.systemd.stop(stop_units)
                 self.systemd.remove_unit_files()
 
             log.info("Archive the current config.")
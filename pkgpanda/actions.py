@@ -2,11 +2,15 @@ import logging
 import os
 import sys
 import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from subprocess import CalledProcessError, check_call
 from typing import List
 
 from gen import do_gen_package, resolve_late_package
-from pkgpanda import PackageId, requests_fetcher
+from pkgpanda import (fetch_package_contents_digest, fetch_package_tarball, PackageId, peer_fetcher,
+                      requests_fetcher)
 from pkgpanda.constants import (DCOS_SERVICE_CONFIGURATION_PATH,
                                 install_root,
                                 SYSCTL_SETTING_KEY)
@@ -21,22 +25,39 @@ WantedBy=multi-user.target
 log = logging.getLogger(__name__)
 
 
-def activate_packages(install, repository, package_ids, systemd, block_systemd):
+def activate_packages(install, repository, package_ids, systemd, block_systemd, dry_run=False):
     """Replace the active package set with package_ids.
 
+    Only the systemd services which change are stopped and started again.
+
     install: pkgpanda.Install
     repository: pkgpanda.Repository
     package_ids: sequence of package IDs to activate
     systemd: start/stop systemd services
     block_systemd: if systemd, block waiting for systemd services to come up
+    dry_run: print which services would be restarted without activating anything
 
     """
-    install.activate(repository.load_packages(package_ids))
+    restart_plan = install.activate(repository.load_packages(package_ids), dry_run=dry_run)
+    if dry_run:
+        if restart_plan is None:
+            print("systemd units aren't managed by this install")
+        else:
+            print_restart_plan(restart_plan)
+        return
     if systemd:
-        _start_dcos_target(block_systemd)
+        _start_dcos_target(install, block_systemd)
+
+
+def print_restart_plan(restart_plan):
+    for unit, reason in sorted(restart_plan['restart'].items()):
+        print("restart {} ({})".format(unit, reason))
+    for action in ['stop', 'start', 'keep']:
+        for unit in restart_plan[action]:
+            print("{} {}".format(action, unit))
 
 
-def swap_active_package(install, repository, package_id, systemd, block_systemd):
+def swap_active_package(install, repository, package_id, systemd, block_systemd, dry_run=False):
     """Replace an active package with a package_id with the same name.
 
     swap(install, repository, 'foo--version') will replace the active 'foo'
@@ -47,6 +68,7 @@ def swap_active_package(install, repository, package_id, systemd, block_systemd)
     package_id: package ID to activate
     systemd: start/stop systemd services
     block_systemd: if systemd, block waiting for systemd services to come up
+    dry_run: print which services would be restarted without swapping anything
 
     """
     active = install.get_active()
@@ -64,7 +86,7 @@ def swap_active_package(install, repository, package_id, systemd, block_systemd)
     packages_by_name[new_id.name] = new_id
     new_active = list(map(str, packages_by_name.values()))
     # Activate with the new package name
-    activate_packages(install, repository, new_active, systemd, block_systemd)
+    activate_packages(install, repository, new_active, systemd, block_systemd, dry_run)
 
 
 def fetch_package(repository, repository_url, package_id, work_dir):
@@ -94,6 +116,131 @@ def fetch_package(repository, repository_url, package_id, work_dir):
         sys.stdout.flush()
 
 
+def get_peer_urls(install):
+    """Return the pkgpanda HTTP API urls of the nodes to fetch packages from before the repository."""
+    return (if_exists(load_string, install.get_config_filename("setup-flags/peer-urls")) or '').split()
+
+
+def get_dedup(install):
+    """Return whether to store the files identical across packages once (see Repository), off by default."""
+    return install.has_flag("setup-flags/dedup-packages")
+
+
+def _get_contents_digest(repository_url, package_id, work_dir):
+    try:
+        contents_digest = fetch_package_contents_digest(repository_url, package_id, work_dir)
+    except FetchError as ex:
+        print("Unable to fetch the contents digest of package {}: {}".format(package_id, ex))
+        return None
+    if contents_digest is None:
+        print("No contents digest for package {} in the repository, not fetching it from peers".format(package_id))
+    return contents_digest
+
+
+def download_package(repository, repository_url, package_id, download_dir, work_dir, peer_urls=()):
+    """Fetch package_id from a peer, or else download its tarball from repository_url.
+
+    A package from a peer is added to repository right away and None is
+    returned. Otherwise the path of the downloaded tarball is returned, which
+    is in download_dir unless repository_url is a local file URL. The caller
+    adds it to repository (see fetch_packages).
+
+    repository: pkgpanda.Repository
+    repository_url: URL for remote package repository
+    package_id: package ID to fetch
+    download_dir: directory to download the tarball to
+    work_dir: location for temporary files, used only if repository_url is a file URL with a relative path
+    peer_urls: pkgpanda HTTP API URLs of nodes to try before repository_url, only used if the
+        repository has a contents digest for the package
+
+    """
+    start = time.monotonic()
+    contents_digest = _get_contents_digest(repository_url, package_id, work_dir) if peer_urls else None
+    for peer_url in peer_urls if contents_digest else ():
+        try:
+            repository.add(
+                lambda _, target: peer_fetcher(peer_url, package_id, target, contents_digest),
+                package_id,
+                warn_added=False)
+        except (FetchError, ValidationError) as ex:
+            print("Unable to fetch package {} from peer: {}".format(package_id, ex))
+        else:
+            print("Fetched {} from peer {} in {:.1f}s".format(package_id, peer_url, time.monotonic() - start))
+            return None
+    return fetch_package_tarball(repository_url, package_id, download_dir, work_dir)
+
+
+def fetch_packages(repository, repository_url, package_ids, work_dir, jobs=4, peer_urls=()):
+    """Fetch the packages in package_ids which aren't in repository yet.
+
+    Up to `jobs` packages are downloaded at once. Each downloaded tarball is
+    handed to a separate pool of `jobs` threads for extraction, so extracting
+    one package overlaps with downloading the next ones. Packages are added to
+    the repository atomically by Repository.add, so a failed fetch never
+    leaves a partial package behind.
+
+    If peer_urls are given, every package which has a contents digest in the
+    repository is first tried from the pkgpanda HTTP API of each peer in turn
+    (see pkgpanda.peer_fetcher), and only downloaded from repository_url if
+    none of them has a copy matching the digest.
+
+    repository: pkgpanda.Repository
+    repository_url: URL for remote package repository, may be None if all
+        packages are expected to be local
+    package_ids: package IDs to fetch
+    work_dir: location for temporary files, used only if repository_url is a file URL with a relative path
+    jobs: number of packages to download and to extract at once
+    peer_urls: pkgpanda HTTP API URLs of nodes to try before repository_url
+
+    """
+    missing = [pkg_id for pkg_id in OrderedDict.fromkeys(package_ids) if not repository.has_package(pkg_id)]
+    if not missing:
+        return
+    if repository_url is None:
+        raise ValidationError("ERROR: Non-local package {} but no repository url given.".format(missing[0]))
+
+    start = time.monotonic()
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            ThreadPoolExecutor(max_workers=jobs) as download_executor, \
+            ThreadPoolExecutor(max_workers=jobs) as extract_executor:
+
+        def extract(pkg_id, tarball, download_time):
+            extract_start = time.monotonic()
+            repository.add(lambda _, target: extract_tarball(tarball, target), pkg_id, warn_added=False)
+            if tarball.startswith(tmp_dir):
+                os.remove(tarball)
+            print("Fetched {} (download {:.1f}s, extract {:.1f}s)".format(
+                pkg_id, download_time, time.monotonic() - extract_start))
+
+        def download(pkg_id):
+            download_start = time.monotonic()
+            tarball = download_package(repository, repository_url, pkg_id, tmp_dir, work_dir, peer_urls)
+            if tarball is None:
+                return None
+            return extract_executor.submit(extract, pkg_id, tarball, time.monotonic() - download_start)
+
+        downloads = [(pkg_id, download_executor.submit(download, pkg_id)) for pkg_id in missing]
+        error = None
+        for pkg_id, future in downloads:
+            try:
+                extract_future = future.result()
+                if extract_future is not None:
+                    extract_future.result()
+            except CancelledError:
+                pass
+            except Exception as ex:
+                print("Unable to fetch package {}: {}".format(pkg_id, ex))
+                if error is None:
+                    error = ex
+                    # Don't start fetching anything else, the packages can't be activated anyway.
+                    for _, pending in downloads:
+                        pending.cancel()
+        if error is not None:
+            raise error
+
+    print("Fetched {} packages in {:.1f}s".format(len(missing), time.monotonic() - start))
+
+
 def add_package_file(repository, package_filename):
     """Add a package to the repository from a file.
 
@@ -151,11 +298,12 @@ def remove_package(install, repository, package_id):
         sys.stdout.flush()
 
 
-def setup(install, repository):
+def setup(install, repository, fetch_jobs=4):
     """Set up a fresh install of DC/OS.
 
     install: pkgpanda.Install
     repository: pkgpanda.Repository
+    fetch_jobs: number of packages to fetch at once
 
     """
     # Check for /opt/mesosphere/bootstrap. If not exists, download everything
@@ -171,11 +319,11 @@ def setup(install, repository):
 
         write_string(os.path.join(dcos_target_dir, "dcos.target"),
                      DCOS_TARGET_CONTENTS)
-        _do_bootstrap(install, repository)
+        _do_bootstrap(install, repository, fetch_jobs)
         # Enable dcos.target only after we have populated it to prevent starting
         # up stuff inside of it before we activate the new set of packages.
         if install.manage_systemd:
-            _start_dcos_target(block_systemd=True)
+            _start_dcos_target(install, block_systemd=True)
         os.remove(bootstrap_path)
 
     # Check for /opt/mesosphere/install_progress. If found, recover the partial
@@ -186,11 +334,10 @@ def setup(install, repository):
             print("No recovery performed: {}".format(msg))
 
 
-def _start_dcos_target(block_systemd):
-    no_block = [] if block_systemd else ["--no-block"]
-    check_call(["systemctl", "daemon-reload"])
-    check_call(["systemctl", "enable", "dcos.target", '--no-reload'])
-    check_call(["systemctl", "start", "dcos.target"] + no_block)
+def _start_dcos_target(install, block_systemd):
+    latencies = install.systemd.start_target("dcos.target", block_systemd)
+    for unit, latency in sorted(latencies.items(), key=lambda item: (-item[1], item[0])):
+        print("Started {} in {:.1f}s".format(unit, latency))
 
 
 def _get_package_list(package_list_id: str, repository_url: str) -> List[str]:
@@ -207,15 +354,12 @@ def _get_package_list(package_list_id: str, repository_url: str) -> List[str]:
     return package_list
 
 
-def _do_bootstrap(install, repository):
+def _do_bootstrap(install, repository, fetch_jobs):
     # These files should be set by the environment which initially builds
     # the host (cloud-init).
     repository_url = if_exists(load_string, install.get_config_filename("setup-flags/repository-url"))
-
-    def fetcher(id, target):
-        if repository_url is None:
-            raise ValidationError("ERROR: Non-local package {} but no repository url given.".format(id))
-        return requests_fetcher(repository_url, id, target, os.getcwd())
+    # Optional pkgpanda HTTP API urls of other nodes to fetch packages from before repository_url.
+    peer_urls = get_peer_urls(install)
 
     setup_pkg_dir = install.get_config_filename("setup-packages")
     if os.path.exists(setup_pkg_dir):
@@ -270,8 +414,7 @@ def _do_bootstrap(install, repository):
 
         # Ensure all packages are local
         print("Ensuring all packages in active set {} are local".format(",".join(to_activate)))
-        for package in to_activate:
-            repository.add(fetcher, package)
+        fetch_packages(repository, repository_url, to_activate, os.getcwd(), fetch_jobs, peer_urls)
     else:
         print("Calculated active packages from bootstrap tarball")
         to_activate = list(install.get_active())
@@ -286,14 +429,13 @@ def _do_bootstrap(install, repository):
 
             for package_id_str in cluster_packages:
                 # Validate the package ids
-                pkg_id = PackageId(package_id_str)
+                PackageId(package_id_str)
 
-                # Fetch the packages if not local
-                if not repository.has_package(package_id_str):
-                    repository.add(fetcher, package_id_str)
+            # Fetch the packages if not local
+            fetch_packages(repository, repository_url, cluster_packages, os.getcwd(), fetch_jobs, peer_urls)
 
-                # Add the package to the set to activate
-                setup_packages_to_activate.append(package_id_str)
+            # Add the packages to the set to activate
+            setup_packages_to_activate += cluster_packages
         else:
             print("No cluster-packages specified")
 
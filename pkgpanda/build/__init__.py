@@ -1,3 +1,5 @@
+import collections
+import concurrent.futures
 import copy
 import json
 import multiprocessing
@@ -6,20 +8,23 @@ import random
 import shutil
 import string
 import tempfile
+import threading
+import time
 from contextlib import contextmanager
-from os import chdir, getcwd, mkdir
+from os import mkdir
 from os.path import exists
 
+import requests
+
 import pkgpanda.build.constants
 import pkgpanda.build.src_fetchers
 from pkgpanda import expand_require as expand_require_exceptions
-from pkgpanda import Install, PackageId, Repository
-from pkgpanda.actions import add_package_file
+from pkgpanda import Install, package_contents_digest_path, PackageId, Repository
 from pkgpanda.constants import install_root, PKG_DIR, RESERVED_UNIT_NAMES
 from pkgpanda.exceptions import FetchError, PackageError, ValidationError
 from pkgpanda.subprocess import CalledProcessError, check_call, check_output
-from pkgpanda.util import (check_forbidden_services, download_atomic,
-                           hash_checkout, is_windows, load_json, load_string, logger,
+from pkgpanda.util import (check_forbidden_services, download_atomic, extract_tarball,
+                           hash_checkout, if_exists, is_windows, load_json, load_string, logger,
                            make_directory, make_file, make_tar, remove_directory, rewrite_symlinks, write_json,
                            write_string)
 
@@ -255,6 +260,8 @@ class PackageStore:
         self._builders = {}
         self._repository_url = repository_url.rstrip('/') if repository_url is not None else None
         self._packages_dir = packages_dir.rstrip('/')
+        self._docker_ids = {}
+        self._docker_ids_lock = threading.Lock()
 
         # Load all possible packages, making a dictionary from (name, variant) -> buildinfo
         self._packages = dict()
@@ -264,6 +271,7 @@ class PackageStore:
         # Load an upstream if one exists
         # TODO(cmaloney): Allow upstreams to have upstreams
         self._package_cache_dir = self._packages_dir + "/cache/packages"
+        self._file_hash_cache = FileHashCache(self._packages_dir + "/cache/file_hashes.json")
         self._upstream_dir = self._packages_dir + "/cache/upstream/checkout"
         self._upstream = None
         self._upstream_package_dir = self._upstream_dir + "/packages"
@@ -331,6 +339,9 @@ class PackageStore:
     def get_complete_cache_dir(self):
         return self._packages_dir + "/cache/complete"
 
+    def get_dependency_cache_dir(self):
+        return self._packages_dir + "/cache/dependencies"
+
     def get_buildinfo(self, name, variant):
         return self._packages[(name, variant)]
 
@@ -360,6 +371,19 @@ class PackageStore:
     def get_package_path(self, pkg_id):
         return self.get_package_cache_folder(pkg_id.name) + '/{}.tar.xz'.format(pkg_id)
 
+    def get_contents_digest_path(self, pkg_id):
+        return self._packages_dir + '/cache/' + package_contents_digest_path(str(pkg_id))
+
+    def write_contents_digest(self, pkg_id):
+        """Write the contents digest of the built package pkg_id next to its tarball, if it isn't there yet.
+
+        It is published with the package so that nodes can check copies of
+        the package they fetch from their peers.
+        """
+        digest_path = self.get_contents_digest_path(pkg_id)
+        if not exists(digest_path):
+            write_string(digest_path, pkgpanda.util.tarball_contents_digest(self.get_package_path(pkg_id)))
+
     def get_package_cache_folder(self, name):
         directory = self._package_cache_dir + '/' + name
         make_directory(directory)
@@ -390,13 +414,55 @@ class PackageStore:
     def packages_dir(self):
         return self._packages_dir
 
+    @property
+    def file_hash_cache(self):
+        return self._file_hash_cache
+
+    def get_docker_id(self, docker_name):
+        """Return the id of the docker image docker_name, pulling it if necessary.
+
+        Ids are looked up once per PackageStore, so all builds of a run use
+        the same image.
+        """
+        with self._docker_ids_lock:
+            if docker_name not in self._docker_ids:
+                self._docker_ids[docker_name] = get_or_pull_docker_id(docker_name)
+            return self._docker_ids[docker_name]
+
+    def get_remote_package_url(self, pkg_id: PackageId):
+        assert self._repository_url is not None
+        return self._repository_url + '/packages/{0}/{1}.tar.xz'.format(pkg_id.name, pkg_id)
+
+    @staticmethod
+    def _remote_exists(url, work_dir):
+        if url.startswith('file://'):
+            # Relative file:// urls are resolved against work_dir, the same as download() does.
+            path = url[len('file://'):]
+            if not os.path.isabs(path):
+                path = work_dir + '/' + path
+            return os.path.exists(path)
+
+        try:
+            response = pkgpanda.util.get_requests_retry_session().head(url, allow_redirects=True)
+        except requests.exceptions.RequestException as ex:
+            print("WARNING: Unable to check for {}: {}".format(url, ex))
+            return False
+        return response.status_code == 200
+
+    def has_remote_package(self, pkg_id: PackageId):
+        """Return whether the package is available from the repository url, without downloading it."""
+        if self._repository_url is None:
+            return False
+
+        return self._remote_exists(self.get_remote_package_url(pkg_id), self.get_package_cache_folder(pkg_id.name))
+
     def try_fetch_by_id(self, pkg_id: PackageId):
         if self._repository_url is None:
             return False
 
         # TODO(cmaloney): Use storage providers to download instead of open coding.
         pkg_path = "{}.tar.xz".format(pkg_id)
-        url = self._repository_url + '/packages/{0}/{1}'.format(pkg_id.name, pkg_path)
+        url = self.get_remote_package_url(pkg_id)
         try:
             directory = self.get_package_cache_folder(pkg_id.name)
             # TODO(cmaloney): Move to some sort of logging mechanism?
@@ -407,6 +473,72 @@ class PackageStore:
         except FetchError:
             return False
 
+    def has_remote_bootstrap(self, bootstrap_id):
+        """Return whether the bootstrap tarball is available from the repository url, without downloading it."""
+        if self._repository_url is None:
+            return False
+
+        url = self._repository_url + '/bootstrap/{}.bootstrap.tar.xz'.format(bootstrap_id)
+        return self._remote_exists(url, self._packages_dir)
+
+    def prefetch(self, pkg_ids, bootstrap_ids, jobs=8):
+        """Download packages and bootstrap tarballs from the repository url into the local cache.
+
+        Up to jobs downloads run at once, sharing one pool of keep-alive
+        connections. Partial downloads left by an earlier failed prefetch are
+        resumed. The active.json of every bootstrap tarball is verified to
+        contain the packages its bootstrap id was computed from.
+
+        Returns the list of things which failed to download, each of which is
+        logged. Those are downloaded (or built) later as usual.
+        """
+        if self._repository_url is None:
+            return []
+
+        session = pkgpanda.util.get_requests_retry_session(pool_maxsize=jobs)
+
+        def fetch(url, out_filename, work_dir):
+            if os.path.exists(out_filename):
+                return
+            make_directory(os.path.dirname(out_filename))
+            if url.startswith('file://'):
+                download_atomic(out_filename, url, work_dir)
+            else:
+                pkgpanda.util.download_resumable(out_filename, url, session)
+
+        def fetch_package(pkg_id):
+            fetch(self.get_remote_package_url(pkg_id), self.get_package_path(pkg_id),
+                  self.get_package_cache_folder(pkg_id.name))
+
+        def fetch_bootstrap(bootstrap_id):
+            dest_dir = self.get_bootstrap_cache_dir()
+            active_name = dest_dir + '/{}.active.json'.format(bootstrap_id)
+            fetch(self._repository_url + '/bootstrap/{}.active.json'.format(bootstrap_id), active_name,
+                  self._packages_dir)
+            if hash_checkout(load_json(active_name)) != bootstrap_id:
+                os.remove(active_name)
+                raise BuildError("Downloaded {} doesn't match the bootstrap id".format(active_name))
+            fetch(self._repository_url + '/bootstrap/{}.bootstrap.tar.xz'.format(bootstrap_id),
+                  dest_dir + '/{}.bootstrap.tar.xz'.format(bootstrap_id), self._packages_dir)
+
+        work = [(fetch_package, PackageId(str(pkg_id))) for pkg_id in sorted(map(str, pkg_ids))]
+        work += [(fetch_bootstrap, bootstrap_id) for bootstrap_id in sorted(bootstrap_ids)]
+
+        failed = []
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(fn, item): item for fn, item in work}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except (FetchError, BuildError, ValueError, OSError) as ex:
+                    print("WARNING: Unable to prefetch {}: {}".format(futures[future], ex))
+                    failed.append(futures[future])
+
+        print("Prefetched {} of {} packages and bootstrap tarballs in {:.1f}s".format(
+            len(work) - len(failed), len(work), time.monotonic() - start))
+        return failed
+
     def try_fetch_bootstrap_and_active(self, bootstrap_id):
         if self._repository_url is None:
             return False
@@ -439,7 +571,94 @@ def get_docker_id(docker_name):
     return check_output(["docker", "inspect", "-f", "{{ .Id }}", docker_name]).decode('utf-8').strip()
 
 
-def hash_files_in_folder(directory):
+class FileHashCache:
+    """Persistent cache of the sha1 of files, used to avoid re-hashing unchanged files.
+
+    Digests are stored in a JSON file keyed by absolute path, alongside the
+    size, mtime_ns and inode of the file when it was hashed. A cached digest is
+    only used if all of those still match. Files which were modified very
+    recently aren't cached, since a second modification within the timestamp
+    granularity of the filesystem wouldn't change their mtime.
+
+    Files which aren't in the cache are hashed on a thread pool. New digests
+    are only written back to the JSON file by save(), which the build
+    functions call once they are done.
+    """
+
+    # Don't cache the hash of files modified less than this many nanoseconds before they were hashed.
+    racy_window_ns = 2 * 10**9
+
+    def __init__(self, filename, max_workers=None):
+        self._filename = filename
+        self._max_workers = max_workers or min(32, multiprocessing.cpu_count() * 2)
+        self._lock = threading.Lock()
+        self._entries = dict()
+        self._dirty = False
+        if os.path.exists(filename):
+            try:
+                entries = load_json(filename)
+            except ValueError as ex:
+                print("WARNING: Ignoring corrupt file hash cache {}: {}".format(filename, ex))
+            else:
+                # Drop entries for files which no longer exist so the cache doesn't grow forever.
+                self._entries = {path: entry for path, entry in entries.items() if os.path.exists(path)}
+                self._dirty = len(self._entries) != len(entries)
+
+    @staticmethod
+    def _stat_key(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def sha1_files(self, paths):
+        """Return a dictionary from each path in paths to the sha1 of the file."""
+        hashes = dict()
+        misses = dict()
+        with self._lock:
+            for path in paths:
+                abs_path = os.path.abspath(path)
+                key = self._stat_key(abs_path)
+                entry = self._entries.get(abs_path)
+                if entry is not None and entry[:3] == key:
+                    hashes[path] = entry[3]
+                else:
+                    misses[path] = (abs_path, key)
+
+        if not misses:
+            return hashes
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            digests = dict(zip(misses, executor.map(pkgpanda.util.sha1, misses)))
+
+        now = int(time.time() * 10**9)
+        with self._lock:
+            for path, (abs_path, key) in misses.items():
+                hashes[path] = digests[path]
+                if now - key[1] >= self.racy_window_ns:
+                    self._entries[abs_path] = key + [digests[path]]
+                    self._dirty = True
+
+        return hashes
+
+    def save(self):
+        """Write the cache to disk if it changed since it was loaded or last saved."""
+        with self._lock:
+            if not self._dirty:
+                return
+            make_directory(os.path.dirname(self._filename))
+            write_json(self._filename, self._entries)
+            self._dirty = False
+
+
+@contextmanager
+def _saving_file_hash_cache(package_store):
+    """Save the file hash cache of package_store once the builds in the context are done."""
+    try:
+        yield
+    finally:
+        package_store.file_hash_cache.save()
+
+
+def hash_files_in_folder(directory, file_hash_cache=None):
     """Given a relative path, hashes all files inside that folder and subfolders
 
     Returns a dictionary from filename to the hash of that file. If that whole
@@ -447,20 +666,30 @@ def hash_files_in_folder(directory):
 
     This is split out from calculating the whole folder hash so that the
     behavior in different walking corner cases can be more easily tested.
+
+    If file_hash_cache (a FileHashCache) is given, it is used to look up and
+    store the hashes of the files.
     """
     assert not directory.startswith('/'), \
         "For the hash to be reproducible on other machines relative paths must always be used. " \
         "Got path: {}".format(directory)
+    return _hash_files_in_folder(directory, file_hash_cache)
+
+
+def _hash_files_in_folder(directory, file_hash_cache=None):
+    # The keys of the resulting dictionary are always relative to directory, so walking an absolute
+    # path gives the same result as walking the equivalent relative one. That lets callers hash a
+    # folder without changing the (process wide) working directory.
     directory = directory.rstrip('/')
     file_hash_dict = {}
+    file_paths = {}
     # TODO(cmaloney): Disallow symlinks as they're hard to hash, people can symlink / copy in their
     # build steps if needed.
     for root, dirs, filenames in os.walk(directory):
-        assert not root.startswith('/')
         for name in filenames:
             path = root + '/' + name
             base = path[len(directory) + 1:]
-            file_hash_dict[base] = pkgpanda.util.sha1(path)
+            file_paths[base] = path
 
         # If the directory has files inside of it, then it'll be picked up implicitly. by the files
         # or folders inside of it. If it contains nothing, it wouldn't be picked up but the existence
@@ -472,27 +701,28 @@ def hash_files_in_folder(directory):
             if path:
                 file_hash_dict[root[len(directory) + 1:]] = ""
 
-    return file_hash_dict
-
+    if file_hash_cache is None:
+        for base, path in file_paths.items():
+            file_hash_dict[base] = pkgpanda.util.sha1(path)
+    else:
+        hashes = file_hash_cache.sha1_files(file_paths.values())
+        for base, path in file_paths.items():
+            file_hash_dict[base] = hashes[path]
 
-@contextmanager
-def as_cwd(path):
-    start_dir = getcwd()
-    chdir(path)
-    yield
-    chdir(start_dir)
+    return file_hash_dict
 
 
-def hash_folder_abs(directory, work_dir):
+def hash_folder_abs(directory, work_dir, file_hash_cache=None):
     assert directory.startswith(work_dir), "directory must be inside work_dir: {} {}".format(directory, work_dir)
     assert not work_dir[-1] == '/', "This code assumes no trailing slash on the work_dir"
 
-    with as_cwd(work_dir):
-        return hash_folder(directory[len(work_dir) + 1:])
+    # NOTE: This doesn't chdir into work_dir so that packages can be hashed from multiple build
+    # threads at once.
+    return hash_checkout(_hash_files_in_folder(directory, file_hash_cache))
 
 
-def hash_folder(directory):
-    return hash_checkout(hash_files_in_folder(directory))
+def hash_folder(directory, file_hash_cache=None):
+    return hash_checkout(hash_files_in_folder(directory, file_hash_cache))
 
 
 # Try to read json from the given file. If it is an empty file, then return an
@@ -592,7 +822,7 @@ def make_bootstrap_tarball(package_store, packages, variant):
         pkg_id = filename[:-len(".tar.xz")]
 
         def local_fetcher(id, target):
-            shutil.unpack_archive(pkg_path, target, "gztar")
+            extract_tarball(pkg_path, target)
         repository.add(local_fetcher, pkg_id, False)
 
     # Activate the packages inside the repository.
@@ -631,7 +861,7 @@ def make_bootstrap_tarball(package_store, packages, variant):
     return mark_latest()
 
 
-def build_tree_variants(package_store, mkbootstrap):
+def build_tree_variants(package_store, mkbootstrap, jobs=1, keep_going=False, prefetch_jobs=0):
     """ Builds all possible tree variants in a given package store
     """
     result = dict()
@@ -639,16 +869,126 @@ def build_tree_variants(package_store, mkbootstrap):
     if len(tree_variants) == 0:
         raise Exception('No treeinfo.json can be found in {}'.format(package_store.packages_dir))
     for variant in tree_variants:
-        result[variant] = pkgpanda.build.build_tree(package_store, mkbootstrap, variant)
+        result[variant] = pkgpanda.build.build_tree(
+            package_store, mkbootstrap, variant, jobs, keep_going, prefetch_jobs)
     return result
 
 
-def build_tree(package_store, mkbootstrap, tree_variants):
-    """Build packages and bootstrap tarballs for one or all tree variants.
+def build_packages(package_store, build_order, jobs=1, keep_going=False):
+    """Build the packages in build_order, running up to jobs builds at once.
 
-    Returns a dict mapping tree variants to bootstrap IDs.
+    build_order must be a topological ordering of (name, variant) tuples, as
+    computed by build_tree(). A package is started as soon as every package it
+    requires has been built (and so has a latest file). When several packages
+    are ready the one earliest in build_order is started first, so with a
+    single job the packages are built in exactly build_order.
 
-    If tree_variant is None, builds all available tree variants.
+    If a build fails and keep_going is False no new builds are started, the
+    running ones are waited for, and a BuildError is raised. If keep_going is
+    True every package which doesn't (transitively) require the failed package
+    is still built, and the BuildError is raised at the end.
+
+    Returns a dict mapping package name to a dict mapping variant to the path
+    of the built package tarball.
+
+    """
+    if jobs < 1:
+        raise BuildError("The number of build jobs must be at least 1. Got: {}".format(jobs))
+
+    order_index = {pkg_tuple: index for index, pkg_tuple in enumerate(build_order)}
+    waiting_on = dict()
+    dependents = {pkg_tuple: set() for pkg_tuple in build_order}
+    for pkg_tuple in build_order:
+        requires = set(expand_require(r) for r in package_store.packages[pkg_tuple]['requires'])
+        waiting_on[pkg_tuple] = requires
+        for require_tuple in requires:
+            assert require_tuple in order_index, \
+                "Programming error: {} requires {} which isn't in the build order".format(pkg_tuple, require_tuple)
+            dependents[require_tuple].add(pkg_tuple)
+
+    built_packages = dict()
+    timings = dict()
+    failed = dict()
+    skipped = set()
+    ready = set(pkg_tuple for pkg_tuple, requires in waiting_on.items() if not requires)
+    running = dict()
+
+    def timed_build(pkg_tuple):
+        start = time.monotonic()
+        try:
+            return build(package_store, pkg_tuple[0], pkg_tuple[1], True)
+        finally:
+            timings[pkg_tuple] = time.monotonic() - start
+
+    def skip_dependents(pkg_tuple):
+        to_skip = list(dependents[pkg_tuple])
+        while to_skip:
+            dependent = to_skip.pop()
+            if dependent in skipped:
+                continue
+            skipped.add(dependent)
+            ready.discard(dependent)
+            to_skip += dependents[dependent]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor, \
+            _saving_file_hash_cache(package_store):
+        while ready or running:
+            while ready and len(running) < jobs and (keep_going or not failed):
+                pkg_tuple = min(ready, key=order_index.__getitem__)
+                ready.remove(pkg_tuple)
+                running[executor.submit(timed_build, pkg_tuple)] = pkg_tuple
+
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                pkg_tuple = running.pop(future)
+                name, variant = pkg_tuple
+                try:
+                    pkg_path = future.result()
+                except Exception as ex:
+                    print("Package {} variant {} failed after {:.1f}s: {}".format(
+                        name, pkgpanda.util.variant_name(variant), timings[pkg_tuple], ex))
+                    failed[pkg_tuple] = ex
+                    skip_dependents(pkg_tuple)
+                    continue
+
+                print("Package {} variant {} built in {:.1f}s".format(
+                    name, pkgpanda.util.variant_name(variant), timings[pkg_tuple]))
+                built_packages.setdefault(name, dict())[variant] = pkg_path
+                for dependent in dependents[pkg_tuple]:
+                    waiting_on[dependent].discard(pkg_tuple)
+                    if not waiting_on[dependent] and dependent not in skipped:
+                        ready.add(dependent)
+
+    print("Package build times:")
+    for pkg_tuple in sorted(timings, key=timings.__getitem__, reverse=True):
+        print("  {:>8.1f}s {} variant {}".format(
+            timings[pkg_tuple], pkg_tuple[0], pkgpanda.util.variant_name(pkg_tuple[1])))
+
+    if failed and not keep_going:
+        # Surface the first failure as-is, the same as a serial build would.
+        raise next(iter(failed.values()))
+
+    if failed:
+        raise BuildError("Failed building {} package(s): {}. Not built because a dependency failed: {}".format(
+            len(failed),
+            ', '.join("{} variant {} ({})".format(name, pkgpanda.util.variant_name(variant), ex)
+                      for (name, variant), ex in sorted(failed.items(), key=lambda item: order_index[item[0]])),
+            ', '.join("{} variant {}".format(name, pkgpanda.util.variant_name(variant))
+                      for name, variant in sorted(skipped, key=order_index.__getitem__)) or 'none'))
+
+    return built_packages
+
+
+def get_build_order(package_store, tree_variants):
+    """Return the package sets of the tree variants and the order to build their packages in.
+
+    The build order is a list of (name, variant) tuples in which every package
+    comes after all of the packages it requires.
+
+    If tree_variants is None, uses all available tree variants.
 
     """
     # TODO(cmaloney): Add support for circular dependencies. They are doable
@@ -720,17 +1060,32 @@ def build_tree(package_store, mkbootstrap, tree_variants):
         for package_set in package_sets:
             visit_packages(package_set.all_packages)
 
-    built_packages = dict()
-    for (name, variant) in build_order:
-        built_packages.setdefault(name, dict())
+    return package_sets, build_order
 
-        # Run the build, store the built package path for later use.
-        # TODO(cmaloney): Only build the requested variants, rather than all variants.
-        built_packages[name][variant] = build(
-            package_store,
-            name,
-            variant,
-            True)
+
+def build_tree(package_store, mkbootstrap, tree_variants, jobs=1, keep_going=False, prefetch_jobs=0):
+    """Build packages and bootstrap tarballs for one or all tree variants.
+
+    Returns a dict mapping tree variants to bootstrap IDs.
+
+    If tree_variant is None, builds all available tree variants.
+
+    Up to jobs packages are built at once, see build_packages() for how
+    keep_going changes what happens when a package fails to build.
+
+    If prefetch_jobs is non-zero, the tree is planned with plan_tree() first
+    and every package and bootstrap tarball available from the repository url
+    is downloaded up front with that many concurrent downloads.
+
+    """
+    if prefetch_jobs:
+        prefetch_plan(package_store, plan_tree(package_store, tree_variants), prefetch_jobs)
+
+    package_sets, build_order = get_build_order(package_store, tree_variants)
+
+    # Run the builds, store the built package paths for later use.
+    # TODO(cmaloney): Only build the requested variants, rather than all variants.
+    built_packages = build_packages(package_store, build_order, jobs, keep_going)
 
     # Build bootstrap tarballs for all tree variants.
     def make_bootstrap(package_set):
@@ -764,6 +1119,109 @@ def build_tree(package_store, mkbootstrap, tree_variants):
     return results
 
 
+class UnplannableError(Exception):
+    """A package id can't be computed without building or pulling something first."""
+
+
+def plan_tree(package_store, tree_variants):
+    """Compute the id of every package (and bootstrap tarball) the tree variants would produce.
+
+    Nothing is built, pulled or extracted. Docker image ids are only looked up
+    among the images already present locally. Each package is reported as one
+    of:
+
+    - local: the package tarball is in the local package cache.
+    - remote: the package tarball can be downloaded from the repository url.
+    - build: the package has to be built.
+    - unknown: the id can't be computed, because the docker image the package
+      (or one of its requires) is built in isn't available locally.
+
+    Returns a dict with 'packages', a dict mapping (name, variant) to a dict
+    with the 'id' and 'status' of the package, in build order, and
+    'bootstraps', a dict mapping tree variant to a dict with the 'id' and
+    'status' of its bootstrap tarball.
+
+    """
+    package_sets, build_order = get_build_order(package_store, tree_variants)
+
+    docker_ids = dict()
+
+    def get_local_docker_id(docker_name):
+        if docker_name not in docker_ids:
+            try:
+                docker_ids[docker_name] = get_docker_id(docker_name)
+            except CalledProcessError:
+                docker_ids[docker_name] = None
+        if docker_ids[docker_name] is None:
+            raise UnplannableError("docker image {} isn't available locally".format(docker_name))
+        return docker_ids[docker_name]
+
+    packages = collections.OrderedDict()
+
+    def get_requires_id(name, variant):
+        pkg_id = packages[(name, variant)]['id']
+        if pkg_id is None:
+            raise UnplannableError("requires {} variant {} which can't be planned".format(
+                name, pkgpanda.util.variant_name(variant)))
+        return pkg_id
+
+    for name, variant in build_order:
+        try:
+            resolved = resolve_package(package_store, name, variant, get_requires_id, get_local_docker_id)
+        except UnplannableError as ex:
+            print("Unable to compute the id of {} variant {}: {}".format(name, pkgpanda.util.variant_name(variant), ex))
+            packages[(name, variant)] = {'id': None, 'status': 'unknown'}
+            continue
+
+        pkg_id = resolved.pkg_id
+        if os.path.exists(package_store.get_package_path(pkg_id)):
+            status = 'local'
+        elif package_store.has_remote_package(pkg_id):
+            status = 'remote'
+        else:
+            status = 'build'
+        packages[(name, variant)] = {'id': str(pkg_id), 'status': status}
+
+    bootstraps = dict()
+    for package_set in package_sets:
+        pkg_ids = [packages[pkg_tuple]['id'] for pkg_tuple in package_set.bootstrap_packages]
+        if None in pkg_ids:
+            bootstraps[package_set.variant] = {'id': None, 'status': 'unknown'}
+            continue
+
+        bootstrap_id = hash_checkout(pkg_ids)
+        if os.path.exists(package_store.get_bootstrap_cache_dir() + '/' + bootstrap_id + '.bootstrap.tar.xz'):
+            status = 'local'
+        elif package_store.has_remote_bootstrap(bootstrap_id):
+            status = 'remote'
+        else:
+            status = 'build'
+        bootstraps[package_set.variant] = {'id': bootstrap_id, 'status': status}
+
+    return {'packages': packages, 'bootstraps': bootstraps}
+
+
+def prefetch_plan(package_store, plan, jobs=8):
+    """Download every package and bootstrap tarball which plan_tree() found to be a remote hit."""
+    pkg_ids = [info['id'] for info in plan['packages'].values() if info['status'] == 'remote']
+    bootstrap_ids = [info['id'] for info in plan['bootstraps'].values() if info['status'] == 'remote']
+    with logger.scope("Prefetch {} packages and {} bootstrap tarballs".format(len(pkg_ids), len(bootstrap_ids))):
+        return package_store.prefetch(pkg_ids, bootstrap_ids, jobs)
+
+
+def print_plan(plan):
+    print("Package plan:")
+    for (name, variant), info in plan['packages'].items():
+        print("  {:<8} {} variant {}".format(info['status'], info['id'] or name, pkgpanda.util.variant_name(variant)))
+    print("Bootstrap plan:")
+    for variant, info in sorted(plan['bootstraps'].items(), key=lambda item: pkgpanda.util.variant_str(item[0])):
+        print("  {:<8} {} variant {}".format(info['status'], info['id'], pkgpanda.util.variant_name(variant)))
+
+    counts = collections.Counter(info['status'] for info in plan['packages'].values())
+    print("Packages: {} local, {} remote, {} to build, {} unknown".format(
+        counts['local'], counts['remote'], counts['build'], counts['unknown']))
+
+
 def assert_no_duplicate_keys(lhs, rhs):
     if len(lhs.keys() & rhs.keys()) != 0:
         print("ASSERTION FAILED: Duplicate keys between {} and {}".format(lhs, rhs))
@@ -774,13 +1232,14 @@ def assert_no_duplicate_keys(lhs, rhs):
 def build_package_variants(package_store, name, clean_after_build=True, recursive=False):
     # Find the packages dir / root of the packages tree, and create a PackageStore
     results = dict()
-    for variant in package_store.packages_by_name[name].keys():
-        results[variant] = build(
-            package_store,
-            name,
-            variant,
-            clean_after_build=clean_after_build,
-            recursive=recursive)
+    with _saving_file_hash_cache(package_store):
+        for variant in package_store.packages_by_name[name].keys():
+            results[variant] = build(
+                package_store,
+                name,
+                variant,
+                clean_after_build=clean_after_build,
+                recursive=recursive)
     return results
 
 
@@ -833,25 +1292,50 @@ def build(package_store: PackageStore, name: str, variant, clean_after_build, re
         return _build(package_store, name, variant, clean_after_build, recursive)
 
 
-def _build(package_store, name, variant, clean_after_build, recursive):
-    assert isinstance(package_store, PackageStore)
-    tmpdir = tempfile.TemporaryDirectory(prefix="pkgpanda_repo")
-    repository = Repository(tmpdir.name)
+def get_or_pull_docker_id(docker_name):
+    try:
+        return get_docker_id(docker_name)
+    except CalledProcessError:
+        # docker pull the container and try again
+        check_call(['docker', 'pull', docker_name])
+        return get_docker_id(docker_name)
 
+
+class ResolvedPackage:
+    """Everything which goes into the id of a package, as computed by resolve_package()."""
+
+    def __init__(self, pkg_id, final_buildinfo, pkginfo, fetchers, build_script_file, docker_name, requires_ids):
+        self.pkg_id = pkg_id
+        self.final_buildinfo = final_buildinfo
+        self.pkginfo = pkginfo
+        self.fetchers = fetchers
+        self.build_script_file = build_script_file
+        self.docker_name = docker_name
+        self.requires_ids = requires_ids
+
+    @property
+    def version(self):
+        return self.pkg_id.version
+
+
+def resolve_package(package_store, name, variant, get_requires_id, get_docker_id=get_or_pull_docker_id):
+    """Compute the id a build of the package would have, without building anything.
+
+    get_requires_id is called with the (name, variant) of every package the
+    package (transitively) requires and must return the id of the build of that
+    package to use. get_docker_id is called with the name of the docker image
+    the package is built in and must return the id of that image.
+
+    Returns a ResolvedPackage.
+    """
     package_dir = package_store.get_package_folder(name)
 
     def src_abs(name):
         return package_dir + '/' + name
 
-    def cache_abs(filename):
-        return package_store.get_package_cache_folder(name) + '/' + filename
-
     # Build pkginfo over time, translating fields from buildinfo.
     pkginfo = {}
 
-    # Build up the docker command arguments over time, translating fields as needed.
-    cmd = DockerCmd()
-
     assert (name, variant) in package_store.packages, \
         "Programming error: name, variant should have been validated to be valid before calling build()."
 
@@ -910,23 +1394,15 @@ def _build(package_store, name, variant, clean_after_build, recursive):
     # Add the "extra" folder inside the package as an additional source if it
     # exists
     if os.path.exists(extra_dir):
-        extra_id = hash_folder_abs(extra_dir, package_dir)
+        extra_id = hash_folder_abs(extra_dir, package_dir, package_store.file_hash_cache)
         builder.add('extra_source', extra_id)
         final_buildinfo['extra_source'] = extra_id
 
     # Figure out the docker name.
     docker_name = builder.take('docker')
-    cmd.container = docker_name
 
     # Add the id of the docker build environment to the build_ids.
-    try:
-        docker_id = get_docker_id(docker_name)
-    except CalledProcessError:
-        # docker pull the container and try again
-        check_call(['docker', 'pull', docker_name])
-        docker_id = get_docker_id(docker_name)
-
-    builder.update('docker', docker_id)
+    builder.update('docker', get_docker_id(docker_name))
 
     # TODO(cmaloney): The environment variables should be generated during build
     # not live in buildinfo.json.
@@ -961,15 +1437,8 @@ def _build(package_store, name, variant, clean_after_build, recursive):
             raise BuildError("group in buildinfo.json didn't meet the validation rules. {}".format(ex))
         pkginfo['group'] = group
 
-    # Packages need directories inside the fake install root (otherwise docker
-    # will try making the directories on a readonly filesystem), so build the
-    # install root now, and make the package directories in it as we go.
-    install_dir = tempfile.mkdtemp(prefix="pkgpanda-")
-
-    active_packages = list()
-    active_package_ids = set()
+    requires_ids = set()
     active_package_variants = dict()
-    auto_deps = set()
 
     # Final package has the same requires as the build.
     requires = builder.take('requires')
@@ -1008,53 +1477,22 @@ def _build(package_store, name, variant, clean_after_build, recursive):
 
         active_package_variants[requires_name] = requires_variant
 
-        # Figure out the last build of the dependency, add that as the
-        # fully expanded dependency.
-        requires_last_build = package_store.get_last_build_filename(requires_name, requires_variant)
-        if not os.path.exists(requires_last_build):
-            if recursive:
-                # Build the dependency
-                build(package_store, requires_name, requires_variant, clean_after_build, recursive)
-            else:
-                raise BuildError("No last build file found for dependency {} variant {}. Rebuild "
-                                 "the dependency".format(requires_name, requires_variant))
-
         try:
-            pkg_id_str = load_string(requires_last_build)
-            auto_deps.add(pkg_id_str)
-            pkg_buildinfo = package_store.get_buildinfo(requires_name, requires_variant)
-            pkg_requires = pkg_buildinfo['requires']
-            pkg_path = repository.package_path(pkg_id_str)
-            pkg_tar = pkg_id_str + '.tar.xz'
-            if not os.path.exists(package_store.get_package_cache_folder(requires_name) + '/' + pkg_tar):
-                raise BuildError(
-                    "The build tarball {} refered to by the last_build file of the dependency {} "
-                    "variant {} doesn't exist. Rebuild the dependency.".format(
-                        pkg_tar,
-                        requires_name,
-                        requires_variant))
-
-            active_package_ids.add(pkg_id_str)
-
-            # Mount the package into the docker container.
-            cmd.volumes[pkg_path] = install_root + "/packages/{}:ro".format(pkg_id_str)
-            os.makedirs(os.path.join(install_dir, "packages/{}".format(pkg_id_str)))
+            requires_ids.add(get_requires_id(requires_name, requires_variant))
 
             # Add the dependencies of the package to the set which will be
             # activated.
             # TODO(cmaloney): All these 'transitive' dependencies shouldn't
             # be available to the package being built, only what depends on
             # them directly.
-            to_check += pkg_requires
+            to_check += package_store.get_buildinfo(requires_name, requires_variant)['requires']
         except ValidationError as ex:
             raise BuildError("validating package needed as dependency {0}: {1}".format(requires_name, ex)) from ex
         except PackageError as ex:
             raise BuildError("loading package needed as dependency {0}: {1}".format(requires_name, ex)) from ex
 
     # Add requires to the package id, calculate the final package id.
-    # NOTE: active_packages isn't fully constructed here since we lazily load
-    # packages not already in the repository.
-    builder.update('requires', list(active_package_ids))
+    builder.update('requires', list(requires_ids))
     version_extra = None
     if builder.has('version_extra'):
         version_extra = builder.take('version_extra')
@@ -1083,6 +1521,208 @@ def _build(package_store, name, variant, clean_after_build, recursive):
     final_buildinfo['name'] = name
     final_buildinfo['variant'] = variant
 
+    return ResolvedPackage(pkg_id, final_buildinfo, pkginfo, fetchers, build_script_file, docker_name, requires_ids)
+
+
+def _make_cached(path, tmp_dir, make):
+    """Make the directory path with make(tmp_path) unless it exists already, and return it.
+
+    It is made in tmp_dir and moved into place once complete, so concurrent
+    builds never see a partial one. If several make it at once, the first
+    one to finish wins.
+    """
+    if os.path.exists(path):
+        return path
+    make_directory(tmp_dir)
+    make_directory(os.path.dirname(path))
+    tmp_path = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        os.chmod(tmp_path, 0o755)
+        make(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    finally:
+        if os.path.exists(tmp_path):
+            remove_directory(tmp_path)
+    return path
+
+
+def _get_dependency_repository(package_store, pkg_ids):
+    """Return a Repository with the packages pkg_ids extracted into it.
+
+    The repository is shared by all builds, so each package is only
+    extracted once. Its packages must be treated as read-only.
+    """
+    cache_dir = package_store.get_dependency_cache_dir()
+    repository = Repository(cache_dir + "/packages")
+    for pkg_id_str in pkg_ids:
+        package_path = package_store.get_package_path(PackageId(pkg_id_str))
+        _make_cached(
+            repository.package_path(pkg_id_str),
+            cache_dir + "/tmp",
+            lambda target: extract_tarball(package_path, target))
+    return repository
+
+
+def _remove_cached(path, tmp_dir):
+    """Remove the cached directory path.
+
+    It is moved into tmp_dir before it's removed, so nothing ever sees a
+    partially removed one.
+    """
+    make_directory(tmp_dir)
+    tmp_path = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        os.rename(path, os.path.join(tmp_path, "removed"))
+    except FileNotFoundError:
+        # Removed by a concurrent build.
+        pass
+    finally:
+        remove_directory(tmp_path)
+
+
+def _prune_cached(path, keep, tmp_dir):
+    """Remove all but the keep most recently used directories in path."""
+    used = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                used.append((entry.stat(follow_symlinks=False).st_mtime, entry.path))
+            except FileNotFoundError:
+                # Removed by a concurrent build.
+                pass
+    for _, dir_path in sorted(used, reverse=True)[keep:]:
+        _remove_cached(dir_path, tmp_dir)
+
+
+def _prune_dependencies(cache_dir):
+    """Remove the extracted packages in the dependency cache which no install root uses.
+
+    Install roots, cached or copied for a build, have a directory for each
+    of their packages, so together they list the packages still needed.
+    """
+    used = set()
+    tmp_dir = cache_dir + "/tmp"
+    install_roots = [os.path.join(cache_dir + "/install_roots", name)
+                     for name in if_exists(os.listdir, cache_dir + "/install_roots") or []]
+    install_roots += [os.path.join(tmp_dir, name)
+                      for name in if_exists(os.listdir, tmp_dir) or [] if name.startswith("install-")]
+    for root in install_roots:
+        used.update(if_exists(os.listdir, os.path.join(root, "packages")) or [])
+    packages_dir = cache_dir + "/packages"
+    for name in if_exists(os.listdir, packages_dir) or []:
+        if name not in used:
+            _remove_cached(os.path.join(packages_dir, name), tmp_dir)
+
+
+def _make_install_dir(package_store, repository, pkg_ids, max_cached=32):
+    """Return a new install root with the packages pkg_ids active, to mount as /opt/mesosphere in a build.
+
+    Activated install roots are cached by the packages in them, and the
+    max_cached most recently used ones are kept, along with the extracted
+    packages they use. Each build gets a copy in the dependency cache so
+    that it can make its own mount points in it. Only the directories are
+    copied, files are hardlinked, as the install root is mounted read-only.
+    """
+    # The packages are activated in a fixed order, which decides the order of their environment
+    # variables, so the same set of packages always gives the same install root.
+    pkg_ids = sorted(pkg_ids)
+
+    def activate(root):
+        for pkg_id_str in pkg_ids:
+            os.makedirs(os.path.join(root, "packages", pkg_id_str))
+        # Activate the packages so that we have a proper path, environment
+        # variables.
+        install = Install(
+            root=root,
+            config_dir=None,
+            rooted_systemd=True,
+            manage_systemd=False,
+            block_systemd=True,
+            fake_path=True,
+            manage_users=False,
+            manage_state_dir=False)
+        install.activate([repository.load(pkg_id_str) for pkg_id_str in pkg_ids])
+        # Rewrite all the symlinks inside the active path because we will
+        # be mounting the folder into a docker container, and the absolute
+        # paths to the packages will change.
+        # TODO(cmaloney): This isn't very clean, it would be much nicer to
+        # just run pkgpanda inside the package.
+        rewrite_symlinks(root, repository.path, install_root + "/packages/")
+
+    cache_dir = package_store.get_dependency_cache_dir()
+    cached_root = _make_cached(
+        cache_dir + "/install_roots/" + hash_checkout(pkg_ids), cache_dir + "/tmp", activate)
+    # Mark the install root as used, for _prune_cached.
+    os.utime(cached_root)
+
+    # In the dependency cache, next to the cached install root, so files can be hardlinked.
+    install_dir = tempfile.mkdtemp(prefix="install-", dir=cache_dir + "/tmp")
+    with os.scandir(cached_root) as entries:
+        for entry in entries:
+            dest = os.path.join(install_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                shutil.copytree(entry.path, dest, symlinks=True, copy_function=os.link)
+            elif entry.is_symlink():
+                os.symlink(os.readlink(entry.path), dest)
+            else:
+                os.link(entry.path, dest)
+    _prune_cached(cache_dir + "/install_roots", max_cached, cache_dir + "/tmp")
+    _prune_dependencies(cache_dir)
+    return install_dir
+
+
+def _build(package_store, name, variant, clean_after_build, recursive):
+    assert isinstance(package_store, PackageStore)
+
+    package_dir = package_store.get_package_folder(name)
+
+    def src_abs(name):
+        return package_dir + '/' + name
+
+    def cache_abs(filename):
+        return package_store.get_package_cache_folder(name) + '/' + filename
+
+    def get_last_build(requires_name, requires_variant):
+        # Figure out the last build of the dependency, add that as the
+        # fully expanded dependency.
+        requires_last_build = package_store.get_last_build_filename(requires_name, requires_variant)
+        if not os.path.exists(requires_last_build):
+            if recursive:
+                # Build the dependency
+                build(package_store, requires_name, requires_variant, clean_after_build, recursive)
+            else:
+                raise BuildError("No last build file found for dependency {} variant {}. Rebuild "
+                                 "the dependency".format(requires_name, requires_variant))
+
+        pkg_id_str = load_string(requires_last_build)
+        pkg_tar = pkg_id_str + '.tar.xz'
+        if not os.path.exists(package_store.get_package_cache_folder(requires_name) + '/' + pkg_tar):
+            raise BuildError(
+                "The build tarball {} refered to by the last_build file of the dependency {} "
+                "variant {} doesn't exist. Rebuild the dependency.".format(
+                    pkg_tar,
+                    requires_name,
+                    requires_variant))
+        return pkg_id_str
+
+    resolved = resolve_package(package_store, name, variant, get_last_build, package_store.get_docker_id)
+    pkg_id = resolved.pkg_id
+    version = resolved.version
+    final_buildinfo = resolved.final_buildinfo
+    pkginfo = resolved.pkginfo
+    fetchers = resolved.fetchers
+    build_script_file = resolved.build_script_file
+    auto_deps = resolved.requires_ids
+    extra_dir = src_abs("extra")
+
+    # Build up the docker command arguments over time, translating fields as needed.
+    cmd = DockerCmd()
+    cmd.container = resolved.docker_name
+
     # If the package is already built, don't do anything.
     pkg_path = package_store.get_package_cache_folder(name) + '/{}.tar.xz'.format(pkg_id)
 
@@ -1093,6 +1733,7 @@ def _build(package_store, name, variant, clean_after_build, recursive):
         # TODO(cmaloney): Updating / filling last_build should be moved out of
         # the build function.
         write_string(package_store.get_last_build_filename(name, variant), str(pkg_id))
+        package_store.write_contents_digest(pkg_id)
 
         return pkg_path
 
@@ -1105,6 +1746,7 @@ def _build(package_store, name, variant, clean_after_build, recursive):
         write_string(package_store.get_last_build_filename(name, variant), str(pkg_id))
         print(dl_path, pkg_path)
         assert dl_path == pkg_path
+        package_store.write_contents_digest(pkg_id)
         return pkg_path
 
     # Fall out and do the build since it couldn't be downloaded
@@ -1116,6 +1758,16 @@ def _build(package_store, name, variant, clean_after_build, recursive):
 
     # Clean out src, result so later steps can use them freely for building.
     def clean():
+        if not is_windows:
+            # Builds run as root in docker, so removing what they made only
+            # works on the host if we are root too.
+            try:
+                remove_directory(cache_abs("src"))
+                remove_directory(cache_abs("result"))
+                return
+            except CalledProcessError:
+                pass
+
         # Run a docker container to remove src/ and result/
         cmd = DockerCmd()
         cmd.volumes = {
@@ -1141,14 +1793,22 @@ def _build(package_store, name, variant, clean_after_build, recursive):
         raise BuildError("result folder must not exist. It will be made when the package is "
                          "built. {}".format(result_dir))
 
-    # 'mkpanda add' all implicit dependencies since we actually need to build.
+    # Extract all implicit dependencies since we actually need to build.
     for dep in auto_deps:
         print("Auto-adding dependency: {}".format(dep))
-        # NOTE: Not using the name pkg_id because that overrides the outer one.
-        id_obj = PackageId(dep)
-        add_package_file(repository, package_store.get_package_path(id_obj))
-        package = repository.load(dep)
-        active_packages.append(package)
+    repository = _get_dependency_repository(package_store, auto_deps)
+    for pkg_id_str in auto_deps:
+        # Mount the package into the docker container.
+        cmd.volumes[repository.package_path(pkg_id_str)] = install_root + "/packages/{}:ro".format(pkg_id_str)
+
+    # Packages need directories inside the fake install root (otherwise docker
+    # will try making the directories on a readonly filesystem). The install
+    # root has them for the dependencies, the one for this package is made
+    # below. It is made right after extracting the dependencies, as it keeps
+    # them from being pruned from the dependency cache by other builds.
+    # TODO(cmaloney): RAII type thing for temproary directory so if we
+    # don't get all the way through things will be cleaned up?
+    install_dir = _make_install_dir(package_store, repository, auto_deps)
 
     # Checkout all the sources int their respective 'src/' folders.
     try:
@@ -1165,29 +1825,9 @@ def _build(package_store, name, variant, clean_after_build, recursive):
 
             fetcher.checkout_to(root)
     except ValidationError as ex:
+        remove_directory(install_dir)
         raise BuildError("Validation error when fetching sources for package: {}".format(ex))
 
-    # Activate the packages so that we have a proper path, environment
-    # variables.
-    # TODO(cmaloney): RAII type thing for temproary directory so if we
-    # don't get all the way through things will be cleaned up?
-    install = Install(
-        root=install_dir,
-        config_dir=None,
-        rooted_systemd=True,
-        manage_systemd=False,
-        block_systemd=True,
-        fake_path=True,
-        manage_users=False,
-        manage_state_dir=False)
-    install.activate(active_packages)
-    # Rewrite all the symlinks inside the active path because we will
-    # be mounting the folder into a docker container, and the absolute
-    # paths to the packages will change.
-    # TODO(cmaloney): This isn't very clean, it would be much nicer to
-    # just run pkgpanda inside the package.
-    rewrite_symlinks(install_dir, repository.path, install_root + "/packages/")
-
     print("Building package in docker")
 
     # TODO(cmaloney): Run as a specific non-root user, make it possible
@@ -1269,6 +1909,7 @@ def _build(package_store, name, variant, clean_after_build, recursive):
     tmp_name = pkg_path + "-tmp.tar.xz"
     make_tar(tmp_name, cache_abs("result"))
     os.replace(tmp_name, pkg_path)
+    package_store.write_contents_digest(pkg_id)
     print("Package built.")
     if clean_after_build:
         clean()
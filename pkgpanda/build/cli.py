@@ -6,7 +6,25 @@ the necessary dependencies.
 
 Usage:
   mkpanda [--repository-url=<repository_url>] [--dont-clean-after-build] [--recursive] [--variant=<variant>]
-  mkpanda tree [--mkbootstrap] [--repository-url=<repository_url>] [--variant=<variant>]
+  mkpanda tree [--mkbootstrap] [--repository-url=<repository_url>] [--variant=<variant>] [--jobs=<jobs>]
+               [--keep-going] [--prefetch-jobs=<prefetch_jobs>]
+  mkpanda tree --plan [--repository-url=<repository_url>] [--variant=<variant>] [--prefetch-jobs=<prefetch_jobs>]
+
+Options:
+  --jobs=<jobs>  Number of packages to build at once. A package is built as
+                 soon as all of the packages it requires are built. [default: 1]
+  --keep-going   Keep building packages which don't depend on a failed
+                 package, rather than stopping at the first failure.
+  --plan         Print the id of every package and bootstrap tarball the
+                 tree would produce, and whether each is in the local cache,
+                 available from the repository url, or needs to be built.
+                 Nothing is built.
+  --prefetch-jobs=<prefetch_jobs>
+                 Before building, download every package and bootstrap
+                 tarball of the tree which is available from the repository
+                 url, running this many downloads at once. 0 disables the
+                 prefetch, so packages are downloaded one at a time as they
+                 are needed. [default: 0]
 """
 
 import sys
@@ -19,6 +37,13 @@ import pkgpanda.build
 import pkgpanda.build.constants
 
 
+def get_int_argument(arguments, name):
+    try:
+        return int(arguments[name])
+    except ValueError:
+        raise pkgpanda.build.BuildError("{} must be an integer. Got: {}".format(name, arguments[name]))
+
+
 def main():
     try:
         arguments = docopt(__doc__, version="mkpanda {}".format(pkgpanda.build.constants.version))
@@ -29,11 +54,24 @@ def main():
         target_variant = variant_arg if variant_arg != 'default' else None
         # Make a local repository for build dependencies
         if arguments['tree']:
+            jobs = get_int_argument(arguments, '--jobs')
+            prefetch_jobs = get_int_argument(arguments, '--prefetch-jobs')
+            keep_going = arguments['--keep-going']
             package_store = pkgpanda.build.PackageStore(getcwd(), arguments['--repository-url'])
+
+            if arguments['--plan']:
+                plan = pkgpanda.build.plan_tree(package_store, None if variant_arg is None else [target_variant])
+                pkgpanda.build.print_plan(plan)
+                if prefetch_jobs:
+                    pkgpanda.build.prefetch_plan(package_store, plan, prefetch_jobs)
+                sys.exit(0)
+
             if variant_arg is None:
-                pkgpanda.build.build_tree_variants(package_store, arguments['--mkbootstrap'])
+                pkgpanda.build.build_tree_variants(
+                    package_store, arguments['--mkbootstrap'], jobs, keep_going, prefetch_jobs)
             else:
-                pkgpanda.build.build_tree(package_store, arguments['--mkbootstrap'], [target_variant])
+                pkgpanda.build.build_tree(
+                    package_store, arguments['--mkbootstrap'], [target_variant], jobs, keep_going, prefetch_jobs)
             sys.exit(0)
 
         # Package name is the folder name.
@@ -1,4 +1,13 @@
+import json
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+import pkgpanda
 import pkgpanda.build
+import pkgpanda.util
 
 
 def test_hash_files_in_folder(tmpdir):
@@ -84,3 +93,303 @@ def test_hash_files_in_folder(tmpdir):
             'baz/bang/new': '15bc116ce980d703d62a16531b0ef5bb42fef91c',
             'baz/bang/swish/swipe': 'e855a8aca0e15c14144901428df7042798a622d6'
         }
+
+
+def test_hash_folder_abs(tmpdir):
+    tmpdir.join("pkg/extra/foo").write("foo contents", ensure=True)
+    tmpdir.join("pkg/extra/baz/bar").write("bar contents", ensure=True)
+    tmpdir.join("pkg/extra/empty").ensure(dir=True)
+
+    with tmpdir.join("pkg").as_cwd():
+        expected = pkgpanda.build.hash_folder("extra")
+
+    assert pkgpanda.build.hash_folder_abs(str(tmpdir.join("pkg/extra")), str(tmpdir.join("pkg"))) == expected
+
+
+class FakePackageStore:
+
+    def __init__(self, requires):
+        self.packages = {(name, None): {'requires': deps} for name, deps in requires.items()}
+        self.file_hash_cache = mock.Mock()
+
+
+def test_build_packages_order(monkeypatch):
+    package_store = FakePackageStore({'a': [], 'b': ['a'], 'c': [], 'd': ['b', 'c']})
+    built = []
+
+    def fake_build(package_store, name, variant, clean_after_build):
+        built.append(name)
+        return name + '.tar.xz'
+
+    monkeypatch.setattr(pkgpanda.build, 'build', fake_build)
+
+    build_order = [('a', None), ('b', None), ('c', None), ('d', None)]
+    result = pkgpanda.build.build_packages(package_store, build_order, jobs=1)
+    assert built == ['a', 'b', 'c', 'd']
+    assert result == {name: {None: name + '.tar.xz'} for name in 'abcd'}
+    # The file hash cache is written out once, after all the builds.
+    package_store.file_hash_cache.save.assert_called_once_with()
+
+    built.clear()
+    result = pkgpanda.build.build_packages(package_store, build_order, jobs=4)
+    assert sorted(built) == ['a', 'b', 'c', 'd']
+    assert built.index('b') > built.index('a')
+    assert built[-1] == 'd'
+    assert result == {name: {None: name + '.tar.xz'} for name in 'abcd'}
+
+
+def test_build_packages_concurrent(monkeypatch):
+    package_store = FakePackageStore({'a': [], 'b': [], 'c': ['a', 'b']})
+    barrier = threading.Barrier(2, timeout=10)
+
+    def fake_build(package_store, name, variant, clean_after_build):
+        # a and b must be running at the same time for both to pass the barrier.
+        if name in ('a', 'b'):
+            barrier.wait()
+        return name
+
+    monkeypatch.setattr(pkgpanda.build, 'build', fake_build)
+
+    result = pkgpanda.build.build_packages(package_store, [('a', None), ('b', None), ('c', None)], jobs=2)
+    assert result == {'a': {None: 'a'}, 'b': {None: 'b'}, 'c': {None: 'c'}}
+
+
+def test_build_packages_failure(monkeypatch):
+    package_store = FakePackageStore({'a': [], 'b': ['a'], 'c': []})
+    build_order = [('a', None), ('b', None), ('c', None)]
+    built = []
+
+    def fake_build(package_store, name, variant, clean_after_build):
+        if name == 'a':
+            raise pkgpanda.build.BuildError("a is broken")
+        built.append(name)
+        return name
+
+    monkeypatch.setattr(pkgpanda.build, 'build', fake_build)
+
+    # Fail fast re-raises the original error and starts nothing else.
+    with pytest.raises(pkgpanda.build.BuildError, match='a is broken'):
+        pkgpanda.build.build_packages(package_store, build_order, jobs=1)
+    assert built == []
+
+    # Keep going builds everything which doesn't depend on the failed package.
+    with pytest.raises(pkgpanda.build.BuildError) as exinfo:
+        pkgpanda.build.build_packages(package_store, build_order, jobs=1, keep_going=True)
+    assert built == ['c']
+    assert 'a variant <default> (a is broken)' in str(exinfo.value)
+    assert 'dependency failed: b variant <default>' in str(exinfo.value)
+
+
+def test_file_hash_cache(tmpdir):
+    tmpdir.join("pkg/extra/foo").write("foo contents", ensure=True)
+    tmpdir.join("pkg/extra/baz/bar").write("bar contents", ensure=True)
+    tmpdir.join("pkg/extra/empty").ensure(dir=True)
+    # Make the files old enough to be cached.
+    for path in ("pkg/extra/foo", "pkg/extra/baz/bar"):
+        tmpdir.join(path).setmtime(1000000000)
+
+    extra = str(tmpdir.join("pkg/extra"))
+    work_dir = str(tmpdir.join("pkg"))
+    cache_file = str(tmpdir.join("cache/file_hashes.json"))
+    expected = pkgpanda.build.hash_folder_abs(extra, work_dir)
+
+    cache = pkgpanda.build.FileHashCache(cache_file)
+    assert pkgpanda.build.hash_folder_abs(extra, work_dir, cache) == expected
+    # New digests are only written out by save().
+    assert not tmpdir.join("cache/file_hashes.json").check()
+    cache.save()
+    assert set(json.loads(tmpdir.join("cache/file_hashes.json").read()).keys()) == {
+        str(tmpdir.join("pkg/extra/foo")), str(tmpdir.join("pkg/extra/baz/bar"))}
+
+    # Hits in a fresh cache loaded from disk don't re-read the files.
+    sha1_calls = []
+    real_sha1 = pkgpanda.util.sha1
+
+    def fake_sha1(path):
+        sha1_calls.append(path)
+        return real_sha1(path)
+
+    cache = pkgpanda.build.FileHashCache(cache_file)
+    with mock.patch('pkgpanda.util.sha1', side_effect=fake_sha1):
+        assert pkgpanda.build.hash_folder_abs(extra, work_dir, cache) == expected
+        assert sha1_calls == []
+
+        # A changed file is re-hashed.
+        tmpdir.join("pkg/extra/foo").write("new foo contents")
+        tmpdir.join("pkg/extra/foo").setmtime(1000000001)
+        assert pkgpanda.build.hash_folder_abs(extra, work_dir, cache) != expected
+        assert sha1_calls == [str(tmpdir.join("pkg/extra/foo"))]
+    cache.save()
+
+    # Entries for files which were removed are dropped when the cache is loaded.
+    tmpdir.join("pkg/extra/baz/bar").remove()
+    pkgpanda.build.FileHashCache(cache_file).save()
+    assert set(json.loads(tmpdir.join("cache/file_hashes.json").read()).keys()) == {
+        str(tmpdir.join("pkg/extra/foo"))}
+
+
+def make_tree(tmpdir):
+    tmpdir.join("treeinfo.json").write("{}")
+    tmpdir.join("base/buildinfo.json").write("{}", ensure=True)
+    tmpdir.join("base/build").write("#!/bin/bash\n")
+    tmpdir.join("downstream/buildinfo.json").write(json.dumps({"requires": ["base"]}), ensure=True)
+    tmpdir.join("downstream/build").write("#!/bin/bash\n")
+    tmpdir.join("downstream/extra/foo").write("foo contents", ensure=True)
+
+
+def test_plan_tree(tmpdir, monkeypatch):
+    make_tree(tmpdir)
+    monkeypatch.setattr(pkgpanda.build, 'get_docker_id', lambda docker_name: 'sha256:docker-id')
+
+    package_store = pkgpanda.build.PackageStore(str(tmpdir), None)
+    plan = pkgpanda.build.plan_tree(package_store, None)
+    assert list(plan['packages'].keys()) == [('base', None), ('downstream', None)]
+    assert [info['status'] for info in plan['packages'].values()] == ['build', 'build']
+    base_id = pkgpanda.PackageId(plan['packages'][('base', None)]['id'])
+    downstream_id = pkgpanda.PackageId(plan['packages'][('downstream', None)]['id'])
+    assert plan['bootstraps'][None] == {
+        'id': pkgpanda.util.hash_checkout([str(base_id), str(downstream_id)]),
+        'status': 'build',
+    }
+    # Nothing was built.
+    assert not tmpdir.join("cache/packages/base/latest").check()
+
+    # A package tarball in the local cache is a local hit.
+    tmpdir.join("cache/packages/base/{}.tar.xz".format(base_id)).write("", ensure=True)
+    plan = pkgpanda.build.plan_tree(package_store, None)
+    assert plan['packages'][('base', None)] == {'id': str(base_id), 'status': 'local'}
+    assert plan['packages'][('downstream', None)] == {'id': str(downstream_id), 'status': 'build'}
+
+    # A package tarball in the repository is a remote hit.
+    tmpdir.join("repo/packages/downstream/{}.tar.xz".format(downstream_id)).write("", ensure=True)
+    package_store = pkgpanda.build.PackageStore(str(tmpdir), 'file://' + str(tmpdir.join("repo")))
+    plan = pkgpanda.build.plan_tree(package_store, None)
+    assert plan['packages'][('downstream', None)] == {'id': str(downstream_id), 'status': 'remote'}
+
+
+def test_plan_tree_missing_docker_image(tmpdir, monkeypatch):
+    make_tree(tmpdir)
+
+    def missing_docker_id(docker_name):
+        raise pkgpanda.build.CalledProcessError(1, ['docker', 'inspect'])
+
+    monkeypatch.setattr(pkgpanda.build, 'get_docker_id', missing_docker_id)
+
+    package_store = pkgpanda.build.PackageStore(str(tmpdir), None)
+    plan = pkgpanda.build.plan_tree(package_store, None)
+    assert plan['packages'][('base', None)] == {'id': None, 'status': 'unknown'}
+    assert plan['packages'][('downstream', None)] == {'id': None, 'status': 'unknown'}
+    assert plan['bootstraps'][None] == {'id': None, 'status': 'unknown'}
+
+
+def test_prefetch_plan(tmpdir, monkeypatch):
+    make_tree(tmpdir)
+    monkeypatch.setattr(pkgpanda.build, 'get_docker_id', lambda docker_name: 'sha256:docker-id')
+
+    package_store = pkgpanda.build.PackageStore(str(tmpdir), None)
+    plan = pkgpanda.build.plan_tree(package_store, None)
+    pkg_ids = [info['id'] for info in plan['packages'].values()]
+    bootstrap_id = plan['bootstraps'][None]['id']
+
+    repo = tmpdir.join("repo")
+    for pkg_id in pkg_ids:
+        repo.join("packages/{}/{}.tar.xz".format(pkgpanda.PackageId(pkg_id).name, pkg_id)).write(
+            pkg_id, ensure=True)
+    repo.join("bootstrap/{}.bootstrap.tar.xz".format(bootstrap_id)).write("bootstrap", ensure=True)
+    repo.join("bootstrap/{}.active.json".format(bootstrap_id)).write(json.dumps(pkg_ids))
+
+    package_store = pkgpanda.build.PackageStore(str(tmpdir), 'file://' + str(repo))
+    plan = pkgpanda.build.plan_tree(package_store, None)
+    assert pkgpanda.build.prefetch_plan(package_store, plan, jobs=4) == []
+
+    for pkg_id in pkg_ids:
+        assert tmpdir.join("cache/packages/{}/{}.tar.xz".format(pkgpanda.PackageId(pkg_id).name, pkg_id)).read() == \
+            pkg_id
+    assert tmpdir.join("cache/bootstrap/{}.bootstrap.tar.xz".format(bootstrap_id)).check()
+
+    plan = pkgpanda.build.plan_tree(package_store, None)
+    assert [info['status'] for info in plan['packages'].values()] == ['local', 'local']
+    assert plan['bootstraps'][None]['status'] == 'local'
+
+
+def test_prefetch_bad_active_json(tmpdir):
+    make_tree(tmpdir)
+    repo = tmpdir.join("repo")
+    repo.join("bootstrap/abc.bootstrap.tar.xz").write("bootstrap", ensure=True)
+    repo.join("bootstrap/abc.active.json").write(json.dumps(['foo--bar']))
+
+    package_store = pkgpanda.build.PackageStore(str(tmpdir), 'file://' + str(repo))
+    assert package_store.prefetch([], ['abc']) == ['abc']
+    assert not tmpdir.join("cache/bootstrap/abc.active.json").check()
+    assert not tmpdir.join("cache/bootstrap/abc.bootstrap.tar.xz").check()
+
+
+def test_make_install_dir_cached(tmpdir, monkeypatch):
+    tmpdir.join("packages").ensure(dir=True)
+    package_store = pkgpanda.build.PackageStore(str(tmpdir.join("packages")), None)
+    for pkg_id in ["a--1", "b--1"]:
+        src = tmpdir.join("src", pkg_id)
+        src.join("bin", pkg_id.split("--")[0]).write("", ensure=True)
+        src.join("pkginfo.json").write("{}")
+        tarball = package_store.get_package_path(pkgpanda.PackageId(pkg_id))
+        pkgpanda.util.make_directory(tmpdir.join("packages", "cache", "packages", pkg_id.split("--")[0]).strpath)
+        pkgpanda.util.make_tar(tarball, str(src))
+
+    extracted = []
+    real_extract_tarball = pkgpanda.build.extract_tarball
+
+    def extract_tarball(path, target):
+        extracted.append(path)
+        real_extract_tarball(path, target)
+    monkeypatch.setattr(pkgpanda.build, 'extract_tarball', extract_tarball)
+
+    install_dirs = []
+    for deps in [["a--1", "b--1"], ["a--1", "b--1"], ["a--1"]]:
+        repository = pkgpanda.build._get_dependency_repository(package_store, deps)
+        install_dirs.append(pkgpanda.build._make_install_dir(package_store, repository, deps))
+
+    # Each package was extracted once.
+    assert sorted(os.path.basename(path) for path in extracted) == ["a--1.tar.xz", "b--1.tar.xz"]
+    # Builds get their own copy of the install root.
+    assert len(set(install_dirs)) == 3
+    for install_dir, deps in zip(install_dirs, [["a--1", "b--1"], ["a--1", "b--1"], ["a--1"]]):
+        assert sorted(os.listdir(os.path.join(install_dir, "packages"))) == deps
+        assert os.readlink(os.path.join(install_dir, "bin", "a")) == "/opt/mesosphere/packages/a--1/bin/a"
+    assert not os.path.exists(os.path.join(install_dirs[2], "bin", "b"))
+    # One install root is cached per set of dependencies, whatever their order.
+    install_roots = os.path.join(package_store.get_dependency_cache_dir(), "install_roots")
+    assert len(os.listdir(install_roots)) == 2
+    install_dirs.append(pkgpanda.build._make_install_dir(package_store, repository, ["b--1", "a--1"]))
+    assert len(os.listdir(install_roots)) == 2
+
+    # Files are hardlinked from the cached install root.
+    cached_root = os.path.join(install_roots, pkgpanda.build.hash_checkout(["a--1", "b--1"]))
+    assert os.path.samefile(os.path.join(install_dirs[-1], "environment"), os.path.join(cached_root, "environment"))
+
+    # Only the most recently used install roots are kept.
+    install_dirs.append(pkgpanda.build._make_install_dir(package_store, repository, ["a--1"], max_cached=1))
+    assert os.listdir(install_roots) == [pkgpanda.util.hash_checkout(["a--1"])]
+    # Extracted packages are kept while an install root uses them.
+    packages = os.path.join(package_store.get_dependency_cache_dir(), "packages")
+    assert sorted(os.listdir(packages)) == ["a--1", "b--1"]
+
+    for install_dir in install_dirs:
+        pkgpanda.util.remove_directory(install_dir)
+    pkgpanda.util.remove_directory(pkgpanda.build._make_install_dir(package_store, repository, ["a--1"], max_cached=1))
+    assert os.listdir(packages) == ["a--1"]
+
+
+def test_docker_id_cached(tmpdir, monkeypatch):
+    tmpdir.join("packages").ensure(dir=True)
+    lookups = []
+
+    def get_or_pull_docker_id(docker_name):
+        lookups.append(docker_name)
+        return 'sha256:' + docker_name
+    monkeypatch.setattr(pkgpanda.build, 'get_or_pull_docker_id', get_or_pull_docker_id)
+
+    package_store = pkgpanda.build.PackageStore(str(tmpdir.join("packages")), None)
+    assert package_store.get_docker_id('a') == 'sha256:a'
+    assert package_store.get_docker_id('b') == 'sha256:b'
+    assert package_store.get_docker_id('a') == 'sha256:a'
+    assert lookups == ['a', 'b']
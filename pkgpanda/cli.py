@@ -8,15 +8,26 @@ Usage:
   pkgpanda add <package-tarball> [options]
   pkgpanda list [options]
   pkgpanda remove <id>... [options]
+  pkgpanda gc [options]
   pkgpanda setup [options]
   pkgpanda uninstall [options]
-  pkgpanda check [--list] [options]
+  pkgpanda check [--list] [--json] [--check-jobs=<jobs>] [--check-timeout=<seconds>] [options]
 
 Options:
     --config-dir=<conf-dir>     Use an alternate directory for finding machine
                                 configuration (roles, setup flags). [default: {default_config_dir}]
     --no-systemd                Don't try starting/stopping systemd services
     --no-block-systemd          Don't block waiting for systemd services to come up.
+    --dry-run                   Print which systemd services `activate` or `swap` would
+                                restart, without changing the active packages.
+    --fetch-jobs=<jobs>         Number of packages `pkgpanda setup` downloads and
+                                extracts at once [default: 4]
+    --check-jobs=<jobs>         Number of checks `pkgpanda check` runs at once [default: 4]
+    --check-timeout=<seconds>   Seconds after which `pkgpanda check` kills a check and
+                                counts it as failed, 0 for no timeout [default: 0]
+    --json                      Print a JSON report of the checks rather than their output
+    --verify-state-dir-owners   Check the owner of everything in package state directories
+                                which already belong to the package user, not just the top
     --root=<root>               Testing only: Use an alternate root [default: {default_root}]
     --state-dir-root=<root>     Testing only: Use an alternate package state directory root
                                 [default: {default_state_dir_root}]
@@ -27,18 +38,22 @@ Options:
     --silent                    Do not log anything
 """
 
+import json
 import logging
 import os
+import signal
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import groupby
 from os import umask
-from subprocess import CalledProcessError, check_call
+from subprocess import PIPE, Popen, TimeoutExpired
 
 from docopt import docopt
 
 from pkgpanda import actions, constants, Install, PackageId, Repository
 from pkgpanda.exceptions import PackageError, PackageNotFound, ValidationError
-from pkgpanda.util import remove_directory, remove_file
+from pkgpanda.util import is_windows, remove_directory, remove_file
 
 
 def print_repo_list(packages):
@@ -116,17 +131,83 @@ def list_checks(checks):
             print(' - {}'.format(check_file))
 
 
-def run_checks(checks, install, repository):
-    exit_code = 0
+def run_check(path, timeout):
+    """Run the check executable at path, killing it after timeout seconds unless timeout is None.
+
+    Returns the result of the check as a dict.
+    """
+    start = time.monotonic()
+    # Checks run in their own session so that anything they start is killed with them on timeout.
+    proc = Popen([path], stdout=PIPE, stderr=PIPE, start_new_session=not is_windows)
+    timed_out = False
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except TimeoutExpired:
+        timed_out = True
+        try:
+            if is_windows:
+                proc.kill()
+            else:
+                os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # The check and everything it started exited in the meantime.
+            pass
+        stdout, stderr = proc.communicate()
+    return {
+        'returncode': proc.returncode,
+        'timed_out': timed_out,
+        'duration': time.monotonic() - start,
+        'stdout': stdout.decode(errors='replace'),
+        'stderr': stderr.decode(errors='replace'),
+    }
+
+
+def run_checks(checks, install, repository, jobs=1, timeout=None, json_report=False):
+    """Run checks, up to jobs at once, and report their results.
+
+    The output of each check is printed once it has finished, in the same
+    order as if they ran one after the other. If json_report, a JSON report of
+    the results is printed instead. Returns 0 if all checks passed, else 1.
+    """
+    to_run = []
     for pkg_id, check_files in sorted(checks.items()):
         check_dir = repository.load(pkg_id).check_dir
         for check_file in check_files:
-            try:
-                check_call([os.path.join(check_dir, check_file)])
-            except CalledProcessError:
+            to_run.append((pkg_id, check_file, os.path.join(check_dir, check_file)))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_check, path, timeout) for _, _, path in to_run]
+
+        results = []
+        for (pkg_id, check_file, _), future in zip(to_run, futures):
+            result = dict(future.result(), package=pkg_id, check=check_file)
+            result['passed'] = result['returncode'] == 0 and not result['timed_out']
+            results.append(result)
+            if json_report:
+                continue
+            sys.stdout.write(result['stdout'])
+            sys.stdout.flush()
+            sys.stderr.write(result['stderr'])
+            if result['timed_out']:
+                print('Check timed out after {}s: {}'.format(timeout, check_file), file=sys.stderr)
+            elif not result['passed']:
                 print('Check failed: {}'.format(check_file), file=sys.stderr)
-                exit_code = 1
-    return exit_code
+
+    passed = all(result['passed'] for result in results)
+    if json_report:
+        print(json.dumps({'passed': passed, 'checks': results}, indent=2, sort_keys=True))
+    return 0 if passed else 1
+
+
+def get_positive_int(arguments, option, allow_zero=False):
+    try:
+        value = int(arguments[option])
+    except ValueError:
+        value = -1
+    if value < 0 or (value == 0 and not allow_zero):
+        raise ValidationError("{} must be a {} integer, got {}".format(
+            option, "non-negative" if allow_zero else "positive", arguments[option]))
+    return value
 
 
 def main():
@@ -153,13 +234,14 @@ def main():
         manage_users=True,
         add_users=not os.path.exists('/etc/mesosphere/manual_host_users'),
         manage_state_dir=True,
-        state_dir_root=os.path.abspath(arguments['--state-dir-root']))
+        state_dir_root=os.path.abspath(arguments['--state-dir-root']),
+        verify_state_dir_owners=arguments['--verify-state-dir-owners'])
 
-    repository = Repository(os.path.abspath(arguments['--repository']))
+    repository = Repository(os.path.abspath(arguments['--repository']), dedup=actions.get_dedup(install))
 
     try:
         if arguments['setup']:
-            actions.setup(install, repository)
+            actions.setup(install, repository, get_positive_int(arguments, '--fetch-jobs'))
             sys.exit(0)
 
         if arguments['list']:
@@ -190,7 +272,8 @@ def main():
                 repository,
                 arguments['<id>'],
                 not arguments['--no-systemd'],
-                not arguments['--no-block-systemd'])
+                not arguments['--no-block-systemd'],
+                arguments['--dry-run'])
             sys.exit(0)
 
         if arguments['swap']:
@@ -199,7 +282,8 @@ def main():
                 repository,
                 arguments['<package-id>'],
                 not arguments['--no-systemd'],
-                not arguments['--no-block-systemd'])
+                not arguments['--no-block-systemd'],
+                arguments['--dry-run'])
             sys.exit(0)
 
         if arguments['remove']:
@@ -210,6 +294,12 @@ def main():
                     pass
             sys.exit(0)
 
+        if arguments['gc']:
+            removed, freed = repository.gc()
+            print("Removed {} unused objects from the package object store, freeing {:.1f} MiB".format(
+                removed, freed / 2**20))
+            sys.exit(0)
+
         if arguments['uninstall']:
             uninstall(install, repository)
             sys.exit(0)
@@ -220,7 +310,14 @@ def main():
                 list_checks(checks)
                 sys.exit(0)
             # Run all checks
-            sys.exit(run_checks(checks, install, repository))
+            timeout = get_positive_int(arguments, '--check-timeout', allow_zero=True) or None
+            sys.exit(run_checks(
+                checks,
+                install,
+                repository,
+                jobs=get_positive_int(arguments, '--check-jobs'),
+                timeout=timeout,
+                json_report=arguments['--json']))
     except ValidationError as ex:
         print("Validation Error: {0}".format(ex), file=sys.stderr)
         sys.exit(1)
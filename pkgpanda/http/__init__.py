@@ -4,16 +4,24 @@ import http.client
 import logging
 import os
 import sys
+import tempfile
+import threading
 
-from flask import current_app, Flask, jsonify, make_response, request
+from flask import current_app, Flask, jsonify, make_response, request, Response, url_for
 
-from pkgpanda import actions, Install, Repository
+from pkgpanda import actions, Install, PackageId, Repository
 from pkgpanda.exceptions import (PackageConflict, PackageError,
                                  PackageNotFound, ValidationError)
+from pkgpanda.http.jobs import JobQueue
+from pkgpanda.util import extract_tarball, iter_tar
 
 
 empty_response = ('', http.client.NO_CONTENT)
 
+# Activations (and the removals which check the active packages) must not
+# run at the same time, whether they come from a request or a job.
+activation_lock = threading.Lock()
+
 
 def package_listing_response(package_ids):
     return jsonify(sorted(package_ids))
@@ -37,6 +45,42 @@ def package_not_found_response(package_id):
     return error_response('Package {} not found.'.format(package_id))
 
 
+def job_response(job):
+    response = jsonify(job.to_json())
+    response.status_code = http.client.ACCEPTED
+    response.headers['Location'] = url_for('get_job', job_id=job.id)
+    return response
+
+
+def is_async():
+    return request.args.get('async', '').lower() in ('1', 'true')
+
+
+def fetch_job(repository, repository_url, package_id, work_dir, peer_urls=()):
+    """Return a job function which fetches package_id, reporting the bytes downloaded.
+
+    Packages are fetched like `pkgpanda setup` does (see actions.download_package),
+    so peers are tried before repository_url.
+    """
+    def run(job):
+        if repository.has_package(package_id):
+            job.set_stage('done')
+            return
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            job.set_stage('download')
+            job.watched_files['bytes_downloaded'] = os.path.join(tmp_dir, package_id + '.tar.xz')
+            tarball = actions.download_package(repository, repository_url, package_id, tmp_dir, work_dir, peer_urls)
+            job.watched_files.clear()
+            if tarball is None:
+                job.progress['bytes_downloaded'] = 0
+            else:
+                job.progress['bytes_downloaded'] = os.path.getsize(tarball)
+                job.set_stage('extract')
+                repository.add(lambda id_, target: extract_tarball(tarball, target), package_id, warn_added=False)
+        job.set_stage('done')
+    return run
+
+
 def package_response(package_id, repository):
     try:
         package = repository.load(package_id)
@@ -88,6 +132,14 @@ def uncaught_exception_handler(exc):
 
 @app.before_request
 def set_app_attrs_from_config():
+    # Install and Repository cache the package list, the active packages and
+    # loaded packages, and notice changes made by other processes, so they are
+    # only created again if the config changes.
+    state_config = tuple(current_app.config[key] for key in [
+        'DCOS_ROOT', 'DCOS_CONFIG_DIR', 'DCOS_ROOTED_SYSTEMD', 'DCOS_STATE_DIR_ROOT', 'DCOS_REPO_DIR'])
+    if getattr(current_app, 'state_config', None) == state_config:
+        return
+
     current_app.install = Install(
         current_app.config['DCOS_ROOT'],
         current_app.config['DCOS_CONFIG_DIR'],
@@ -97,7 +149,14 @@ def set_app_attrs_from_config():
         manage_state_dir=True,
         state_dir_root=current_app.config['DCOS_STATE_DIR_ROOT'])
     current_app.repository = Repository(
-        current_app.config['DCOS_REPO_DIR'])
+        current_app.config['DCOS_REPO_DIR'], dedup=actions.get_dedup(current_app.install))
+    current_app.state_config = state_config
+
+
+@app.before_request
+def create_job_queue():
+    if getattr(current_app, 'jobs', None) is None:
+        current_app.jobs = JobQueue(max_workers=current_app.config['JOB_WORKERS'])
 
 
 @app.before_request
@@ -105,6 +164,15 @@ def create_work_dir():
     os.makedirs(current_app.config['WORK_DIR'], exist_ok=True)
 
 
+@app.after_request
+def add_etag(response):
+    """Let clients polling the API revalidate with If-None-Match and get a 304 if nothing changed."""
+    if request.method != 'GET' or response.status_code != http.client.OK or response.is_streamed:
+        return response
+    response.add_etag()
+    return response.make_conditional(request)
+
+
 @app.route('/repository/', methods=['GET'])
 def get_package_list():
     return package_listing_response(current_app.repository.list())
@@ -115,6 +183,20 @@ def get_package(package_id):
     return package_response(package_id, current_app.repository)
 
 
+@app.route('/repository/<package_id>/tarball', methods=['GET'])
+def get_package_tarball(package_id):
+    response = make_response(
+        package_response(package_id, current_app.repository)
+    )
+
+    if response.status_code != http.client.OK:
+        return response
+
+    return Response(
+        iter_tar(current_app.repository.package_path(package_id)),
+        mimetype='application/x-tar')
+
+
 @app.route('/repository/<package_id>', methods=['POST'])
 def fetch_package(package_id):
     try:
@@ -129,6 +211,15 @@ def fetch_package(package_id):
         )
 
     try:
+        if is_async():
+            PackageId(package_id)
+            # Identical fetches which are already running are joined rather than started again.
+            return job_response(current_app.jobs.submit(
+                'fetch',
+                ('fetch', package_id, repository_url),
+                fetch_job(current_app.repository, repository_url, package_id, current_app.config['WORK_DIR'],
+                          actions.get_peer_urls(current_app.install))))
+
         actions.fetch_package(
             current_app.repository,
             repository_url,
@@ -148,10 +239,11 @@ def fetch_package(package_id):
 @app.route('/repository/<package_id>', methods=['DELETE'])
 def remove_package(package_id):
     try:
-        actions.remove_package(
-            current_app.install,
-            current_app.repository,
-            package_id)
+        with activation_lock:
+            actions.remove_package(
+                current_app.install,
+                current_app.repository,
+                package_id)
     except PackageNotFound:
         response = (
             package_not_found_response(package_id),
@@ -216,22 +308,38 @@ def activate_packages():
             http.client.CONFLICT,
         )
 
-    # This will stop all DC/OS services, including this app. Use a web server
-    # that supports graceful shutdown to ensure that activation is completed
-    # and a response is returned.
+    # Activation stops the DC/OS services which change, this app included, so
+    # it runs within the request rather than in a background job, which would
+    # be killed halfway through the swap along with the app.
+    if is_async():
+        return error_response('Activation cannot run as a background job.'), http.client.BAD_REQUEST
+
+    systemd = not current_app.config.get('TESTING')
+    # This will stop the DC/OS services which change, possibly including this
+    # app. Use a web server that supports graceful shutdown to ensure that
+    # activation is completed and a response is returned.
     try:
-        actions.activate_packages(
-            current_app.install,
-            current_app.repository,
-            request.json,
-            systemd=(not current_app.config.get('TESTING')),
-            block_systemd=False)
+        with activation_lock:
+            actions.activate_packages(
+                current_app.install,
+                current_app.repository,
+                request.json,
+                systemd=systemd,
+                block_systemd=False)
     except ValidationError as exc:
         return error_response(str(exc)), http.client.CONFLICT
 
     return empty_response
 
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = current_app.jobs.get(job_id)
+    if job is None:
+        return error_response('Job {} not found.'.format(job_id)), http.client.NOT_FOUND
+    return jsonify(job.to_json())
+
+
 if __name__ == '__main__':
     # TODO(branden): expose app config as cli params
     if '-d' in sys.argv[1:]:
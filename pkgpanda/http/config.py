@@ -11,3 +11,6 @@ DCOS_ROOTED_SYSTEMD = False
 DCOS_STATE_DIR_ROOT = constants.STATE_DIR_ROOT
 
 WORK_DIR = os.path.join(tempfile.gettempdir(), 'pkgpanda_api')
+
+# Number of jobs (e.g. fetches started with `?async=true`) run at the same time.
+JOB_WORKERS = 4
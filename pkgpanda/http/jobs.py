@@ -0,0 +1,116 @@
+"""Background jobs of the Pkgpanda HTTP API.
+
+Fetching packages can take longer than a proxy is willing to wait for a
+response, so the API can run fetches as jobs instead. Clients get the ID of
+the job immediately and follow its progress at `GET /jobs/<id>`. Activation
+restarts the API, which would kill its job, so it isn't run as one.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class Job:
+    """A background job. progress is updated by the job as it runs."""
+
+    def __init__(self, kind, key):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.key = key
+        self.state = 'pending'
+        self.stage = None
+        self.error = None
+        self.progress = {}
+        self.created = time.time()
+        self.finished = None
+        # Files whose size is reported in progress while the job runs, e.g. downloads.
+        self.watched_files = {}
+
+    def set_stage(self, stage):
+        log.info("Job %s: %s", self.id, stage)
+        self.stage = stage
+
+    @property
+    def done(self):
+        return self.state in ('succeeded', 'failed')
+
+    def to_json(self):
+        progress = dict(self.progress)
+        for name, path in self.watched_files.items():
+            try:
+                progress[name] = os.path.getsize(path)
+            except OSError:
+                pass
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'stage': self.stage,
+            'progress': progress,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+class JobQueue:
+    """Runs jobs on a pool of threads.
+
+    Submitting a job with the same key as one which hasn't finished yet
+    returns that job instead of starting another. The most recent
+    max_finished finished jobs are kept so clients can look up their result.
+    """
+
+    def __init__(self, max_workers=4, max_finished=100):
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__lock = threading.Lock()
+        self.__jobs = OrderedDict()
+        self.__running = {}
+        self.__max_finished = max_finished
+
+    def submit(self, kind, key, fn):
+        """Run fn(job) in the background. Returns the Job."""
+        with self.__lock:
+            job = self.__running.get(key)
+            if job is not None:
+                return job
+            job = Job(kind, key)
+            self.__jobs[job.id] = job
+            self.__running[key] = job
+            self.__prune()
+        self.__executor.submit(self.__run, job, fn)
+        return job
+
+    def get(self, job_id):
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+    def __run(self, job, fn):
+        job.state = 'running'
+        try:
+            fn(job)
+        except Exception as ex:
+            log.exception("Job %s failed", job.id)
+            job.error = str(ex)
+            job.state = 'failed'
+        else:
+            job.state = 'succeeded'
+        finally:
+            job.finished = time.time()
+            with self.__lock:
+                del self.__running[job.key]
+
+    def __prune(self):
+        finished = [job.id for job in self.__jobs.values() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.__max_finished)]:
+            del self.__jobs[job_id]
+
+    def shutdown(self):
+        self.__executor.shutdown()
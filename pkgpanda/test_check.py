@@ -1,5 +1,9 @@
+import json
+import os
+from shutil import copytree
 from subprocess import check_output, PIPE, Popen, STDOUT
 
+import pkgpanda.cli
 from pkgpanda.util import resources_test_dir
 
 list_output = """WARNING: `not_executable.py` is not executable
@@ -40,3 +44,52 @@ def test_check_target_run():
     stdout, stderr = cmd.communicate()
     assert stderr.decode() == run_output_stderr
     assert stdout.decode() == run_output_stdout
+
+
+def test_check_target_json_timeout(tmpdir):
+    root = str(tmpdir.join('mesosphere'))
+    copytree(resources_test_dir('opt/mesosphere'), root, symlinks=True)
+    hanging_check = tmpdir.join('mesosphere', 'packages', 'pkg1--12345', 'check', 'hanging_check.sh')
+    hanging_check.write('#!/bin/bash\necho "Hanging"\nsleep 60\n')
+    hanging_check.chmod(0o755)
+
+    cmd = Popen([
+        'pkgpanda',
+        'check',
+        '--json',
+        '--check-timeout', '1',
+        '--root', root,
+        '--repository', os.path.join(root, 'packages')],
+        stdout=PIPE, stderr=PIPE)
+    stdout, stderr = cmd.communicate(timeout=30)
+    assert cmd.returncode == 1
+    report = json.loads(stdout.decode())
+    assert not report['passed']
+    results = {(check['package'], check['check']): check for check in report['checks']}
+    assert sorted(results) == [
+        ('pkg1--12345', 'hanging_check.sh'),
+        ('pkg1--12345', 'hello_world_ok.py'),
+        ('pkg2--12345', 'failed_check.py'),
+        ('pkg2--12345', 'shell_script_check.sh'),
+    ]
+    hanging = results[('pkg1--12345', 'hanging_check.sh')]
+    assert hanging['timed_out'] and not hanging['passed']
+    assert hanging['stdout'] == 'Hanging\n'
+    assert 1 <= hanging['duration'] < 30
+    ok = results[('pkg1--12345', 'hello_world_ok.py')]
+    assert ok['passed'] and ok['returncode'] == 0 and ok['stdout'] == 'Hello World\n'
+
+
+def test_run_check_exited_before_kill(tmpdir, monkeypatch):
+    # The check may exit between timing out and being killed.
+    check = tmpdir.join('check.sh')
+    check.write('#!/bin/bash\nsleep 1\necho "Done"\n')
+    check.chmod(0o755)
+
+    def killpg(pid, sig):
+        raise ProcessLookupError()
+    monkeypatch.setattr(os, 'killpg', killpg)
+
+    result = pkgpanda.cli.run_check(str(check), 0.1)
+    assert result['timed_out']
+    assert result['stdout'] == 'Done\n'
@@ -1,6 +1,15 @@
+import json
+import os
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
 import pytest
 
-from pkgpanda.util import expect_fs, is_windows, resources_test_dir, run
+from pkgpanda import package_contents_digest_path, Repository
+from pkgpanda.actions import fetch_packages
+from pkgpanda.exceptions import FetchError, ValidationError
+from pkgpanda.util import (expect_fs, hash_checkout, is_windows, iter_tar, make_tar, package_contents_digest,
+                           resources_test_dir, run)
 
 fetch_output = """\rFetching: mesos--0.22.0\rFetched: mesos--0.22.0\n"""
 
@@ -47,3 +56,155 @@ def test_add(tmpdir):
             "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
         })
     # TODO(branden): Test unable to add case.
+
+
+# TODO: DCOS_OSS-3467 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_add_dedup(tmpdir):
+    # Files are only stored in the object store if the node has the dedup-packages flag.
+    tmpdir.join("config", "setup-flags", "dedup-packages").ensure()
+    assert run([
+               "pkgpanda",
+               "add",
+               resources_test_dir('remote_repo/packages/mesos/mesos--0.22.0.tar.xz'),
+               "--repository={0}".format(tmpdir.join("repository")),
+               "--config-dir={0}".format(tmpdir.join("config")),
+               ]) == ""
+
+    expect_fs(
+        "{0}".format(tmpdir.join("repository")),
+        {
+            ".objects": None,
+            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
+        })
+
+
+# TODO: DCOS_OSS-3467 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_fetch_packages(tmpdir, capsys):
+    repository = Repository(str(tmpdir))
+    repository_url = "file://{}/".format(os.path.abspath(resources_test_dir("remote_repo")))
+
+    fetch_packages(repository, repository_url, ["mesos--0.22.0", "mesos--0.22.0"], str(tmpdir), jobs=2)
+    expect_fs(
+        "{0}".format(tmpdir),
+        {
+            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
+        })
+    assert "Fetched 1 packages" in capsys.readouterr()[0]
+
+    # Packages already in the repository aren't fetched again.
+    fetch_packages(repository, None, ["mesos--0.22.0"], str(tmpdir))
+
+    with pytest.raises(FetchError):
+        fetch_packages(repository, repository_url, ["mesos--0.22.0", "mesos--missing"], str(tmpdir))
+    assert not tmpdir.join("mesos--missing").check()
+    assert not tmpdir.listdir(lambda path: path.basename.startswith(".add-"))
+
+    with pytest.raises(ValidationError):
+        fetch_packages(repository, None, ["mesos--missing"], str(tmpdir))
+
+
+class MockPeerRequestHandler(BaseHTTPRequestHandler):
+    """Stand-in for the pkgpanda HTTP API of a peer, serving server.packages."""
+
+    def do_GET(self):  # noqa: N802
+        self.server.requests_received += 1
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'repository' or parts[2] != 'tarball' or \
+                parts[1] not in self.server.packages:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-tar')
+        self.end_headers()
+        for chunk in iter_tar(self.server.packages[parts[1]]):
+            self.wfile.write(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mock_peer():
+    server = HTTPServer(('localhost', 0), MockPeerRequestHandler)
+    server.packages = {}
+    server.requests_received = 0
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_built_package(path, name, build_ids):
+    """Make the contents of a package as mkpanda would build it, returning its id."""
+    pkg_id = "{}--{}".format(name, hash_checkout(build_ids))
+    path.join("pkginfo.json").write("{}", ensure=True)
+    path.join("buildinfo.full.json").write(json.dumps({
+        'build_ids': build_ids,
+        'package_version': hash_checkout(build_ids),
+        'name': name,
+    }))
+    path.join("bin/foo").write("foo", ensure=True)
+    return pkg_id
+
+
+def publish_package(origin, pkg_id, src, tarball=True):
+    """Add the package with the contents of src to the repository at origin, with its contents digest."""
+    origin.join(package_contents_digest_path(pkg_id)).write(package_contents_digest(str(src)), ensure=True)
+    if tarball:
+        make_tar(str(origin.join("packages", "foo", pkg_id + ".tar.xz")), str(src))
+
+
+# TODO: DCOS_OSS-3467 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_fetch_packages_from_peer(tmpdir, mock_peer):
+    pkg_id = make_built_package(tmpdir.join("src"), "foo", {'foo': 'bar', 'requires': []})
+    mock_peer.packages[pkg_id] = str(tmpdir.join("src"))
+    peer_url = "http://localhost:{}".format(mock_peer.server_port)
+
+    # The origin only has the digest of the package, so the package can only come from the peer.
+    origin = tmpdir.join("origin")
+    publish_package(origin, pkg_id, tmpdir.join("src"), tarball=False)
+    repository = Repository(str(tmpdir.join("repository")))
+    fetch_packages(repository, "file://{}".format(origin), [pkg_id], str(tmpdir), peer_urls=[peer_url])
+    assert tmpdir.join("repository", pkg_id, "bin/foo").read() == "foo"
+
+
+# TODO: DCOS_OSS-3467 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_fetch_packages_peer_fallback(tmpdir, mock_peer):
+    pkg_id = make_built_package(tmpdir.join("src"), "foo", {'foo': 'bar', 'requires': []})
+    origin = tmpdir.join("origin")
+    publish_package(origin, pkg_id, tmpdir.join("src"))
+
+    # The peer serves the package with the right buildinfo, but a changed file.
+    tmpdir.join("src").copy(tmpdir.join("other"))
+    tmpdir.join("other", "bin/foo").write("evil")
+    mock_peer.packages[pkg_id] = str(tmpdir.join("other"))
+    peer_url = "http://localhost:{}".format(mock_peer.server_port)
+    # Nothing listens on this peer.
+    down_peer_url = "http://localhost:1"
+
+    repository = Repository(str(tmpdir.join("repository")))
+    fetch_packages(
+        repository, "file://{}".format(origin), [pkg_id], str(tmpdir), peer_urls=[down_peer_url, peer_url])
+    assert mock_peer.requests_received == 1
+    assert tmpdir.join("repository", pkg_id, "bin/foo").read() == "foo"
+    assert tmpdir.join("repository").listdir() == [tmpdir.join("repository", pkg_id)]
+
+
+# TODO: DCOS_OSS-3467 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_fetch_packages_without_contents_digest(tmpdir, mock_peer):
+    pkg_id = make_built_package(tmpdir.join("src"), "foo", {'foo': 'bar', 'requires': []})
+    origin = tmpdir.join("origin")
+    make_tar(str(origin.join("packages", "foo").ensure(dir=True).join(pkg_id + ".tar.xz")), str(tmpdir.join("src")))
+    mock_peer.packages[pkg_id] = str(tmpdir.join("src"))
+    peer_url = "http://localhost:{}".format(mock_peer.server_port)
+
+    # Without a digest to check them against, peers aren't asked for the package.
+    repository = Repository(str(tmpdir.join("repository")))
+    fetch_packages(repository, "file://{}".format(origin), [pkg_id], str(tmpdir), peer_urls=[peer_url])
+    assert mock_peer.requests_received == 0
+    assert tmpdir.join("repository", pkg_id, "bin/foo").read() == "foo"
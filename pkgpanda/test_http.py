@@ -1,11 +1,15 @@
 import json
 import operator
 import os
+import tarfile
+import threading
+import time
 from shutil import copytree
 
 import pytest
 
 from pkgpanda.http import app
+from pkgpanda.http.jobs import JobQueue
 from pkgpanda.util import is_windows, resources_test_dir
 
 
@@ -118,6 +122,24 @@ def test_get_package():
     assert_error(client.get('/repository/!@#*'), 404)
 
 
+# TODO: DCOS_OSS-3468 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_get_package_tarball(tmpdir):
+    _set_test_config(app)
+    client = app.test_client()
+
+    response = client.get('/repository/mesos--0.22.0/tarball')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/x-tar'
+    tarball = tmpdir.join('mesos.tar')
+    tarball.write_binary(response.data)
+    with tarfile.open(str(tarball)) as tar:
+        assert './pkginfo.json' in tar.getnames()
+
+    assert_error(client.get('/repository/nonexistent-package--fakeversion/tarball'), 404)
+    assert_error(client.get('/repository/packageversion/tarball'), 404)
+
+
 # TODO: DCOS_OSS-3468 - muted Windows tests requiring investigation
 @pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
 def test_list_active_packages():
@@ -287,3 +309,130 @@ def test_remove_package(tmpdir):
     # Attempted deletion of nonexistent package.
     assert_error(client.delete('/repository/nonexistent-package--fakeversion'), 404)
     assert_error(client.delete('/repository/invalid---package'), 404)
+
+
+# TODO: DCOS_OSS-3468 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_etag(tmpdir):
+    _set_test_config(app)
+    repo_dir = str(tmpdir.join('packages'))
+    copytree(resources_test_dir('packages'), repo_dir, symlinks=True)
+    app.config['DCOS_REPO_DIR'] = repo_dir
+    client = app.test_client()
+
+    response = client.get('/repository/')
+    etag = response.headers['ETag']
+    assert_response(client.get('/repository/', headers={'If-None-Match': etag}), 304, b'')
+
+    # Changes made outside of the API are picked up.
+    copytree(os.path.join(repo_dir, 'mesos--0.23.0'), os.path.join(repo_dir, 'mesos--0.24.0'))
+    response = client.get('/repository/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert 'mesos--0.24.0' in json.loads(response.data.decode('utf-8'))
+
+    etag = client.get('/active/').headers['ETag']
+    assert_response(client.get('/active/', headers={'If-None-Match': etag}), 304, b'')
+    etag = client.get('/repository/mesos--0.22.0').headers['ETag']
+    assert_response(client.get('/repository/mesos--0.22.0', headers={'If-None-Match': etag}), 304, b'')
+
+
+def _wait_for_job(client, response):
+    assert response.status_code == 202
+    location = response.headers['Location']
+    for _ in range(100):
+        job = json.loads(client.get(location).data.decode('utf-8'))
+        if job['state'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.1)
+    raise AssertionError('Job {} did not finish'.format(location))
+
+
+# TODO: DCOS_OSS-3468 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_async_fetch(tmpdir):
+    _set_test_config(app)
+    install_dir = str(tmpdir.join('install'))
+    copytree(resources_test_dir('install'), install_dir, symlinks=True)
+    app.config['DCOS_ROOT'] = install_dir
+    app.config['DCOS_ROOTED_SYSTEMD'] = True
+    repo_dir = str(tmpdir.join('repo'))
+    copytree(resources_test_dir('packages'), repo_dir, symlinks=True)
+    app.config['DCOS_REPO_DIR'] = repo_dir
+    os.rename(os.path.join(repo_dir, 'mesos--0.22.0'), str(tmpdir.join('mesos--0.22.0')))
+    client = app.test_client()
+
+    remote_repo = 'file://{}/{}/'.format(os.getcwd(), resources_test_dir('remote_repo'))
+    job = _wait_for_job(client, client.post(
+        '/repository/mesos--0.22.0?async=true',
+        content_type='application/json',
+        data=json.dumps({'repository_url': remote_repo})))
+    assert job['kind'] == 'fetch'
+    assert job['state'] == 'succeeded', job['error']
+    assert job['progress']['bytes_downloaded'] > 0
+    assert 'mesos--0.22.0' in json.loads(client.get('/repository/').data.decode('utf-8'))
+
+    # Packages which are already in the repository aren't downloaded again.
+    job = _wait_for_job(client, client.post(
+        '/repository/mesos--0.22.0?async=true',
+        content_type='application/json',
+        data=json.dumps({'repository_url': 'file:///nonexistent/'})))
+    assert job['state'] == 'succeeded', job['error']
+    assert 'bytes_downloaded' not in job['progress']
+
+    new_packages = [
+        'mesos--0.23.0',
+        'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8',
+    ]
+    # Activation restarts the API, so it can't be left to a background job.
+    assert_error(client.put(
+        '/active/?async=true', content_type='application/json', data=json.dumps(new_packages)), 400)
+    assert client.put('/active/', content_type='application/json', data=json.dumps(new_packages)).status_code == 204
+    assert_json_response(client.get('/active/'), 200, new_packages)
+
+    job = _wait_for_job(client, client.post(
+        '/repository/mesos--0.24.0?async=true',
+        content_type='application/json',
+        data=json.dumps({'repository_url': remote_repo})))
+    assert job['state'] == 'failed'
+    assert job['error']
+
+    assert_error(client.get('/jobs/nonexistent'), 404)
+    assert_error(client.post(
+        '/repository/invalid---package?async=true',
+        content_type='application/json',
+        data=json.dumps({'repository_url': remote_repo})), 400)
+
+
+def test_job_queue_dedup():
+    jobs = JobQueue(max_workers=2, max_finished=1)
+    release = threading.Event()
+    runs = []
+
+    def run(job):
+        runs.append(job.id)
+        release.wait(10)
+
+    first = jobs.submit('fetch', ('fetch', 'a--1'), run)
+    assert jobs.submit('fetch', ('fetch', 'a--1'), run) is first
+    other = jobs.submit('fetch', ('fetch', 'b--1'), run)
+    assert other is not first
+    release.set()
+    jobs.shutdown()
+    assert sorted(runs) == sorted([first.id, other.id])
+    assert first.state == other.state == 'succeeded'
+
+    # A finished job doesn't stop the same job from running again. Only the
+    # most recent finished jobs are kept.
+    jobs = JobQueue(max_workers=1, max_finished=1)
+    first = jobs.submit('fetch', ('fetch', 'a--1'), run)
+    while not first.done:
+        time.sleep(0.01)
+    second = jobs.submit('fetch', ('fetch', 'a--1'), run)
+    assert second is not first
+    while not second.done:
+        time.sleep(0.01)
+    jobs.submit('fetch', ('fetch', 'b--1'), run)
+    assert jobs.get(first.id) is None
+    assert jobs.get(second.id) is second
+    jobs.shutdown()
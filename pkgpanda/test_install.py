@@ -1,9 +1,12 @@
 """ Test reading and changing the active set of available packages"""
 
+import json
+import os
 import shutil
 
 import pytest
 
+import pkgpanda
 from pkgpanda import Install, Repository
 from pkgpanda.util import expect_fs, is_windows, resources_test_dir
 
@@ -96,3 +99,218 @@ def test_recovery_move_new(tmpdir):
             "include": [".gitignore"],
             "lib": ["libmesos.so"]
         })
+
+
+def _make_package(repo_dir, pkg_id, files):
+    for path, contents in files.items():
+        repo_dir.join(pkg_id, path).write(contents, ensure=True)
+    repo_dir.join(pkg_id, "pkginfo.json").write(json.dumps({"environment": {pkg_id.split('--')[0].upper(): pkg_id}}))
+
+
+def _link_trees(root):
+    """Return {path: symlink target} of the well known directories of an install root."""
+    result = {}
+    for name in ["bin", "etc", "include", "lib", "dcos.target.wants", "active"]:
+        for dir_path, dirs, files in os.walk(str(root.join(name))):
+            for entry in dirs + files:
+                path = os.path.join(dir_path, entry)
+                result[os.path.relpath(path, str(root))] = os.readlink(path) if os.path.islink(path) else None
+    return result
+
+
+# TODO: DCOS_OSS-3471 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_activate_incremental(tmpdir, monkeypatch):
+    repo_dir = tmpdir.join("repository")
+    tmpdir.join("config", "roles", "master").ensure()
+    _make_package(repo_dir, "a--1", {
+        "bin/a": "a1", "lib/python/a/__init__.py": "", "bin_master/a-master": "",
+        "dcos.target.wants_master/dcos-a.service": "[Unit]"})
+    _make_package(repo_dir, "a--2", {"bin/a": "a2", "lib/python/a2/__init__.py": ""})
+    _make_package(repo_dir, "b--1", {"bin/b": "b", "lib/python/b/__init__.py": "", "etc/b.conf": ""})
+    _make_package(repo_dir, "c--1", {"lib/libc.so": "", "include/c/c.h": ""})
+    repository = Repository(str(repo_dir))
+
+    def activate(root, ids, incremental):
+        root.ensure(dir=True)
+        install = Install(str(root), str(tmpdir.join("config")), True, False, False)
+        install.activate(repository.load_packages(ids), incremental=incremental)
+        return install
+
+    activate(tmpdir.join("incremental"), ["a--1", "b--1", "c--1"], False)
+
+    linked = []
+    real_symlink_tree = pkgpanda.symlink_tree
+
+    def symlink_tree(src, dest):
+        linked.append(src)
+        real_symlink_tree(src, dest)
+    monkeypatch.setattr(pkgpanda, "symlink_tree", symlink_tree)
+
+    install = activate(tmpdir.join("incremental"), ["a--2", "b--1"], True)
+    assert install.get_active() == {"a--2", "b--1"}
+    # Only the package which changed was walked (besides its units, which are always relinked).
+    assert {os.path.relpath(src, str(repo_dir)).split("/")[0] for src in linked} == {"a--2"}
+    assert not tmpdir.join("incremental", "install_progress").check()
+
+    activate(tmpdir.join("full"), ["a--2", "b--1"], False)
+    full = _link_trees(tmpdir.join("full"))
+    assert _link_trees(tmpdir.join("incremental")) == full
+    assert full["bin/b"] == str(repo_dir.join("b--1", "bin", "b"))
+    assert "lib/python/a" not in full
+    assert "include/c" not in full
+    assert json.loads(tmpdir.join("incremental", "active.buildinfo.full.json").read()) == \
+        json.loads(tmpdir.join("full", "active.buildinfo.full.json").read())
+    assert "B=b--1" in tmpdir.join("incremental", "environment").read()
+
+
+# TODO: DCOS_OSS-3471 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_activate_restarts_changed_units(tmpdir, monkeypatch):
+    repo_dir = tmpdir.join("repository")
+    _make_package(repo_dir, "lib--1", {"lib/liblib.so": ""})
+    _make_package(repo_dir, "lib--2", {"lib/liblib.so": ""})
+    _make_package(repo_dir, "config--1", {"etc/a.env": "A=1", "etc/b.env": "B=1"})
+    _make_package(repo_dir, "config--2", {"etc/a.env": "A=1", "etc/b.env": "B=2"})
+    for pkg_id, unit in [("a--1", "[Service]\nEnvironmentFile=/opt/mesosphere/etc/a.env"),
+                         ("b--1", "[Service]\nEnvironmentFile=-/opt/mesosphere/etc/b.env"),
+                         ("c--1", "[Service]"),
+                         ("c--2", "[Service]\nRestart=always"),
+                         ("d--1", "[Service]"),
+                         ("e--1", "[Service]"),
+                         ("f--1", "[Service]")]:
+        name = pkg_id.split('--')[0]
+        _make_package(repo_dir, pkg_id, {"dcos.target.wants/dcos-{}.service".format(name): unit})
+    repo_dir.join("d--1", "pkginfo.json").write(json.dumps({"requires": ["lib"]}))
+    repository = Repository(str(repo_dir))
+
+    stopped = []
+    monkeypatch.setattr(pkgpanda.Systemd, "stop", lambda self, names: stopped.append(names))
+    tmpdir.join("root").ensure(dir=True)
+    install = Install(str(tmpdir.join("root")), str(tmpdir.join("config")), True, False, False)
+    install.activate(repository.load_packages(["lib--1", "config--1", "a--1", "b--1", "c--1", "d--1", "e--1"]))
+
+    new_ids = ["lib--2", "config--2", "a--1", "b--1", "c--2", "d--1", "f--1"]
+    expected_plan = {
+        'restart': {
+            "dcos-b.service": "environment file /opt/mesosphere/etc/b.env changed",
+            "dcos-c.service": "unit file changed",
+            "dcos-d.service": "required package lib changed",
+        },
+        'stop': ["dcos-e.service"],
+        'start': ["dcos-f.service"],
+        'keep': ["dcos-a.service"],
+    }
+
+    # The dry run must not write to the systemd directory, not even temporarily.
+    systemd_calls = []
+    for name in ["stage_new_units", "remove_staged_unit_files"]:
+        monkeypatch.setattr(pkgpanda.Systemd, name, lambda self, *args, name=name: systemd_calls.append(name))
+    stopped.clear()
+    assert install.activate(repository.load_packages(new_ids), dry_run=True) == expected_plan
+    assert not stopped
+    assert not systemd_calls
+    assert install.get_active() == {"lib--1", "config--1", "a--1", "b--1", "c--1", "d--1", "e--1"}
+    assert not [path for path in tmpdir.join("root").listdir() if path.ext in (".new", ".old")]
+    assert not tmpdir.join("root").listdir(lambda path: path.basename.endswith(pkgpanda.Systemd.new_unit_suffix))
+    monkeypatch.undo()
+    monkeypatch.setattr(pkgpanda.Systemd, "stop", lambda self, names: stopped.append(names))
+
+    assert install.activate(repository.load_packages(new_ids)) == expected_plan
+    assert stopped == [["dcos-b.service", "dcos-c.service", "dcos-d.service", "dcos-e.service"]]
+    assert install.get_active() == set(new_ids)
+    assert tmpdir.join("root", "dcos-c.service").read() == "[Service]\nRestart=always"
+
+
+# TODO: DCOS_OSS-3471 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_activate_restarts_all_units_on_setup_change(tmpdir):
+    repo_dir = tmpdir.join("repository")
+    _make_package(repo_dir, "a--1", {"dcos.target.wants/dcos-a.service": "[Service]"})
+    _make_package(repo_dir, "b--1", {"dcos.target.wants/dcos-b.service": "[Service]"})
+    _make_package(repo_dir, "dcos-config--setup_1", {"etc/a.conf": "a=1"})
+    _make_package(repo_dir, "dcos-config--setup_2", {"etc/a.conf": "a=2"})
+    repository = Repository(str(repo_dir))
+    tmpdir.join("root").ensure(dir=True)
+    install = Install(str(tmpdir.join("root")), str(tmpdir.join("config")), True, False, False)
+    install.activate(repository.load_packages(["a--1", "b--1", "dcos-config--setup_1"]))
+
+    plan = install.activate(repository.load_packages(["a--1", "b--1", "dcos-config--setup_2"]), dry_run=True)
+    assert plan['restart'] == {
+        "dcos-a.service": "setup package dcos-config changed",
+        "dcos-b.service": "setup package dcos-config changed",
+    }
+    assert plan['keep'] == []
+
+    plan = install.activate(repository.load_packages(["a--1", "b--1", "dcos-config--setup_1"]), dry_run=True)
+    assert plan['restart'] == {}
+    assert plan['keep'] == ["dcos-a.service", "dcos-b.service"]
+
+
+# TODO: DCOS_OSS-3471 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_activate_dry_run_leaves_host_alone(tmpdir, monkeypatch):
+    repo_dir = tmpdir.join("repository")
+    _make_package(repo_dir, "a--1", {"bin/a": ""})
+    repo_dir.join("a--1", "pkginfo.json").write(json.dumps({
+        "username": "dcos_a_dry_run_user",
+        "state_directory": True}))
+    repository = Repository(str(repo_dir))
+
+    commands = []
+    monkeypatch.setattr(pkgpanda, "check_output", lambda cmd, *args, **kwargs: commands.append(cmd))
+    tmpdir.join("root").ensure(dir=True)
+    install = Install(str(tmpdir.join("root")), str(tmpdir.join("config")), True, False, True,
+                      manage_users=True, add_users=True, manage_state_dir=True,
+                      state_dir_root=str(tmpdir.join("state")))
+
+    install.activate(repository.load_packages(["a--1"]), dry_run=True)
+    assert not commands
+    assert not tmpdir.join("state").check()
+    assert not tmpdir.join("root", "active").check()
+
+
+# TODO: DCOS_OSS-3471 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_systemd_batches_units(tmpdir):
+    repo_dir = tmpdir.join("repository")
+    for name in ["a", "b", "c"]:
+        _make_package(repo_dir, "{}--1".format(name), {"dcos.target.wants/dcos-{}.service".format(name): "[Service]"})
+    _make_package(repo_dir, "c--2", {"dcos.target.wants/dcos-c.service": "[Service]\nRestart=always"})
+    repository = Repository(str(repo_dir))
+    tmpdir.join("root").ensure(dir=True)
+    backend = pkgpanda.FakeSystemctlBackend(str(tmpdir.join("root", "dcos.target.wants")), {"dcos-a.service": 2.5})
+    install = Install(str(tmpdir.join("root")), str(tmpdir.join("config")), True, True, True,
+                      systemd_backend=backend)
+
+    install.activate(repository.load_packages(["a--1", "b--1", "c--1"]))
+    assert install.systemd.start_target("dcos.target", True) == {
+        "dcos-a.service": 2.5, "dcos-b.service": 0.0, "dcos-c.service": 0.0}
+    assert backend.calls == [("daemon-reload",), ("enable-and-start", "dcos.target")]
+
+    backend.calls.clear()
+    install.activate(repository.load_packages(["a--1", "c--2"]))
+    assert backend.calls == [("stop", "dcos-b.service", "dcos-c.service")]
+    assert tmpdir.join("root", "dcos-c.service").read() == "[Service]\nRestart=always"
+    assert not tmpdir.join("root", "dcos-b.service").check()
+    assert install.systemd.start_target("dcos.target", False) == {}
+
+
+def test_systemctl_start_latencies(monkeypatch):
+    output = (
+        "Id=dcos-a.service\nActiveState=active\n"
+        "InactiveExitTimestampMonotonic=1000000\nActiveEnterTimestampMonotonic=3500000\n\n"
+        "Id=dcos-b.service\nActiveState=failed\n"
+        "InactiveExitTimestampMonotonic=1000000\nActiveEnterTimestampMonotonic=0\n\n"
+        "Id=dcos-c.service\nActiveState=active\n"
+        "InactiveExitTimestampMonotonic=0\nActiveEnterTimestampMonotonic=0\n")
+    commands = []
+
+    def check_output(cmd):
+        commands.append(cmd)
+        return output.encode()
+    monkeypatch.setattr(pkgpanda, "check_output", check_output)
+
+    names = ["dcos-a.service", "dcos-b.service", "dcos-c.service"]
+    assert pkgpanda.SystemctlBackend().get_start_latencies(names) == {"dcos-a.service": 2.5}
+    assert len(commands) == 1 and commands[0][-3:] == names
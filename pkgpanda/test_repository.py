@@ -1,5 +1,11 @@
 """Test functionality of the local package repository"""
 
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import py
 import pytest
 
 import pkgpanda.exceptions
@@ -24,6 +30,22 @@ def test_list(repository):
                         'mesos-config--justmesos'}
 
 
+# TODO: DCOS_OSS-3464 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_list_is_a_snapshot(tmpdir):
+    repository = Repository(str(tmpdir))
+    repository.add(_make_package({"bin/foo": "foo v1"}), "foo--1")
+    packages = repository.list()
+
+    repository.add(_make_package({"bin/foo": "foo v2"}), "foo--2")
+    assert packages == {"foo--1"}
+    assert repository.list() == {"foo--1", "foo--2"}
+    assert sorted(repository.get_ids("foo")) == ["foo--1", "foo--2"]
+
+    repository.remove("foo--1")
+    assert repository.list() == {"foo--2"}
+
+
 def test_load_bad(repository):
     with pytest.raises(pkgpanda.exceptions.ValidationError):
         repository.load_packages(["invalid-package"])
@@ -32,3 +54,127 @@ def test_load_bad(repository):
 def test_load_nonexistant(repository):
     with pytest.raises(pkgpanda.exceptions.PackageError):
         repository.load_packages(["missing-package--42"])
+
+
+def _make_package(files):
+    def fetcher(_, target):
+        for path, contents in files.items():
+            target.join(path).write(contents, ensure=True)
+        target.join("pkginfo.json").write("{}")
+    return lambda id, target: fetcher(id, py.path.local(target))
+
+
+# TODO: DCOS_OSS-3464 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_dedup_and_gc(tmpdir):
+    repository = Repository(str(tmpdir), dedup=True)
+    repository.add(_make_package({"lib/shared.so": "shared", "bin/foo": "foo v1"}), "foo--1")
+    repository.add(_make_package({"lib/shared.so": "shared", "bin/foo": "foo v2"}), "foo--2")
+
+    shared_1 = os.stat(str(tmpdir.join("foo--1/lib/shared.so")))
+    shared_2 = os.stat(str(tmpdir.join("foo--2/lib/shared.so")))
+    assert shared_1.st_ino == shared_2.st_ino
+    assert shared_1.st_nlink == 3
+    assert os.stat(str(tmpdir.join("foo--1/bin/foo"))).st_ino != os.stat(str(tmpdir.join("foo--2/bin/foo"))).st_ino
+    assert tmpdir.join("foo--2/bin/foo").read() == "foo v2"
+    assert repository.list() == {"foo--1", "foo--2"}
+
+    # Everything is still in use.
+    assert repository.gc() == (0, 0)
+
+    repository.remove("foo--1")
+    assert repository.gc() == (1, len("foo v1"))
+    assert tmpdir.join("foo--2/lib/shared.so").read() == "shared"
+
+    repository.remove("foo--2")
+    assert repository.gc() == (3, len("shared") + len("foo v2") + len("{}"))
+    assert tmpdir.join(Repository.objects_dir).listdir() == []
+
+
+# TODO: DCOS_OSS-3464 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_dedup_keeps_metadata_apart(tmpdir):
+    repository = Repository(str(tmpdir), dedup=True)
+
+    def make_fetcher(mode, mtime):
+        def fetcher(id, target):
+            _make_package({"bin/foo": "foo", "lib/foo.py": "foo = 1"})(id, target)
+            os.chmod(os.path.join(target, "bin/foo"), mode)
+            if mtime is not None:
+                os.utime(os.path.join(target, "lib/foo.py"), (mtime, mtime))
+        return fetcher
+
+    repository.add(make_fetcher(0o755, None), "foo--1")
+    repository.add(make_fetcher(0o644, 0), "foo--2")
+
+    # Different permissions and Python sources with different mtimes aren't shared.
+    assert oct(os.stat(str(tmpdir.join("foo--1/bin/foo"))).st_mode & 0o777) == oct(0o755)
+    assert oct(os.stat(str(tmpdir.join("foo--2/bin/foo"))).st_mode & 0o777) == oct(0o644)
+    assert os.stat(str(tmpdir.join("foo--2/lib/foo.py"))).st_mtime == 0
+    assert os.stat(str(tmpdir.join("foo--1/lib/foo.py"))).st_mtime != 0
+
+
+def test_no_dedup_by_default(tmpdir):
+    repository = Repository(str(tmpdir))
+    repository.add(_make_package({"bin/foo": "foo"}), "foo--1")
+    assert not tmpdir.join(Repository.objects_dir).check()
+
+
+# TODO: DCOS_OSS-3464 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_concurrent_add(tmpdir):
+    repository = Repository(str(tmpdir))
+    fetched = []
+    started = threading.Event()
+
+    def slow_fetcher(id, target):
+        fetched.append(id)
+        started.set()
+        time.sleep(0.1)
+        _make_package({"bin/foo": "foo"})(id, target)
+
+    # Adds of the same package in one process only fetch it once.
+    with ThreadPoolExecutor(2) as executor:
+        first = executor.submit(repository.add, slow_fetcher, "foo--1")
+        started.wait()
+        second = executor.submit(repository.add, slow_fetcher, "foo--1", False)
+        assert sorted([first.result(), second.result()]) == [False, True]
+    assert fetched == ["foo--1"]
+
+    # Another process added the package while this one fetched it.
+    def racing_fetcher(id, target):
+        _make_package({"bin/foo": "theirs"})(id, str(tmpdir.join(id)))
+        _make_package({"bin/foo": "ours"})(id, target)
+
+    assert not repository.add(racing_fetcher, "foo--2", False)
+    assert tmpdir.join("foo--2", "bin/foo").read() == "theirs"
+    assert sorted(path.basename for path in tmpdir.join("foo--2").listdir()) == ["bin", "pkginfo.json"]
+    assert sorted(path.basename for path in tmpdir.listdir()) == ["foo--1", "foo--2"]
+
+
+# TODO: DCOS_OSS-3464 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_index_and_load_cache(tmpdir):
+    repository = Repository(str(tmpdir))
+    repository.add(_make_package({"bin/x": ""}), "a--1")
+    repository.add(_make_package({"bin/x": ""}), "a--2")
+    repository.add(_make_package({"bin/x": ""}), "b--1")
+
+    assert sorted(repository.get_ids("a")) == ["a--1", "a--2"]
+    assert sorted(str(pkg_id) for pkg_id in repository.get_package_ids("b")) == ["b--1"]
+    assert repository.get_ids("c") == []
+
+    package = repository.load("a--1")
+    assert repository.load("a--1") is package
+    # Changes to pkginfo.json are picked up.
+    tmpdir.join("a--1", "pkginfo.json").write('{"environment": {"A": "1"}}')
+    assert repository.load("a--1").environment == {"A": "1"}
+
+    repository.remove("a--1")
+    assert repository.get_ids("a") == ["a--2"]
+    with pytest.raises(pkgpanda.exceptions.PackageNotFound):
+        repository.load("a--1")
+
+    # Packages added by other processes are picked up.
+    tmpdir.join("c--1", "pkginfo.json").write("{}", ensure=True)
+    assert repository.get_ids("c") == ["c--1"]
@@ -1,4 +1,8 @@
+import hashlib
+import io
 import os
+import shutil
+import tarfile
 import tempfile
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from subprocess import CalledProcessError
@@ -9,7 +13,7 @@ import requests
 
 import pkgpanda.util
 from pkgpanda import UserManagement
-from pkgpanda.exceptions import ValidationError
+from pkgpanda.exceptions import FetchError, ValidationError
 
 PathSeparator = '/'  # Currently same for both windows and linux. Constant may vary in near future by platform
 
@@ -489,3 +493,315 @@ def test_download_remote_file_without_content_length(tmpdir, mock_download_serve
 
     with open(out_file, 'rb') as f:
         assert f.read() == b'fooba'
+
+
+class MockRangeServerRequestHandler(BaseHTTPRequestHandler):
+    # The first response is cut off part way through a read chunk, see _iter_raw_content().
+    body = b'0123456789' * 10000
+
+    def do_GET(self):  # noqa: N802
+        start = 0
+        if 'Range' in self.headers and 'no_range' not in self.path:
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(requests.codes.partial_content)
+        else:
+            self.send_response(requests.codes.ok)
+        self.server.requests_received.append(start)
+
+        body = self.body[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if len(self.server.requests_received) == 1:
+            # Drop the connection half way through the first response.
+            self.wfile.write(body[:len(body) // 2])
+        else:
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def mock_range_server():
+    mock_server = HTTPServer(('localhost', 0), MockRangeServerRequestHandler)
+    mock_server.requests_received = []
+
+    mock_server_thread = Thread(target=mock_server.serve_forever, daemon=True)
+    mock_server_thread.start()
+
+    yield mock_server
+
+    mock_server.shutdown()
+
+
+def test_download_resumable(tmpdir, mock_range_server):
+    url = 'http://localhost:{port}/foobar.txt'.format(port=mock_range_server.server_port)
+    out_file = str(tmpdir.join('foobar.txt'))
+    body = MockRangeServerRequestHandler.body
+
+    digest = pkgpanda.util.download_resumable(out_file, url, pkgpanda.util.get_requests_retry_session())
+
+    # The retry resumed from where the first response was cut off.
+    assert mock_range_server.requests_received == [0, len(body) // 2]
+    assert digest == hashlib.sha1(body).hexdigest()
+    assert not os.path.exists(out_file + '.part')
+    with open(out_file, 'rb') as f:
+        assert f.read() == body
+
+
+def test_download_resumable_without_range_support(tmpdir, mock_range_server):
+    url = 'http://localhost:{port}/foobar.txt?no_range=true'.format(port=mock_range_server.server_port)
+    out_file = str(tmpdir.join('foobar.txt'))
+    body = MockRangeServerRequestHandler.body
+    tmpdir.join('foobar.txt.part').write('stale partial download')
+    # Don't cut off the first response.
+    mock_range_server.requests_received.append(None)
+
+    digest = pkgpanda.util.download_resumable(out_file, url, pkgpanda.util.get_requests_retry_session())
+
+    assert digest == hashlib.sha1(body).hexdigest()
+    with open(out_file, 'rb') as f:
+        assert f.read() == body
+
+
+def test_download_resumable_sha1_mismatch(tmpdir, mock_range_server):
+    url = 'http://localhost:{port}/foobar.txt'.format(port=mock_range_server.server_port)
+    out_file = str(tmpdir.join('foobar.txt'))
+    mock_range_server.requests_received.append(None)
+
+    with pytest.raises(FetchError):
+        pkgpanda.util.download_resumable(
+            out_file, url, pkgpanda.util.get_requests_retry_session(), expected_sha1='0' * 40)
+
+    assert not os.path.exists(out_file)
+    assert not os.path.exists(out_file + '.part')
+
+
+def make_tar_source(tmpdir):
+    src = tmpdir.join('src')
+    src.join('bin/tool').write('#!/bin/sh\necho tool\n', ensure=True)
+    src.join('lib/libfoo.so').write_binary(os.urandom(64 * 1024), ensure=True)
+    src.join('a.txt').write('a\n' * 10000)
+    src.join('empty').ensure(dir=True)
+    os.symlink('bin', str(src.join('bin-link')))
+    return str(src)
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="make_tar always uses gzip on Windows")
+def test_make_tar_xz_deterministic(tmpdir, monkeypatch):
+    src = make_tar_source(tmpdir)
+    # Use small blocks so the archive is split across several xz streams.
+    monkeypatch.setattr(pkgpanda.util, 'xz_block_size', 16 * 1024)
+
+    single = str(tmpdir.join('single.tar.xz'))
+    multi = str(tmpdir.join('multi.tar.xz'))
+    pkgpanda.util.make_tar(single, src, threads=1)
+    pkgpanda.util.make_tar(multi, src, threads=4)
+    with open(single, 'rb') as f1, open(multi, 'rb') as f2:
+        assert f1.read() == f2.read()
+
+    # The output is readable by stock tar.
+    out = tmpdir.join('out')
+    pkgpanda.util.extract_tarball(multi, str(out))
+    assert out.join('a.txt').read() == 'a\n' * 10000
+    assert os.readlink(str(out.join('bin-link'))) == 'bin'
+    assert out.join('empty').check(dir=True)
+
+    with tarfile.open(multi) as tar:
+        members = tar.getmembers()
+    names = [m.name for m in members]
+    assert names == ['.', './a.txt', './bin', './bin-link', './empty', './lib', './bin/tool', './lib/libfoo.so']
+    assert all(m.uid == 0 and m.gid == 0 and m.uname == '' and m.gname == '' for m in members)
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="make_tar always uses gzip on Windows")
+def test_make_tar_mtime(tmpdir):
+    src = make_tar_source(tmpdir)
+    result = str(tmpdir.join('result.tar.xz'))
+    pkgpanda.util.make_tar(result, src, mtime=1000)
+    with tarfile.open(result) as tar:
+        assert {m.mtime for m in tar.getmembers()} == {1000}
+
+    # Modification times are clamped by default too, so rebuilding the same contents gives the same tarball.
+    default = str(tmpdir.join('default.tar.xz'))
+    pkgpanda.util.make_tar(default, src)
+    with tarfile.open(default) as tar:
+        assert {m.mtime for m in tar.getmembers()} == {pkgpanda.util.tar_mtime}
+    os.utime(os.path.join(src, 'a.txt'))
+    again = str(tmpdir.join('again.tar.xz'))
+    pkgpanda.util.make_tar(again, src)
+    with open(default, 'rb') as f1, open(again, 'rb') as f2:
+        assert f1.read() == f2.read()
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="make_tar always uses gzip on Windows")
+def test_contents_digest(tmpdir):
+    src = make_tar_source(tmpdir)
+    os.chmod(os.path.join(src, 'bin/tool'), 0o755)
+    os.link(os.path.join(src, 'a.txt'), os.path.join(src, 'b.txt'))
+    result = str(tmpdir.join('result.tar.xz'))
+    pkgpanda.util.make_tar(result, src)
+    digest = pkgpanda.util.tarball_contents_digest(result)
+    assert pkgpanda.util.package_contents_digest(src) == digest
+
+    # The package extracted from the tarball or streamed from a peer has the same digest.
+    out = tmpdir.join('out')
+    pkgpanda.util.extract_tarball(result, str(out))
+    assert pkgpanda.util.package_contents_digest(str(out)) == digest
+    streamed = tmpdir.join('streamed')
+    pkgpanda.util.extract_tar_stream(io.BytesIO(b''.join(pkgpanda.util.iter_tar(str(out)))), str(streamed))
+    assert pkgpanda.util.package_contents_digest(str(streamed)) == digest
+
+    # Contents, permissions and symlink targets are all covered.
+    out.join('lib/libfoo.so').write_binary(b'altered')
+    assert pkgpanda.util.package_contents_digest(str(out)) != digest
+    os.chmod(str(streamed.join('bin/tool')), 0o4755)
+    assert pkgpanda.util.package_contents_digest(str(streamed)) != digest
+    os.remove(os.path.join(src, 'bin-link'))
+    os.symlink('lib', os.path.join(src, 'bin-link'))
+    assert pkgpanda.util.package_contents_digest(src) != digest
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason="zstd isn't installed")
+def test_make_tar_zstd(tmpdir):
+    src = make_tar_source(tmpdir)
+    result = str(tmpdir.join('result.tar.zst'))
+    pkgpanda.util.make_tar(result, src, level=1, threads=2)
+    out = tmpdir.join('out')
+    pkgpanda.util.extract_tarball(result, str(out))
+    assert out.join('a.txt').read() == 'a\n' * 10000
+    assert out.join('lib/libfoo.so').size() == 64 * 1024
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="extract_tarball uses bsdtar on Windows")
+@pytest.mark.parametrize('mode', ['w:', 'w:gz', 'w:xz'])
+def test_extract_tarball_formats(tmpdir, mode):
+    src = make_tar_source(tmpdir)
+    result = str(tmpdir.join('result.tar'))
+    with tarfile.open(result, mode) as tar:
+        tar.add(src, arcname='./')
+    # Make a directory read-only to check its contents can still be extracted.
+    os.chmod(os.path.join(src, 'bin'), 0o555)
+
+    out = tmpdir.join('out')
+    pkgpanda.util.extract_tarball(result, str(out))
+    assert out.join('bin/tool').read() == '#!/bin/sh\necho tool\n'
+    assert out.join('lib/libfoo.so').read_binary() == tmpdir.join('src/lib/libfoo.so').read_binary()
+    assert os.readlink(str(out.join('bin-link'))) == 'bin'
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="extract_tarball uses bsdtar on Windows")
+def test_extract_tarball_members(tmpdir):
+    src = make_tar_source(tmpdir)
+    result = str(tmpdir.join('result.tar.xz'))
+    pkgpanda.util.make_tar(result, src)
+
+    out = tmpdir.join('out')
+    pkgpanda.util.extract_tarball(result, str(out), members=['bin/tool', 'lib'])
+    assert sorted(os.listdir(str(out))) == ['bin', 'lib']
+    assert out.join('bin/tool').read() == '#!/bin/sh\necho tool\n'
+    assert out.join('lib/libfoo.so').check(file=True)
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="extract_tarball uses bsdtar on Windows")
+def test_extract_tarball_outside_target(tmpdir):
+    result = str(tmpdir.join('result.tar'))
+    with tarfile.open(result, 'w') as tar:
+        tar_info = tarfile.TarInfo('../escaped')
+        tar.addfile(tar_info)
+
+    out = tmpdir.join('out')
+    with pytest.raises(ValidationError):
+        pkgpanda.util.extract_tarball(result, str(out))
+    assert not out.check()
+    assert not tmpdir.join('escaped').check()
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="extract_tarball uses bsdtar on Windows")
+@pytest.mark.parametrize('inside', ['x/evil', 'x/y/evil'])
+def test_extract_tarball_through_symlink(tmpdir, inside):
+    outside = tmpdir.join('outside').ensure(dir=True)
+    result = str(tmpdir.join('result.tar'))
+    with tarfile.open(result, 'w') as tar:
+        link = tarfile.TarInfo('x')
+        link.type = tarfile.SYMTYPE
+        link.linkname = str(outside)
+        tar.addfile(link)
+        tar.addfile(tarfile.TarInfo(inside))
+
+    out = tmpdir.join('out')
+    with pytest.raises((ValidationError, OSError)):
+        pkgpanda.util.extract_tarball(result, str(out))
+    assert not out.check()
+    assert outside.listdir() == []
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows or os.geteuid() != 0, reason="changing owners requires root")
+def test_chown_tree(tmpdir):
+    tree = tmpdir.join("state")
+    for path in ["a/b/c", "a/d", "e"]:
+        tree.join(path).write("", ensure=True)
+    tree.join("link").mksymlinkto("/etc/passwd")
+    owner = os.lstat("/etc/passwd").st_uid
+
+    uid = 12345
+    # Everything is owned by root, so every entry is changed, and the symlink target is left alone.
+    assert pkgpanda.util.chown_tree(str(tree), uid) == 7
+    for dir_path, dirs, files in os.walk(str(tree)):
+        for name in [dir_path] + [os.path.join(dir_path, entry) for entry in dirs + files]:
+            assert os.lstat(name).st_uid == uid
+    assert os.lstat("/etc/passwd").st_uid == owner
+
+    # Trees whose top already has the right owner are skipped, unless verifying.
+    os.chown(str(tree.join("a", "b", "c")), 0, -1)
+    assert pkgpanda.util.chown_tree(str(tree), uid) == 0
+    assert os.lstat(str(tree.join("a", "b", "c"))).st_uid == 0
+    assert pkgpanda.util.chown_tree(str(tree), uid, verify=True) == 1
+    assert os.lstat(str(tree.join("a", "b", "c"))).st_uid == uid
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="symlinks require privileges on Windows")
+def test_rewrite_symlinks(tmpdir):
+    root = tmpdir.join("root")
+    links = {
+        "bin/a": "/build/packages/a--1/bin/a",
+        "packages/a--1/lib/b": "/build/packages/a--1/lib/b.so",
+        "packages/a--1/lib/deep/c": "relative/c",
+        "packages/b--1/etc": "/etc/other",
+        "top": "/build",
+    }
+    for path, target in links.items():
+        root.join(path).dirpath().ensure(dir=True)
+        root.join(path).mksymlinkto(target)
+
+    assert pkgpanda.util.rewrite_symlinks(str(root), "/build", "/opt/mesosphere") == 3
+    assert {path: os.readlink(str(root.join(path))) for path in links} == {
+        "bin/a": "/opt/mesosphere/packages/a--1/bin/a",
+        "packages/a--1/lib/b": "/opt/mesosphere/packages/a--1/lib/b.so",
+        "packages/a--1/lib/deep/c": "relative/c",
+        "packages/b--1/etc": "/etc/other",
+        "top": "/opt/mesosphere/",
+    }
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="symlinks require privileges on Windows")
+def test_rewrite_symlinks_per_package(tmpdir, monkeypatch):
+    # Laid out like the work dir of a bootstrap tarball.
+    root = tmpdir.join("work")
+    packages = root.join("opt", "mesosphere", "packages")
+    for pkg_id in ["a--1", "b--1", "c--1"]:
+        packages.join(pkg_id, "lib", "lib.so").dirpath().ensure(dir=True)
+        packages.join(pkg_id, "lib", "lib.so").mksymlinkto("/work/lib.so")
+    root.join("opt", "mesosphere", "bin", "a").dirpath().ensure(dir=True)
+    root.join("opt", "mesosphere", "bin", "a").mksymlinkto("/work/opt/mesosphere/packages/a--1/bin/a")
+
+    walked = []
+    rewrite_symlinks_in = pkgpanda.util._rewrite_symlinks_in
+
+    def record(path, *args, **kwargs):
+        walked.append(path)
+        return rewrite_symlinks_in(path, *args, **kwargs)
+
+    monkeypatch.setattr(pkgpanda.util, "_rewrite_symlinks_in", record)
+    assert pkgpanda.util.rewrite_symlinks(str(root), "/work", "/") == 4
+    assert walked[0] == str(root)
+    assert sorted(walked[1:]) == [str(packages.join(pkg_id)) for pkg_id in ["a--1", "b--1", "c--1"]]
+    assert os.readlink(str(root.join("opt", "mesosphere", "bin", "a"))) == "/opt/mesosphere/packages/a--1/bin/a"
@@ -1,7 +1,9 @@
+import gzip
 import hashlib
 import http.server
 import json
 import logging
+import lzma
 import os
 import platform
 import re
@@ -10,6 +12,10 @@ import socketserver
 import stat
 import tarfile
 import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, ExitStack
 from itertools import chain
 from multiprocessing import Process
@@ -21,6 +27,7 @@ import retrying
 import teamcity
 import yaml
 from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import ProtocolError
 from requests.packages.urllib3.util.retry import Retry
 from teamcity.messages import TeamcityServiceMessages
 
@@ -73,7 +80,58 @@ def make_directory(path):
         path = path.replace('/', '\\')
 
     if not os.path.exists(path):
-        os.makedirs(path)
+        # exist_ok since another thread may create the directory between the check and makedirs.
+        os.makedirs(path, exist_ok=True)
+
+
+def _chown_subtree(path, uid):
+    """Set the owner of everything below the directory path to uid. Returns the number of entries changed."""
+    changed = 0
+    to_scan = [path]
+    while to_scan:
+        with os.scandir(to_scan.pop()) as entries:
+            for entry in entries:
+                if entry.stat(follow_symlinks=False).st_uid != uid:
+                    os.chown(entry.path, uid, -1, follow_symlinks=False)
+                    changed += 1
+                if entry.is_dir(follow_symlinks=False):
+                    to_scan.append(entry.path)
+    return changed
+
+
+def chown_tree(path, uid, verify=False, jobs=8):
+    """Set the owner of path and everything below it to uid, like `chown -R uid path`.
+
+    Only entries which have another owner are changed. Trees whose top
+    already belongs to uid are assumed to be right and skipped, unless verify
+    is set. The subdirectories of path are walked in parallel with jobs
+    threads. Symlinks are changed themselves rather than followed.
+
+    Returns the number of entries whose owner was changed.
+    """
+    st = os.lstat(path)
+    if st.st_uid == uid and not verify:
+        return 0
+
+    changed = 0
+    if st.st_uid != uid:
+        os.chown(path, uid, -1, follow_symlinks=False)
+        changed += 1
+    if not stat.S_ISDIR(st.st_mode):
+        return changed
+
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.stat(follow_symlinks=False).st_uid != uid:
+                os.chown(entry.path, uid, -1, follow_symlinks=False)
+                changed += 1
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        changed += sum(executor.map(lambda subdir: _chown_subtree(subdir, uid), subdirs))
+    return changed
 
 
 def copy_file(src_path, dst_path):
@@ -136,14 +194,17 @@ def variant_suffix(variant, delim='.'):
     return delim + variant
 
 
-def get_requests_retry_session(max_retries=4, backoff_factor=1, status_forcelist=None):
+def get_requests_retry_session(max_retries=4, backoff_factor=1, status_forcelist=None, pool_maxsize=None):
     status_forcelist = status_forcelist or [500, 502, 504]
     # Default max retries 4 with sleeping between retries 1s, 2s, 4s, 8s
     session = requests.Session()
     custom_retry = Retry(total=max_retries,
                          backoff_factor=backoff_factor,
                          status_forcelist=status_forcelist)
-    custom_adapter = HTTPAdapter(max_retries=custom_retry)
+    # pool_maxsize is the number of keep-alive connections kept per host. Set it to the number of
+    # threads sharing the session so connections are re-used rather than re-opened.
+    adapter_kwargs = {'pool_maxsize': pool_maxsize} if pool_maxsize else {}
+    custom_adapter = HTTPAdapter(max_retries=custom_retry, **adapter_kwargs)
     # Any request through this session that starts with 'http://' or 'https://'
     # will use the custom Transport Adapter created which include retries
     session.mount('http://', custom_adapter)
@@ -228,25 +289,347 @@ def download_atomic(out_filename, url, work_dir):
         raise
 
 
-def extract_tarball(path, target):
+def _is_resumable_download_error(exception):
+    return isinstance(exception, (
+        IncompleteDownloadError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.ChunkedEncodingError,
+        ProtocolError))
+
+
+def _iter_raw_content(raw, chunk_size=64 * 1024):
+    """Yield the (decoded) content of the urllib3 response raw as it arrives.
+
+    Unlike Response.iter_content() this doesn't wait for a whole chunk before
+    yielding, so everything received before the connection drops is written to
+    the partial download and doesn't need to be fetched again. urllib3 2 only
+    returns what already arrived from read1(), older versions from read().
+    """
+    read = getattr(raw, 'read1', raw.read)
+    while True:
+        chunk = read(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+
+@retrying.retry(
+    stop_max_attempt_number=3,
+    wait_random_min=1000,
+    wait_random_max=2000,
+    retry_on_exception=_is_resumable_download_error)
+def _download_resumable(part_filename, url, session):
+    hasher = hashlib.sha1()
+    offset = 0
+    if os.path.exists(part_filename):
+        with open(part_filename, 'rb') as f:
+            for buf in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(buf)
+                offset += len(buf)
+
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    r = session.get(url, stream=True, headers=headers)
+    if offset and r.status_code != requests.codes.partial_content:
+        # The server doesn't support ranges, or the partial download is of something else (416).
+        # Start over.
+        log.debug("Unable to resume download of %s (HTTP %s), restarting", url, r.status_code)
+        r.close()
+        hasher = hashlib.sha1()
+        offset = 0
+        r = session.get(url, stream=True)
+
+    with r:
+        r.raise_for_status()
+
+        total_bytes_read = 0
+        with open(part_filename, 'ab' if offset else 'wb') as f:
+            for chunk in _iter_raw_content(r.raw):
+                f.write(chunk)
+                hasher.update(chunk)
+                total_bytes_read += len(chunk)
+
+        if 'content-length' in r.headers:
+            content_length = int(r.headers['content-length'])
+            if total_bytes_read != content_length:
+                # Keep the partial download around so the retry can resume it.
+                raise IncompleteDownloadError(url, offset + total_bytes_read, offset + content_length)
+
+    return hasher.hexdigest()
+
+
+def download_resumable(out_filename, url, session, expected_sha1=None):
+    """Download url to out_filename using session, resuming an earlier partial download if possible.
+
+    The download is written to out_filename + '.part', which is kept if the
+    download fails so a later call can continue it with an HTTP Range request,
+    then moved into place once complete. The sha1 of the content is computed
+    while it is downloaded. If expected_sha1 is given and doesn't match, the
+    download is discarded.
+
+    Returns the sha1 of the downloaded file. Raises FetchError on failure.
+    """
+    assert os.path.isabs(out_filename)
+    part_filename = out_filename + '.part'
+    try:
+        digest = _download_resumable(part_filename, url, session)
+        if expected_sha1 is not None and digest != expected_sha1:
+            os.remove(part_filename)
+            raise ValidationError("Expected sha1 {} but downloaded content has sha1 {}".format(expected_sha1, digest))
+        os.replace(part_filename, out_filename)
+        return digest
+    except Exception as fetch_exception:
+        raise FetchError(url, out_filename, fetch_exception, False) from fetch_exception
+
+
+class _DecompressingReader:
+    """Read-only file object which decompresses fileobj as it is read.
+
+    Concatenated streams (as written by make_tar) are decompressed one after
+    the other. The decompressor is never asked for a bounded amount of output,
+    as that occasionally fails on valid xz files before Python 3.10
+    (https://bugs.python.org/issue21872).
+    """
+
+    # Small input reads bound the memory used by highly compressible data.
+    chunk_size = 16 * 1024
+
+    def __init__(self, fileobj, make_decompressor):
+        self._fileobj = fileobj
+        self._make_decompressor = make_decompressor
+        self._decompressor = make_decompressor()
+        self._buffer = b''
+        self._pos = 0
+
+    def _fill(self):
+        if self._decompressor.eof:
+            data = self._decompressor.unused_data or self._fileobj.read(self.chunk_size)
+            if not data:
+                return False
+            self._decompressor = self._make_decompressor()
+        else:
+            data = self._fileobj.read(self.chunk_size)
+            if not data:
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        self._buffer = self._decompressor.decompress(data)
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._pos == len(self._buffer) and not self._fill():
+                break
+            end = len(self._buffer) if size < 0 else min(len(self._buffer), self._pos + size)
+            chunks.append(self._buffer[self._pos:end])
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return b''.join(chunks)
+
+
+# Leading magic bytes -> decompressor factory for the formats make_tar writes.
+_tar_decompressors = [
+    (b'\xfd7zXZ\x00', lambda: lzma.LZMADecompressor(format=lzma.FORMAT_XZ)),
+    (b'\x1f\x8b', lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+]
+_zstd_magic = b'\x28\xb5\x2f\xfd'
+
+
+@contextmanager
+def _open_tar_stream(path):
+    """Open the tarball at path, returning a file object for the uncompressed tar stream.
+
+    xz, gzip and uncompressed tarballs are read in process, zstd tarballs are
+    piped through `zstd -dc`.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+        f.seek(0)
+        if magic.startswith(_zstd_magic):
+            with subprocess.Popen(['zstd', '-dc', path], stdout=subprocess.PIPE) as proc:
+                yield proc.stdout
+                # Drain any trailing padding so zstd doesn't die of a broken pipe.
+                proc.stdout.read()
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+            return
+
+        for prefix, make_decompressor in _tar_decompressors:
+            if magic.startswith(prefix):
+                yield _DecompressingReader(f, make_decompressor)
+                return
+        yield f
+
+
+def _sha256_fileobj(fileobj):
+    hasher = hashlib.sha256()
+    for buf in iter(lambda: fileobj.read(1024 * 1024), b''):
+        hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def _hash_contents_entries(entries):
+    hasher = hashlib.sha256()
+    for entry in sorted(entries):
+        hasher.update(json.dumps(entry).encode() + b'\n')
+    return hasher.hexdigest()
+
+
+def package_contents_digest(path):
+    """Return the contents digest of the package extracted at path.
+
+    The digest covers the path, type and permissions of everything in the
+    package, the sha256 of each regular file and the target of each symlink.
+    Owners and modification times aren't included. tarball_contents_digest()
+    returns the same digest for the tarball the package was extracted from,
+    so a copy from an untrusted source can be checked against it.
+    """
+    entries = []
+    for rel_path in _walk_sorted(path):
+        full_path = os.path.join(path, rel_path)
+        st = os.lstat(full_path)
+        rel_path = rel_path.replace(os.sep, '/')
+        if stat.S_ISLNK(st.st_mode):
+            entries.append((rel_path, 'l', 0, os.readlink(full_path)))
+        elif stat.S_ISDIR(st.st_mode):
+            entries.append((rel_path, 'd', stat.S_IMODE(st.st_mode), ''))
+        elif stat.S_ISREG(st.st_mode):
+            with open(full_path, 'rb') as f:
+                entries.append((rel_path, 'f', stat.S_IMODE(st.st_mode), _sha256_fileobj(f)))
+        else:
+            raise ValidationError("Unsupported file type in package: {}".format(full_path))
+    return _hash_contents_entries(entries)
+
+
+def tarball_contents_digest(path):
+    """Return the contents digest of the package tarball at path, see package_contents_digest()."""
+    entries = []
+    file_digests = {}
+    with _open_tar_stream(path) as fileobj, tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for tar_info in tar:
+            name = _normalize_member_name(tar_info)
+            if name == '.':
+                continue
+            if tar_info.issym():
+                entries.append((name, 'l', 0, tar_info.linkname))
+            elif tar_info.isdir():
+                entries.append((name, 'd', tar_info.mode, ''))
+            elif tar_info.islnk():
+                # Hard links are extracted as regular files with the contents of their target.
+                entries.append((name, 'f', tar_info.mode, file_digests[os.path.normpath(tar_info.linkname)]))
+            elif tar_info.isfile():
+                file_digests[name] = _sha256_fileobj(tar.extractfile(tar_info))
+                entries.append((name, 'f', tar_info.mode, file_digests[name]))
+            else:
+                raise ValidationError("Unsupported file type in package tarball {}: {}".format(path, tar_info.name))
+    return _hash_contents_entries(entries)
+
+
+def _normalize_member_name(tar_info):
+    name = os.path.normpath(tar_info.name)
+    if os.path.isabs(name) or name == '..' or name.startswith('../'):
+        raise ValidationError("Refusing to extract {} outside of the target directory".format(tar_info.name))
+    if tar_info.islnk():
+        link_name = os.path.normpath(tar_info.linkname)
+        if os.path.isabs(link_name) or link_name == '..' or link_name.startswith('../'):
+            raise ValidationError("Refusing to extract hard link {} to {} outside of the target directory".format(
+                tar_info.name, tar_info.linkname))
+    return name
+
+
+def _is_below_symlink(name, symlinks):
+    parent = os.path.dirname(name)
+    while parent:
+        if parent in symlinks:
+            return True
+        parent = os.path.dirname(parent)
+    return False
+
+
+def _extract_tar_stream(fileobj, target, members):
+    """Extract the uncompressed tar stream read from fileobj into target.
+
+    Like `tar`, symlinks are only made once everything else is extracted, and
+    no member may be inside one, so a tarball can't write outside of target
+    through its own symlinks.
+    """
+    directories = []
+    symlinks = {}
+    extracted = []
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for tar_info in tar:
+            name = _normalize_member_name(tar_info)
+            if members is not None and not any(name == m or name.startswith(m + '/') for m in members):
+                continue
+            if tar_info.issym():
+                symlinks[name] = tar_info
+                continue
+            if tar_info.isdir():
+                directories.append(tar_info)
+            tar.extract(tar_info, target, set_attrs=not tar_info.isdir(), numeric_owner=True)
+            extracted.append(name)
+
+        for name in chain(symlinks, extracted):
+            if _is_below_symlink(name, symlinks):
+                raise ValidationError("Refusing to extract {} inside of a symlink".format(name))
+        for tar_info in symlinks.values():
+            tar.extract(tar_info, target, numeric_owner=True)
+
+        # Like `tar`, set directory attributes last, deepest first, so that
+        # read-only directories can still be extracted into.
+        directories.sort(key=lambda tar_info: tar_info.name, reverse=True)
+        for tar_info in directories:
+            dir_path = os.path.join(target, tar_info.name)
+            tar.chown(tar_info, dir_path, numeric_owner=True)
+            tar.utime(tar_info, dir_path)
+            tar.chmod(tar_info, dir_path)
+
+
+def extract_tar_stream(fileobj, target, members=None):
+    """Extract the uncompressed tarball read from fileobj into target.
+
+    members selects what to extract like for extract_tarball. If there are any
+    errors, delete the folder being extracted to.
+    """
+    if members is not None:
+        members = [os.path.normpath(m) for m in members]
+    try:
+        make_directory(target)
+        _extract_tar_stream(fileobj, target, members)
+    except:
+        rmtree(target, ignore_errors=True)
+        raise
+
+
+def extract_tarball(path, target, members=None):
     """Extract the tarball into target.
 
+    The tarball is decompressed and unpacked in a single streaming pass. xz,
+    gzip and uncompressed tarballs are handled in process, zstd tarballs are
+    piped through `zstd -dc`.
+
+    If members is given, only the listed paths (relative to the root of the
+    tarball, e.g. 'bin/foo') and the contents of listed directories are
+    extracted.
+
     If there are any errors, delete the folder being extracted to.
     """
     # TODO(cmaloney): Validate extraction will pass before unpacking as much as possible.
     # TODO(cmaloney): Unpack into a temporary directory then move into place to
     # prevent partial extraction from ever laying around on the filesystem.
+    if members is not None:
+        members = [os.path.normpath(m) for m in members]
     try:
         assert os.path.exists(path), "Path doesn't exist but should: {}".format(path)
         make_directory(target)
 
-        # TODO(tweidner): https://jira.mesosphere.com/browse/DCOS-48220
-        # Make this cross-platform via Python's tarfile module once
-        # https://bugs.python.org/issue21872 is fixed.
         if is_windows:
-            subprocess.check_call(['bsdtar', '-xf', path, '-C', target])
-        else:
-            subprocess.check_call(['tar', '-xf', path, '-C', target])
+            # Symlinks can't be extracted in a single pass on Windows, so leave that to bsdtar.
+            subprocess.check_call(['bsdtar', '-xf', path, '-C', target] + ['./' + m for m in members or []])
+            return
+
+        with _open_tar_stream(path) as fileobj:
+            _extract_tar_stream(fileobj, target, members)
 
     except:
         # If there are errors, we can't really cope since we are already in an error state.
@@ -305,6 +688,18 @@ def write_string(filename, data):
     If no file already exists at ``filename``, the new file is created with
     permissions 0o644.
     """
+    with open_atomic(filename) as f:
+        f.write(data)
+
+
+@contextmanager
+def open_atomic(filename):
+    """
+    Open a temporary text file which replaces ``filename`` once the context
+    exits without an exception, as with ``write_string``.
+
+    Use this to write large files piece by piece.
+    """
     prefix = os.path.basename(filename)
     tmp_file_dir = os.path.dirname(os.path.realpath(filename))
     fd, temporary_filename = tempfile.mkstemp(prefix=prefix, dir=tmp_file_dir)
@@ -316,13 +711,11 @@ def write_string(filename, data):
         permissions = 0o644
 
     try:
-        try:
-            os.write(fd, data.encode())
-        finally:
-            os.close(fd)
+        with open(fd, 'w', encoding='utf-8', newline='') as f:
+            yield f
         os.chmod(temporary_filename, stat.S_IMODE(permissions))
         os.replace(temporary_filename, filename)
-    except Exception:
+    except BaseException:
         os.remove(temporary_filename)
         raise
 
@@ -354,7 +747,21 @@ def sha1(filename):
 
     with open(filename, 'rb') as fh:
         while 1:
-            buf = fh.read(4096)
+            # Large reads keep the number of syscalls (and hasher updates) down for big files.
+            buf = fh.read(1024 * 1024)
+            if not buf:
+                break
+            hasher.update(buf)
+
+    return hasher.hexdigest()
+
+
+def sha256(filename):
+    hasher = hashlib.sha256()
+
+    with open(filename, 'rb') as fh:
+        while 1:
+            buf = fh.read(1024 * 1024)
             if not buf:
                 break
             hasher.update(buf)
@@ -380,38 +787,282 @@ def expect_fs(folder, contents):
         raise ValueError("Invalid type {0} passed to expect_fs".format(type(contents)))
 
 
-def _tar_filter(tar_info: tarfile.TarInfo) -> tarfile.TarInfo:
-    tar_info.uid = 0
-    tar_info.gid = 0
-    return tar_info
+class _ParallelXzWriter:
+    """Write-only file object which xz compresses its input on a thread pool.
+
+    The input is split into fixed size blocks which are each compressed into
+    an independent xz stream (lzma releases the GIL while compressing), and
+    the streams are written out in order. Concatenated xz streams are valid
+    xz, readable by `xz -d`, `tar -xJf` and Python's lzma module. The output
+    only depends on the input, the preset and the block size, never on the
+    number of threads.
+    """
+
+    def __init__(self, fileobj, preset, threads, block_size):
+        self._fileobj = fileobj
+        self._preset = preset
+        self._block_size = block_size
+        self._buffer = bytearray()
+        # Bound the number of blocks in flight so memory use doesn't grow with
+        # the size of the archive.
+        self._max_pending = threads * 2
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(lzma.compress, block, format=lzma.FORMAT_XZ, preset=self._preset))
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+        finally:
+            self.abort()
+
+    def abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown()
+
+
+# Large enough for the default xz presets to reach close to single stream
+# compression ratios (xz -T uses three times the dictionary size).
+xz_block_size = 24 * 1024 * 1024
+
 
+@contextmanager
+def _open_xz(filename, level, threads):
+    with open(filename, 'wb') as f:
+        writer = _ParallelXzWriter(f, level, threads, xz_block_size)
+        try:
+            yield writer
+        except:
+            writer.abort()
+            raise
+        writer.close()
 
-def make_tar(result_filename, change_folder):
-    tar_mode = ''
+
+@contextmanager
+def _open_zstd(filename, level, threads):
+    cmd = ['zstd', '--quiet', '--force', '-{}'.format(level), '-T{}'.format(threads), '-o', filename]
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE) as proc:
+        try:
+            yield proc.stdin
+        except:
+            proc.kill()
+            raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+@contextmanager
+def _open_gz(filename, level, threads):
+    # Fix the mtime and name in the gzip header so the output is reproducible.
+    with open(filename, 'wb') as f:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=f, compresslevel=level, mtime=0) as gz:
+            yield gz
+
+
+# Archive writers usable by make_tar: compression -> (open function, default level).
+# Every open function takes (filename, level, threads) and is a context manager
+# returning a writable file object for the uncompressed tar stream.
+tar_compressors = {
+    'gz': (_open_gz, 9),
+    'xz': (_open_xz, 6),
+    'zstd': (_open_zstd, 3),
+}
+
+
+def _get_tar_compression(result_filename):
     if is_windows:
-        tar_mode = 'w:gz'
-    else:
-        tar_mode = 'w:xz'
+        return 'gz'
+    if result_filename.endswith('.zst'):
+        return 'zstd'
+    if result_filename.endswith('.gz') or result_filename.endswith('.tgz'):
+        return 'gz'
+    return 'xz'
+
+
+def _walk_sorted(folder):
+    """Yield the paths of everything inside folder relative to it, in a stable order."""
+    for root_dir, dirs, files in os.walk(folder):
+        dirs.sort()
+        rel_dir = os.path.relpath(root_dir, folder)
+        # Symlinks to directories are listed in dirs but not descended into.
+        for name in sorted(dirs + files):
+            yield os.path.normpath(os.path.join(rel_dir, name))
+
+
+def _tar_entries(change_folder):
+    """Yield (path, arcname) for change_folder and everything inside it, in a stable order."""
+    yield change_folder, './'
+    for path in _walk_sorted(change_folder):
+        yield os.path.join(change_folder, path), './' + path.replace(os.sep, '/')
+
+
+# Modification times in tarballs are clamped to this (1980-01-01, the oldest
+# time zip files can hold) unless SOURCE_DATE_EPOCH is set, so the same
+# contents always give the same tarball.
+tar_mtime = 315532800
+
+# make_tar compresses on at most this many threads unless told otherwise. Each
+# xz thread holds blocks of xz_block_size and an encoder of around 100MB.
+max_tar_threads = 4
+
+
+def _get_tar_mtime(mtime):
+    if mtime is not None:
+        return mtime
+    if 'SOURCE_DATE_EPOCH' in os.environ:
+        return int(os.environ['SOURCE_DATE_EPOCH'])
+    return tar_mtime
+
 
-    with tarfile.open(name=str(result_filename), mode=tar_mode) as tar:
-        tar.add(name=str(change_folder), arcname='./', filter=_tar_filter)
+def _make_tar_filter(mtime):
+    def tar_filter(tar_info):
+        tar_info.uid = 0
+        tar_info.gid = 0
+        tar_info.uname = ''
+        tar_info.gname = ''
+        tar_info.mtime = min(tar_info.mtime, mtime)
+        return tar_info
+    return tar_filter
 
 
-def rewrite_symlinks(root, old_prefix, new_prefix):
+def make_tar(result_filename, change_folder, compression=None, level=None, threads=None, mtime=None):
+    """Make a compressed tarball of the contents of change_folder.
+
+    The tarball is deterministic: entries are sorted, owned by uid / gid 0
+    with no user or group names, and no entry is newer than mtime.
+
+    Args:
+        result_filename: tarball to write.
+        change_folder: directory whose contents become the root of the tarball.
+        compression: one of tar_compressors. Picked from the extension of
+            result_filename if not given, defaulting to xz.
+        level: compression level. Defaults to the compressor's default level.
+        threads: number of threads to compress with. Defaults to the number
+            of CPUs, up to max_tar_threads.
+        mtime: unix timestamp to clamp modification times to. Defaults to
+            SOURCE_DATE_EPOCH if it is set in the environment, else tar_mtime.
+    """
+    result_filename = str(result_filename)
+    change_folder = str(change_folder)
+    if compression is None:
+        compression = _get_tar_compression(result_filename)
+    open_compressed, default_level = tar_compressors[compression]
+    if level is None:
+        level = default_level
+    if threads is None:
+        threads = min(os.cpu_count() or 1, max_tar_threads)
+
+    tar_filter = _make_tar_filter(_get_tar_mtime(mtime))
+    with open_compressed(result_filename, level, threads) as fileobj:
+        with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+            for name, arcname in _tar_entries(change_folder):
+                tar.add(name=name, arcname=arcname, recursive=False, filter=tar_filter)
+
+
+class _ChunkWriter:
+    """Write-only file object which collects what is written to it."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_tar(change_folder):
+    """Yield an uncompressed tarball of the contents of change_folder in chunks.
+
+    The tarball has the same entries as the one make_tar writes, so it can be
+    served while it is being made, e.g. in an HTTP response.
+    """
+    change_folder = str(change_folder)
+    tar_filter = _make_tar_filter(_get_tar_mtime(None))
+    writer = _ChunkWriter()
+    with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+        for name, arcname in _tar_entries(change_folder):
+            tar.add(name=name, arcname=arcname, recursive=False, filter=tar_filter)
+            data = writer.take()
+            if data:
+                yield data
+    yield writer.take()
+
+
+def _rewrite_symlinks_in(path, old_prefix, new_prefix, packages=None):
+    """Rewrite the symlinks below path, see rewrite_symlinks().
+
+    If packages is a list, the directories inside directories called packages
+    are added to it rather than walked.
+    Returns the number of symlinks found and the number rewritten.
+    """
+    found, rewritten = 0, 0
+    to_scan = [path]
+    while to_scan:
+        dir_path = to_scan.pop()
+        in_packages = packages is not None and os.path.basename(dir_path) == 'packages'
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                # DirEntry knows the type of the entry from the directory listing, so this doesn't stat.
+                if entry.is_symlink():
+                    found += 1
+                    # Rewrite old_prefix to new_prefix if present.
+                    target = os.readlink(entry.path)
+                    if target.startswith(old_prefix):
+                        new_target = os.path.join(new_prefix, target[len(old_prefix) + 1:].lstrip('/'))
+                        os.remove(entry.path)
+                        os.symlink(new_target, entry.path)
+                        rewritten += 1
+                elif entry.is_dir(follow_symlinks=False):
+                    (packages if in_packages else to_scan).append(entry.path)
+    return found, rewritten
+
+
+def rewrite_symlinks(root, old_prefix, new_prefix, jobs=8):
+    """Rewrite the symlinks below root from old_prefix to new_prefix.
+
+    All symlinks not beginning with old_prefix are ignored because packages
+    may contain arbitrary symlinks. The packages, i.e. the directories inside
+    any directory called packages (e.g. opt/mesosphere/packages/ of a
+    bootstrap work dir), are walked in parallel with jobs threads.
+
+    Returns the number of symlinks rewritten.
+    """
     log.info("Rewrite symlinks in %s from %s to %s", root, old_prefix, new_prefix)
-    # Find the symlinks and rewrite them from old_prefix to new_prefix
-    # All symlinks not beginning with old_prefix are ignored because
-    # packages may contain arbitrary symlinks.
-    for root_dir, dirs, files in os.walk(root):
-        for name in chain(files, dirs):
-            full_path = os.path.join(root_dir, name)
-            if os.path.islink(full_path):
-                # Rewrite old_prefix to new_prefix if present.
-                target = os.readlink(full_path)
-                if target.startswith(old_prefix):
-                    new_target = os.path.join(new_prefix, target[len(old_prefix) + 1:].lstrip('/'))
-                    os.remove(full_path)
-                    os.symlink(new_target, full_path)
+    start = time.monotonic()
+
+    packages = []
+    found, rewritten = _rewrite_symlinks_in(root, old_prefix, new_prefix, packages)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for package_found, package_rewritten in executor.map(
+                lambda package: _rewrite_symlinks_in(package, old_prefix, new_prefix), packages):
+            found += package_found
+            rewritten += package_rewritten
+
+    log.info("Rewrote %d of %d symlinks in %s in %.2fs", rewritten, found, root, time.monotonic() - start)
+    return rewritten
 
 
 def check_forbidden_services(path, services):
@@ -273,6 +273,13 @@ def get_package_artifact(package_id_str):
         'local_path': 'packages/cache/' + package_filename}
 
 
+def get_package_contents_digest_artifact(package_id_str):
+    digest_filename = pkgpanda.package_contents_digest_path(package_id_str)
+    return {
+        'reproducible_path': digest_filename,
+        'local_path': 'packages/cache/' + digest_filename}
+
+
 def get_gen_package_artifact(package_id_str):
     package_filename = make_package_filename(package_id_str)
     return {
@@ -355,6 +362,8 @@ def make_stable_artifacts(cache_repository_url, tree_variants):
             return
         metadata['packages'].add(package_id)
         add_file(get_package_artifact(package_id))
+        # Lets nodes check copies of the package they fetch from their peers.
+        add_file(get_package_contents_digest_artifact(package_id))
 
     # Add the bootstrap, active.json, packages as reproducible_path artifacts
     # Add the <variant>.bootstrap.latest as a channel_path
@@ -394,7 +403,13 @@ def built_resource_to_artifacts(built_resource: dict):
 #       'content': '',
 #       'content_file': '',
 #       }]}}
-def make_channel_artifacts(metadata, provider_names):
+def make_channel_artifacts(metadata, provider_names, jobs=1):
+    """Make the artifacts of each provider in provider_names for the release described by metadata.
+
+    The providers generate up to jobs of their templates at once, in separate
+    processes. The artifacts and the output of the generation come out in the
+    same order whatever jobs is.
+    """
     log.debug('making channel artifacts')
     artifacts = [{
         'channel_path': 'version',
@@ -449,7 +464,8 @@ def make_channel_artifacts(metadata, provider_names):
                     reproducible_artifact_path=metadata['reproducible_artifact_path'],
                     commit=metadata['commit'],
                     variant_arguments=module_specific_variant_arguments,
-                    all_completes=metadata['all_completes']):
+                    all_completes=metadata['all_completes'],
+                    jobs=jobs):
 
                 assert isinstance(built_resource, dict), built_resource
 
@@ -717,11 +733,12 @@ class ReleaseManager():
 
             self.__storage_providers[name] = storage
 
-    def __init__(self, config, noop, provider_names):
+    def __init__(self, config, noop, provider_names, jobs=1):
         self._setup_storage(config.get('storage', dict()))
         self.__noop = noop
         self.__config = config
         self.__provider_names = provider_names
+        self.__jobs = jobs
 
         preferred_name = config.get('options', dict()).get('preferred')
         if preferred_name:
@@ -785,7 +802,7 @@ class ReleaseManager():
         assert 'tag' in metadata
         del metadata['channel_artifacts']
 
-        metadata['channel_artifacts'] = make_channel_artifacts(metadata, self.__provider_names)
+        metadata['channel_artifacts'] = make_channel_artifacts(metadata, self.__provider_names, self.__jobs)
 
         storage_commands = repository.make_commands(metadata)
         self.apply_storage_commands(storage_commands)
@@ -798,7 +815,7 @@ class ReleaseManager():
         metadata = self.get_metadata(src_channel)
         self.fetch_key_artifacts(metadata)
         del metadata['channel_artifacts']
-        make_channel_artifacts(metadata, self.__provider_names)
+        make_channel_artifacts(metadata, self.__provider_names, self.__jobs)
 
         return metadata
 
@@ -837,7 +854,7 @@ class ReleaseManager():
         metadata['tag'] = tag
         assert 'channel_artifacts' not in metadata
 
-        metadata['channel_artifacts'] = make_channel_artifacts(metadata, self.__provider_names)
+        metadata['channel_artifacts'] = make_channel_artifacts(metadata, self.__provider_names, self.__jobs)
 
         storage_commands = repository.make_commands(metadata)
         self.apply_storage_commands(storage_commands)
@@ -880,6 +897,13 @@ def main():
         action='store_true',
         help="Build an installer artifact and terminate. Do not run any cloud provider stages.")
 
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help="Number of processes to generate the provider templates (CloudFormation, ARM) in at once.")
+
     parser.add_argument(
         '-c',
         '--config',
@@ -947,7 +971,11 @@ def main():
     if options.local:
         provider_names = ['bash']
 
-    release_manager = ReleaseManager(config, options.noop, provider_names)
+    if options.jobs < 1:
+        print("ERROR: --jobs must be a positive integer, got {}".format(options.jobs))
+        sys.exit(1)
+
+    release_manager = ReleaseManager(config, options.noop, provider_names, options.jobs)
     if options.action == 'promote':
         release_manager.promote(options.source_channel, options.destination_repository, options.destination_channel)
     elif options.action == 'create':
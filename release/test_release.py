@@ -481,8 +481,12 @@ stable_artifacts_metadata = {
          'channel_path': 'complete.latest.json'},
         {'local_path': 'packages/cache/packages/a/a--b.tar.xz',
             'reproducible_path': 'packages/a/a--b.tar.xz'},
+        {'local_path': 'packages/cache/packages/a/a--b.contents.sha256',
+            'reproducible_path': 'packages/a/a--b.contents.sha256'},
         {'local_path': 'packages/cache/packages/c/c--d.tar.xz',
             'reproducible_path': 'packages/c/c--d.tar.xz'},
+        {'local_path': 'packages/cache/packages/c/c--d.contents.sha256',
+            'reproducible_path': 'packages/c/c--d.contents.sha256'},
         {'local_path': 'packages/cache/bootstrap/downstream_installer_bootstrap_id.bootstrap.tar.xz',
          'reproducible_path': 'bootstrap/downstream_installer_bootstrap_id.bootstrap.tar.xz'},
         {'local_path': 'packages/cache/bootstrap/downstream_installer_bootstrap_id.active.json',
@@ -501,6 +505,8 @@ stable_artifacts_metadata = {
          'channel_path': 'installer.complete.latest.json'},
         {'local_path': 'packages/cache/packages/e/e--f.tar.xz',
             'reproducible_path': 'packages/e/e--f.tar.xz'},
+        {'local_path': 'packages/cache/packages/e/e--f.contents.sha256',
+            'reproducible_path': 'packages/e/e--f.contents.sha256'},
     ],
     'packages': ['a--b', 'c--d', 'e--f'],
     'bootstrap_dict': {None: "bootstrap_id"},